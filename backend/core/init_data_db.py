@@ -1,57 +1,143 @@
 import asyncio
 import json
 import pathlib
+from collections import defaultdict
 
 import geoalchemy2 as gsa
+import geopandas
+import pandas as pd
 import shapely
 
 from core.auth import get_password_hash
 from core.model_utils import get_count
 
 from .database import async_session, init_db
-from .models import City, City_property, District, District_property, User
+from .models import (
+    Block,
+    Block_property,
+    City,
+    City_property,
+    District,
+    District_property,
+    User,
+)
 
 DATA_DIR = pathlib.Path(__file__).parent.parent.joinpath("data")
 
 
-async def init_geo_data():
+DISTRICT_PROPERTIES = [
+    "common_area",
+    "beers_per_square_km",
+    "shop_numbers",
+    "green_area",
+    "station_numbers",
+    "avg_altitude_apartments",
+    "garage_area",
+    "retail_area",
+]
+# У кварталов те же метрики, что и у районов
+BLOCK_PROPERTIES = DISTRICT_PROPERTIES
+
+
+def _read_geojson_cities():
     with open(DATA_DIR.joinpath("geo_data.geojson"), "r") as f:
         data = json.load(f)
 
+    for city in data["features"]:
+        districts = []
+        for dist in city["districts"]["features"]:
+            dist_props = dist["properties"]
+            districts.append(
+                (
+                    dist_props["title"],
+                    {k: dist_props[k] for k in DISTRICT_PROPERTIES},
+                    dist["geometry"],
+                )
+            )
+        blocks = []
+        for block in city.get("blocks", {"features": []})["features"]:
+            block_props = block["properties"]
+            blocks.append(
+                (
+                    block_props["title"],
+                    {k: block_props[k] for k in BLOCK_PROPERTIES},
+                    block["geometry"],
+                )
+            )
+        yield city["properties"]["title"], city["geometry"], districts, blocks
+
+
+def _read_parquet_cities():
+    # Читаются только колонки, которые нужны таблицам backend
+    districts = geopandas.read_parquet(
+        DATA_DIR.joinpath("geo_data.parquet"),
+        columns=["city", "title", *DISTRICT_PROPERTIES, "geometry"],
+    )
+    cities = geopandas.read_parquet(
+        DATA_DIR.joinpath("geo_data_cities.parquet"), columns=["title", "geometry"]
+    )
+    city_districts = defaultdict(list)
+    for dist in districts.to_dict("records"):
+        city_districts[dist["city"]].append(
+            (
+                dist["title"],
+                {k: None if pd.isna(dist[k]) else dist[k] for k in DISTRICT_PROPERTIES},
+                gsa.shape.from_shape(dist["geometry"], srid=4326),
+            )
+        )
+    city_blocks = defaultdict(list)
+    if DATA_DIR.joinpath("geo_data_blocks.parquet").exists():
+        blocks = geopandas.read_parquet(
+            DATA_DIR.joinpath("geo_data_blocks.parquet"),
+            columns=["city", "title", *BLOCK_PROPERTIES, "geometry"],
+        )
+        for block in blocks.to_dict("records"):
+            city_blocks[block["city"]].append(
+                (
+                    block["title"],
+                    {k: None if pd.isna(block[k]) else block[k] for k in BLOCK_PROPERTIES},
+                    gsa.shape.from_shape(block["geometry"], srid=4326),
+                )
+            )
+    for city in cities.to_dict("records"):
+        yield (
+            city["title"],
+            gsa.shape.from_shape(city["geometry"], srid=4326),
+            city_districts[city["title"]],
+            city_blocks[city["title"]],
+        )
+
+
+async def init_geo_data():
+    if DATA_DIR.joinpath("geo_data.parquet").exists():
+        cities = _read_parquet_cities()
+    else:
+        cities = _read_geojson_cities()
+
     async with async_session() as db:
-        for city in data["features"]:
-            districts = []
-            for dist in city["districts"]["features"]:
-                dist_props = dist["properties"]
-                dist_title = dist_props.pop("title")
-                dist_props = {
-                    k: dist_props[k]
-                    for k in [
-                        "common_area",
-                        "beers_per_square_km",
-                        "shop_numbers",
-                        "green_area",
-                        "station_numbers",
-                        "avg_altitude_apartments",
-                        "garage_area",
-                        "retail_area",
-                    ]
-                }
-                districts.append(
-                    District(
-                        title=dist_title,
-                        properties=District_property(**dist_props),
-                        geom=dist["geometry"],
-                    )
+        for city_title, city_geom, city_districts, city_blocks in cities:
+            districts = [
+                District(
+                    title=dist_title,
+                    properties=District_property(**dist_props),
+                    geom=dist_geom,
+                )
+                for dist_title, dist_props, dist_geom in city_districts
+            ]
+            blocks = [
+                Block(
+                    title=block_title,
+                    properties=Block_property(**block_props),
+                    geom=block_geom,
                 )
-            city_props = city["properties"]
-            city_title = city_props.pop("title")
+                for block_title, block_props, block_geom in city_blocks
+            ]
             city_row = City(
                 title=city_title,
-                properties=City_property(**city_props),
+                properties=City_property(),
                 districts=districts,
-                blocks=[],
-                geom=city["geometry"],
+                blocks=blocks,
+                geom=city_geom,
             )
             db.add(city_row)
             await db.commit()
@@ -0,0 +1,124 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from pyproj import Transformer
+from shapely import MultiPolygon, Polygon
+
+# Равновеликая проекция, в которой считаются все площади
+EQUAL_AREA_CRS = 'EPSG:6933'
+# shapely.get_type_id для Polygon и MultiPolygon
+POLYGON_TYPE_IDS = (3, 6)
+
+
+@lru_cache(maxsize=None)
+def _transformer(source_crs: str, target_crs: str = EQUAL_AREA_CRS) -> Transformer:
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def _reproject(geometries, transformer: Transformer):
+    def transform(coords: np.ndarray) -> np.ndarray:
+        return np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+    return shapely.transform(geometries, transform)
+
+
+def to_equal_area(geometries, source_crs='EPSG:4326'):
+    """
+    Перепроецирует геометрии в равновеликую проекцию одним векторизованным вызовом.
+    :param geometries: Геометрия или массив геометрий.
+    :param source_crs: Исходная система координат.
+    :return: Геометрии в EQUAL_AREA_CRS.
+    """
+    return _reproject(geometries, _transformer(str(source_crs)))
+
+
+def from_equal_area(geometries, target_crs='EPSG:4326'):
+    """
+    Перепроецирует геометрии из равновеликой проекции обратно, например в EPSG:4326.
+    :param geometries: Геометрия или массив геометрий в EQUAL_AREA_CRS.
+    :param target_crs: Целевая система координат.
+    :return: Геометрии в target_crs.
+    """
+    return _reproject(geometries, _transformer(EQUAL_AREA_CRS, str(target_crs)))
+
+
+def local_crs(bounds: tuple) -> str:
+    """
+    Равновеликая азимутальная проекция Ламберта с центром в середине охвата. В пределах города она практически
+    не искажает ни площади, ни форму, поэтому размеры в ней - метры на местности по обеим осям
+    (в EQUAL_AREA_CRS на широте 56-60° отрезок с востока на запад растягивается в 1,5-1,7 раза,
+    а с севера на юг - во столько же раз сжимается).
+    :param bounds: Охват (minx, miny, maxx, maxy) в EPSG:4326.
+    :return: Строка proj.
+    """
+    minx, miny, maxx, maxy = bounds
+    return f'+proj=laea +lat_0={(miny + maxy) / 2:.6f} +lon_0={(minx + maxx) / 2:.6f} +datum=WGS84 +units=m +no_defs'
+
+
+def reproject(geometries, source_crs, target_crs):
+    """
+    Перепроецирует геометрии одним векторизованным вызовом между произвольными системами координат.
+    :param geometries: Геометрия или массив геометрий.
+    :param source_crs: Исходная система координат.
+    :param target_crs: Целевая система координат (например, local_crs).
+    :return: Геометрии в target_crs.
+    """
+    return _reproject(geometries, _transformer(str(source_crs), str(target_crs)))
+
+
+def clipped_union_areas(geometries: np.ndarray, zones: np.ndarray, feature_idx: np.ndarray,
+                        zone_idx: np.ndarray) -> np.ndarray:
+    """
+    Считает площади объектов, обрезанных по зонам (кварталам, ячейкам сетки), сразу для всех зон.
+    :param geometries: Полигоны объектов в равновеликой проекции (EQUAL_AREA_CRS или local_crs).
+    :param zones: Полигоны зон в той же проекции.
+    :param feature_idx: Номера объектов в парах объект-зона (например, из STRtree.query).
+    :param zone_idx: Номера зон в тех же парах.
+    :return: Площадь объединения обрезанных объектов для каждой зоны в квадратных метрах.
+    """
+    areas = np.zeros(len(zones))
+    if not len(feature_idx):
+        return areas
+    clipped = pd.Series(shapely.intersection(geometries[feature_idx], zones[zone_idx]), index=zone_idx)
+    single = ~clipped.index.duplicated(keep=False)
+    # Объект, единственный в зоне, не нужно объединять с другими
+    areas[clipped.index[single]] = shapely.area(clipped.values[single])
+    for zone, pieces in clipped[~single].groupby(level=0):
+        areas[zone] = shapely.union_all(pieces.values).area
+    return areas
+
+
+class ClippedAreaEngine:
+    """
+    Класс ClippedAreaEngine считает площади объектов внутри района за один проход.
+    Район перепроецируется один раз и подготавливается (shapely.prepare); полигоны всех площадных метрик
+    перепроецируются и обрезаются по району одним векторизованным вызовом, после чего площадь каждой метрики -
+    площадь объединения ее обрезанных полигонов, так что перекрывающиеся объекты не учитываются дважды.
+    """
+
+    def __init__(self, district: Polygon | MultiPolygon, features: GeoDataFrame):
+        """
+        :param district: Граница района в EQUAL_AREA_CRS (см. to_equal_area).
+        :param features: GeoDataFrame с объектами площадных метрик района.
+        """
+        self.district = district
+        shapely.prepare(self.district)
+        features = features[~features.index.duplicated()]
+        polygons = features[features.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])]
+        geometries = to_equal_area(polygons.geometry.to_numpy(), polygons.crs or 'EPSG:4326')
+        hits = shapely.intersects(geometries, self.district)
+        self._clipped = pd.Series(shapely.intersection(geometries[hits], self.district),
+                                  index=polygons.index[hits], dtype=object)
+
+    def area(self, layer: GeoDataFrame) -> float:
+        """
+        :param layer: GeoDataFrame с объектами одной метрики (подмножество объектов, переданных в конструктор).
+        :return: Площадь объединения обрезанных полигонов слоя в квадратных метрах.
+        """
+        clipped = self._clipped[self._clipped.index.isin(layer.index)]
+        if clipped.empty:
+            return 0.0
+        return shapely.union_all(clipped.values).area
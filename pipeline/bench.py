@@ -0,0 +1,294 @@
+import logging
+import math
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+import numpy as np
+import orjson
+import pandas as pd
+import shapely
+from pandas import DataFrame
+
+from geopandas import GeoDataFrame
+from shapely import MultiPolygon, Polygon, box
+
+from area_engine import ClippedAreaEngine, to_equal_area
+from collect_metric import METRICS, MetricCollector, measurable_metrics, metrics_of_kind, requested_metrics
+from main import METRIC_DIRECTIONS, calculate_index, form_geo_json
+from osm_cache import OsmCache
+
+# Центр синтетических районов (Томск); от широты зависит перевод километров в градусы
+SYNTHETIC_CENTER = (84.95, 56.48)
+
+
+def synthetic_metrics_frame(districts: int, cities: int, missing: float = 0.05, seed: int = 0) -> DataFrame:
+    """
+    Генерирует сырые метрики для синтетических районов.
+    :param districts: Число районов.
+    :param cities: Число городов, между которыми районы распределены поровну.
+    :param missing: Доля пропущенных значений каждой метрики.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: DataFrame с колонками city, district и колонками метрик.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'city': np.repeat([f'city_{index}' for index in range(cities)], -(-districts // cities))[:districts],
+        'district': [f'district_{index}' for index in range(districts)],
+    })
+    for metric_name in METRIC_DIRECTIONS:
+        values = rng.gamma(2.0, 10.0, districts)
+        values[rng.random(districts) < missing] = np.nan
+        df[metric_name] = values
+    return df
+
+
+def synthetic_metrics_outputs(districts: int, cities: int, seed: int = 0) -> dict:
+    """
+    Генерирует сырые метрики в формате fetch_raw_metrics: районы - квадраты, уложенные в ряд внутри города.
+    :param districts: Число районов.
+    :param cities: Число городов.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}.
+    """
+    df = synthetic_metrics_frame(districts, cities, seed=seed)
+    metrics_outputs = {}
+    for row in df.to_dict('records'):
+        city_districts = metrics_outputs.setdefault(row['city'], {'districts': {}})['districts']
+        offset = len(city_districts) * 0.01
+        properties = {metric_name: row[metric_name] for metric_name in METRIC_DIRECTIONS}
+        properties.update(title=row['district'], common_area=1.0)
+        city_districts[row['district']] = {
+            'type': 'FeatureCollection',
+            'features': [{
+                'id': '0',
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': MultiPolygon([box(offset, 0, offset + 0.01, 0.01)]).__geo_interface__,
+            }],
+        }
+    return metrics_outputs
+
+
+class SyntheticGeocoder:
+    """
+    Геокодер для бенчмарков без сети: любой город - единичный квадрат.
+    """
+
+    @staticmethod
+    def geocode_to_gdf(query: str, which_result: int = None) -> GeoDataFrame:
+        return GeoDataFrame({'display_name': [query]}, geometry=[box(0, 0, 1, 1)], crs='epsg:4326')
+
+
+class SyntheticFeatureSource(SyntheticGeocoder):
+    """
+    Источник объектов OSM для бенчмарков без сети. В любом полигоне генерируется density объектов каждой метрики
+    на квадратный километр: точки для метрик вида count и density и квадраты от 10 до 100 м для метрик вида area и mean.
+    Объекты имеют тот же вид, что и ответ osmnx: индекс (element_type, osmid) и колонка на каждый тег.
+    """
+
+    def __init__(self, density: float = 100.0, seed: int = 0):
+        """
+        :param density: Число объектов каждой метрики на квадратный километр.
+        :param seed: Начальное значение генератора случайных чисел.
+        """
+        self.density = density
+        self.seed = seed
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        rng = np.random.default_rng(self.seed)
+        minx, miny, maxx, maxy = polygon.bounds
+        count = max(1, round(self.density * to_equal_area(polygon).area / 1e6))
+        # Примерно 100 м в градусах на широте полигона
+        side = 0.0009 / max(math.cos(math.radians((miny + maxy) / 2)), 0.1), 0.0009
+        frames = []
+        for spec in METRICS.values():
+            key, values = next(iter(spec.tags.items()))
+            x = rng.uniform(minx, maxx, count)
+            y = rng.uniform(miny, maxy, count)
+            if spec.kind in ('area', 'mean'):
+                scale = rng.uniform(0.1, 1.0, count)
+                geometry = shapely.box(x, y, x + side[0] * scale, y + side[1] * scale)
+                element_type = 'way'
+            else:
+                geometry = shapely.points(x, y)
+                element_type = 'node'
+            frame = GeoDataFrame({key: rng.choice(values, count)}, geometry=geometry, crs='epsg:4326')
+            if spec.kind == 'mean':
+                frame[spec.attribute] = rng.integers(1, 25, count).astype(str)
+            frame['element_type'] = element_type
+            frames.append(frame)
+        features = pd.concat(frames, ignore_index=True)
+        features['osmid'] = np.arange(len(features))
+        features = features.set_index(['element_type', 'osmid'])
+        return MetricCollector.select_layer(features[features.intersects(polygon)], tags)
+
+
+def synthetic_district(side_km: float, center: tuple[float, float] = SYNTHETIC_CENTER) -> GeoDataFrame:
+    """
+    :param side_km: Сторона квадратного района в километрах.
+    :param center: Центр района (долгота, широта).
+    :return: GeoDataFrame с одним районом в формате geocode_to_gdf.
+    """
+    lon, lat = center
+    half_lat = side_km / 2 / 111.32
+    half_lon = half_lat / math.cos(math.radians(lat))
+    return GeoDataFrame({'display_name': [f'synthetic {side_km} km']},
+                        geometry=[box(lon - half_lon, lat - half_lat, lon + half_lon, lat + half_lat)],
+                        crs='epsg:4326')
+
+
+def _timed(fun, *args, repeat: int = 1, **kwargs) -> float:
+    """
+    :return: Лучшее время выполнения функции в секундах из repeat запусков.
+    """
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fun(*args, **kwargs)
+        timings.append(time.perf_counter() - started_at)
+    return min(timings)
+
+
+def save_results(results_path: str | Path, run: str, benchmark: str, cases: list[dict]) -> None:
+    """
+    Дописывает результаты бенчмарка в файл NDJSON, чтобы запуски можно было сравнить (см. команду compare).
+    :param results_path: Файл результатов.
+    :param run: Название запуска, например ветка или коммит.
+    :param benchmark: Название бенчмарка.
+    :param cases: Список словарей с параметрами случая и временем seconds.
+    """
+    timestamp = datetime.now(timezone.utc).isoformat()
+    with open(results_path, 'ab') as file:
+        for case in cases:
+            file.write(orjson.dumps({'run': run, 'timestamp': timestamp, 'benchmark': benchmark, **case},
+                                    option=orjson.OPT_APPEND_NEWLINE))
+
+
+def load_results(results_path: str | Path) -> DataFrame:
+    """
+    :param results_path: Файл результатов save_results.
+    :return: DataFrame с колонками run, timestamp, benchmark, case, seconds.
+    """
+    with open(results_path, 'rb') as file:
+        rows = [orjson.loads(line) for line in file if line.strip()]
+    results = pd.DataFrame(rows)
+    parameters = [column for column in results.columns if column not in ('run', 'timestamp', 'benchmark', 'seconds')]
+    results['case'] = results[parameters].astype(str).agg(' '.join, axis=1)
+    return results[['run', 'timestamp', 'benchmark', 'case', 'seconds']]
+
+
+def _run_name(run: str | None) -> str:
+    return run or datetime.now().strftime('%Y%m%d-%H%M%S')
+
+
+@click.group()
+def cli():
+    """Бенчмарки пайплайна; работают без сети."""
+
+
+@cli.command('calculate-index')
+@click.option("--districts", default=200_000, help="Number of synthetic districts")
+@click.option("--cities", default=200, help="Number of synthetic cities")
+@click.option("--repeat", default=3, help="Number of runs, the best one is reported")
+@click.option("--run", default=None, help="Name of the run in the results file, defaults to the current time")
+@click.option("--results", default='data/bench_results.ndjson', help="Enter the file to append results to")
+def bench_calculate_index(districts: int, cities: int, repeat: int, run: str, results: str):
+    metrics_outputs = synthetic_metrics_outputs(districts, cities)
+    seconds = _timed(calculate_index, metrics_outputs, repeat=repeat)
+    logging.info(f'calculate_index: {districts} districts, {cities} cities - {seconds:.3f} s')
+    save_results(results, _run_name(run), 'calculate_index',
+                 [{'districts': districts, 'cities': cities, 'seconds': seconds}])
+
+
+@cli.command('geo-json')
+@click.option("--districts", default=50_000, help="Number of synthetic districts")
+@click.option("--cities", default=500, help="Number of synthetic cities")
+@click.option("--output", default='data/bench_districts_indexed.json', help="Enter the file for GeoJSON output")
+@click.option("--run", default=None, help="Name of the run in the results file, defaults to the current time")
+@click.option("--results", default='data/bench_results.ndjson', help="Enter the file to append results to")
+def bench_geo_json(districts: int, cities: int, output: str, run: str, results: str):
+    metrics_outputs = synthetic_metrics_outputs(districts, cities)
+    indexed_districts = calculate_index(metrics_outputs)
+    seconds = _timed(form_geo_json, indexed_districts, metrics_outputs, output, source=SyntheticGeocoder())
+    logging.info(f'form_geo_json: {districts} districts, {cities} cities - {seconds:.3f} s')
+    save_results(results, _run_name(run), 'form_geo_json',
+                 [{'districts': districts, 'cities': cities, 'seconds': seconds}])
+
+
+def _bench_district(district: GeoDataFrame, features: GeoDataFrame, repeat: int) -> dict[str, float]:
+    """
+    Замеряет сбор метрик одного района по заранее загруженным объектам.
+    :return: Словарь {замер: время в секундах}: fetch_metrics, overlay (обрезка площадных объектов по району)
+        и каждая площадная метрика.
+    """
+    timings = {'fetch_metrics': _timed(MetricCollector.fetch_metrics, district, measurable_metrics, features,
+                                       repeat=repeat)}
+    district_equal_area, *_ = to_equal_area(district.geometry.to_numpy(), district.crs)
+    requested = requested_metrics(measurable_metrics)
+    layers = MetricCollector._split_layers(features, requested)
+    area_features = pd.concat([layers[metric_name] for metric_name in metrics_of_kind('area')])
+    timings['overlay'] = _timed(ClippedAreaEngine, district_equal_area, area_features, repeat=repeat)
+    areas = ClippedAreaEngine(district_equal_area, area_features)
+    for metric_name in metrics_of_kind('area'):
+        timings[f'_{metric_name}'] = _timed(MetricCollector._calculate_metric, metric_name, layers[metric_name],
+                                            areas, district_equal_area.area, repeat=repeat)
+    return timings
+
+
+@cli.command('metrics')
+@click.option("--sizes", default='1 4 16', help="Side lengths of synthetic square districts in km, between spaces")
+@click.option("--densities", default='10 100 1000', help="Features of each metric per square km, between spaces")
+@click.option("--fixtures", default=None, type=click.Path(exists=True, file_okay=False),
+              help="OSM cache directory recorded by main.py --cache_dir, read in offline mode instead of synthetic data")
+@click.option("--cities", default='Томск', help="Cities from data/districts.json to benchmark with --fixtures")
+@click.option("--repeat", default=3, help="Number of runs, the best one is reported")
+@click.option("--run", default=None, help="Name of the run in the results file, defaults to the current time")
+@click.option("--results", default='data/bench_results.ndjson', help="Enter the file to append results to")
+def bench_metrics(sizes: str, densities: str, fixtures: str, cities: str, repeat: int, run: str, results: str):
+    cases = []
+    if fixtures is None:
+        for side_km in map(float, sizes.split(' ')):
+            district = synthetic_district(side_km)
+            for density in map(float, densities.split(' ')):
+                features = SyntheticFeatureSource(density).features_from_polygon(
+                    district.geometry.iloc[0], MetricCollector.merge_tags(requested_metrics(measurable_metrics)))
+                for name, seconds in _bench_district(district, features, repeat).items():
+                    logging.info(f'{name}: {side_km} km, {density} features/km2 ({len(features)}) - {seconds:.4f} s')
+                    cases.append({'measure': name, 'side_km': side_km, 'density': density, 'seconds': seconds})
+    else:
+        source = OsmCache(fixtures, mode='offline')
+        with open('data/districts.json', 'rb') as file:
+            districts_list = orjson.loads(file.read())
+        for city_name in cities.split(' '):
+            for district_name in districts_list.get(city_name, []):
+                district = source.geocode_to_gdf(f'{city_name}, {district_name}', which_result=1)
+                features = MetricCollector.fetch_features(
+                    district.geometry.iloc[0], requested_metrics(measurable_metrics), source)
+                for name, seconds in _bench_district(district, features, repeat).items():
+                    logging.info(f'{name}: {city_name}, {district_name} ({len(features)}) - {seconds:.4f} s')
+                    cases.append({'measure': name, 'district': f'{city_name}, {district_name}', 'seconds': seconds})
+    save_results(results, _run_name(run), 'metrics', cases)
+
+
+@cli.command('compare')
+@click.option("--results", default='data/bench_results.ndjson', help="Enter the file with saved results")
+@click.option("--baseline", default=None, help="Baseline run, defaults to the previous run")
+@click.option("--current", default=None, help="Compared run, defaults to the last run")
+def bench_compare(results: str, baseline: str, current: str):
+    saved = load_results(results)
+    runs = saved.sort_values('timestamp')['run'].drop_duplicates().tolist()
+    current = current or runs[-1]
+    if baseline is None:
+        if runs.index(current) == 0:
+            raise click.UsageError(f'No run before {current} in {results}, pass --baseline')
+        baseline = runs[runs.index(current) - 1]
+    times = saved[saved['run'].isin([baseline, current])].pivot_table(
+        index=['benchmark', 'case'], columns='run', values='seconds', aggfunc='min')[[baseline, current]]
+    times['ratio'] = times[current] / times[baseline]
+    logging.info(f'{current} vs {baseline} (ratio < 1 is faster):\n{times.to_markdown()}')
+
+
+if __name__ == '__main__':
+    cli()
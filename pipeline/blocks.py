@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from osmnx._errors import EmptyOverpassResponse
+from pandas import DataFrame
+from shapely import MultiPolygon, Polygon, STRtree
+
+import osmnx as ox
+from area_engine import POLYGON_TYPE_IDS, clipped_union_areas, to_equal_area
+from collect_metric import METRICS, MetricCollector, measurable_metrics, record_features, requested_metrics
+from profiler import profiler
+
+# Улицы, которыми город делится на кварталы
+STREET_TAGS = {
+    'highway': [
+        'motorway', 'trunk', 'primary', 'secondary', 'tertiary', 'unclassified', 'residential', 'living_street',
+        'motorway_link', 'trunk_link', 'primary_link', 'secondary_link', 'tertiary_link', 'pedestrian',
+    ],
+}
+# Полигоны меньше этой площади (кв. м) - развязки и острова безопасности, а не кварталы
+MIN_BLOCK_AREA = 2_000
+
+
+def street_blocks(city_area: Polygon | MultiPolygon, source=None, min_area: float = MIN_BLOCK_AREA) -> GeoDataFrame:
+    """
+    Строит кварталы города полигонизацией уличной сети: улицы и граница города сшиваются в одну сеть линий,
+    а кварталами считаются замкнутые ею полигоны внутри города.
+    :param city_area: Граница города.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :param min_area: Минимальная площадь квартала в квадратных метрах.
+    :return: GeoDataFrame с колонкой title и границами кварталов.
+    """
+    if source is None:
+        source = ox
+    try:
+        streets = source.features_from_polygon(city_area, tags=STREET_TAGS)
+        lines = streets.geometry[streets.geom_type.isin(['LineString', 'MultiLineString'])].to_numpy()
+    except EmptyOverpassResponse:
+        lines = np.array([], dtype=object)
+    # union_all разбивает линии в точках пересечения, без этого polygonize не найдет замкнутых контуров
+    network = shapely.union_all(np.append(lines, shapely.boundary(city_area)))
+    polygons = shapely.get_parts(shapely.polygonize(shapely.get_parts(network)))
+    shapely.prepare(city_area)
+    polygons = polygons[shapely.contains(city_area, shapely.point_on_surface(polygons))]
+    polygons = polygons[shapely.area(to_equal_area(polygons)) >= min_area]
+    return GeoDataFrame({'title': [f'Квартал {number}' for number in range(1, len(polygons) + 1)]},
+                        geometry=[MultiPolygon([polygon]) for polygon in polygons], crs='epsg:4326')
+
+
+def block_metrics(blocks: GeoDataFrame, features: GeoDataFrame, metrics: dict[str, bool] = None) -> DataFrame:
+    """
+    Считает метрики сразу для всех кварталов города по объектам, загруженным одним запросом на весь город.
+    Пары объект-квартал находятся одним запросом к STRtree, площади обрезанных объектов считаются векторизованно,
+    поэтому время растет с числом пар, а не с произведением числа кварталов и объектов.
+    Метрики считаются так же, как для районов: способ расчета задается видом метрики в реестре METRICS.
+    Кварталы смыкаются по осям улиц, поэтому объекты на улице (например, остановки на линии дороги) касаются
+    двух кварталов сразу; для числа объектов и среднего атрибута объект относится ровно к одному кварталу -
+    тому, в котором лежит его точка на поверхности (как в grid.grid_aggregates).
+    :param blocks: GeoDataFrame с кварталами.
+    :param features: Объекты OSM города.
+    :param metrics: Словарь {метрика: собирать ли её}; по умолчанию все метрики.
+    :return: DataFrame с common_area (кв. км) и колонкой на каждую метрику в порядке строк blocks.
+    """
+    if metrics is None:
+        metrics = measurable_metrics
+    blocks_ea = to_equal_area(blocks.geometry.to_numpy(), blocks.crs or 'EPSG:4326')
+    common_area = shapely.area(blocks_ea)
+    result = DataFrame({'common_area': common_area / 1e6}, index=blocks.index)
+    features = features[~features.index.duplicated()]
+    geometries = to_equal_area(features.geometry.to_numpy(), features.crs or 'EPSG:4326')
+    tree = STRtree(blocks_ea)
+    feature_idx, block_idx = tree.query(geometries, predicate='intersects')
+    point_idx, point_blocks = tree.query(shapely.point_on_surface(geometries), predicate='intersects')
+    # Точка на общей границе двух кварталов относится к первому из них
+    point_idx, first = np.unique(point_idx, return_index=True)
+    point_blocks = point_blocks[first]
+
+    for metric_name in requested_metrics(metrics):
+        spec = METRICS[metric_name]
+        layer = MetricCollector.select_layer(features, spec.tags)
+        in_layer = features.index.isin(layer.index)
+        layer_points = point_idx[in_layer[point_idx]]
+        layer_point_blocks = point_blocks[in_layer[point_idx]]
+        match spec.kind:
+            case 'area':
+                pairs_in_layer = in_layer[feature_idx]
+                layer_features, layer_blocks = feature_idx[pairs_in_layer], block_idx[pairs_in_layer]
+                is_polygon = np.isin(shapely.get_type_id(geometries[layer_features]), POLYGON_TYPE_IDS)
+                areas = clipped_union_areas(geometries, blocks_ea, layer_features[is_polygon], layer_blocks[is_polygon])
+                result[metric_name] = areas / common_area
+            case 'mean':
+                values = pd.to_numeric(features[spec.attribute], errors='coerce').to_numpy() \
+                    if spec.attribute in features.columns else np.full(len(features), np.nan)
+                points = pd.Series(values[layer_points], index=layer_point_blocks).dropna()
+                result[metric_name] = points.groupby(level=0).mean().reindex(range(len(blocks))).to_numpy()
+            case 'count':
+                result[metric_name] = np.bincount(layer_point_blocks, minlength=len(blocks))
+            case 'density':
+                result[metric_name] = np.bincount(layer_point_blocks, minlength=len(blocks)) / (common_area / 1e6)
+    return result
+
+
+def collect_blocks(city_name: str, source=None, metrics: dict[str, bool] = None) -> GeoDataFrame:
+    """
+    Строит кварталы города и считает их метрики; на город нужно два запроса к OSM - улицы и объекты метрик.
+    :param city_name: Название города.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :param metrics: Словарь {метрика: собирать ли её}; по умолчанию все метрики.
+    :return: GeoDataFrame с колонками title, common_area, метриками и границами кварталов.
+    """
+    if source is None:
+        source = ox
+    if metrics is None:
+        metrics = measurable_metrics
+    city_area = source.geocode_to_gdf(city_name, which_result=1).geometry.iloc[0]
+    with profiler.stage('street_blocks', city=city_name) as record:
+        blocks = street_blocks(city_area, source)
+        record['features'] = len(blocks)
+    with profiler.stage('fetch_city', city=city_name) as record:
+        features = MetricCollector.fetch_features(city_area, requested_metrics(metrics), source)
+        record_features(record, features)
+    with profiler.stage('block_metrics', city=city_name) as record:
+        values = block_metrics(blocks, features, metrics)
+        record['features'] = len(blocks)
+    return GeoDataFrame(pd.concat([blocks[['title']], values], axis=1), geometry=blocks.geometry, crs='epsg:4326')
+
+
+def block_features(blocks: GeoDataFrame) -> list[dict]:
+    """
+    :param blocks: Кварталы из collect_blocks.
+    :return: Объекты GeoJSON кварталов без id, как у районов.
+    """
+    features = []
+    for feature in blocks.iterfeatures(na='null'):
+        feature.pop('id')
+        features.append(feature)
+    return features
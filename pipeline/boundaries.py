@@ -0,0 +1,197 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from osmnx._errors import EmptyOverpassResponse
+from shapely import MultiPolygon, Polygon
+
+import osmnx as ox
+from area_engine import POLYGON_TYPE_IDS
+from profiler import profiler
+
+# Административные границы, среди которых ищутся районы города; уровни регионов и стран (2-4) не запрашиваются,
+# так как их геометрия во много раз больше всех районов города вместе
+ADMIN_TAGS = {'admin_level': ['5', '6', '7', '8', '9', '10']}
+# Теги с названиями границы, по которым сопоставляются названия районов из districts.json
+NAME_KEYS = ('name', 'name:ru', 'official_name', 'short_name', 'alt_name')
+
+
+def normalize_name(name: str) -> str:
+    """
+    :param name: Название района.
+    :return: Название в нижнем регистре, с е вместо ё и словами через один пробел (без дефисов и знаков).
+    """
+    return ' '.join(re.findall(r'\w+', str(name).lower().replace('ё', 'е')))
+
+
+def _boundary_names(boundary: pd.Series) -> set[str]:
+    names = set()
+    for key in NAME_KEYS:
+        value = boundary.get(key)
+        if isinstance(value, str):
+            names.update(normalize_name(part) for part in value.split(';'))
+    return names
+
+
+def match_districts(boundaries: GeoDataFrame, district_list: list[str]) -> dict[str, int]:
+    """
+    Сопоставляет названия районов с административными границами. Сначала ищется точное совпадение
+    нормализованного названия, затем - граница, в названии которой есть все слова района
+    (например, "Исакогорский округ" и "Исакогорский территориальный округ") или наоборот.
+    Неоднозначные совпадения не принимаются.
+    :param boundaries: Административные границы внутри города.
+    :param district_list: Названия районов из districts.json.
+    :return: Словарь {район: позиция границы в boundaries} для найденных районов.
+    """
+    names = [_boundary_names(boundary) for _, boundary in boundaries.iterrows()]
+    levels = pd.to_numeric(boundaries['admin_level'], errors='coerce').to_numpy() \
+        if 'admin_level' in boundaries.columns else np.full(len(boundaries), np.nan)
+    matched = {}
+    for district_name in district_list:
+        district = normalize_name(district_name)
+        words = set(district.split())
+        candidates = [position for position, boundary_names in enumerate(names) if district in boundary_names]
+        if not candidates:
+            candidates = [position for position, boundary_names in enumerate(names)
+                          if any(words <= set(name.split()) or set(name.split()) <= words
+                                 for name in boundary_names if name)]
+        if len(candidates) > 1:
+            # Один и тот же район может быть отмечен на нескольких уровнях; берется самый крупный из них
+            top_level = np.nanmin(levels[candidates]) if not np.isnan(levels[candidates]).all() else np.nan
+            candidates = [position for position in candidates if levels[position] == top_level]
+        if len(candidates) == 1:
+            matched[district_name] = candidates[0]
+        elif candidates:
+            logging.warning(f'Ambiguous boundaries for district {district_name}: {len(candidates)} candidates')
+    return matched
+
+
+def _district_gdf(boundaries: GeoDataFrame, position: int, query: str) -> GeoDataFrame:
+    """
+    :return: Граница района в том же виде, что возвращает геокодер (см. PbfFeatureSource.geocode_to_gdf).
+    """
+    result = boundaries.iloc[[position]].reset_index()
+    result['display_name'] = query
+    columns = [column for column in ('geometry', 'display_name', 'element_type', 'osmid', 'name', 'admin_level')
+               if column in result.columns]
+    return GeoDataFrame(result[columns], geometry='geometry', crs='epsg:4326')
+
+
+def resolve_boundaries(city_name: str, city_area: Polygon | MultiPolygon, boundaries: GeoDataFrame,
+                       district_list: list[str]) -> dict[str, GeoDataFrame]:
+    """
+    Находит границы районов среди административных границ, загруженных одним запросом по границе города.
+    :param city_name: Название города.
+    :param city_area: Граница города.
+    :param boundaries: Административные границы, пересекающие город.
+    :param district_list: Названия районов из districts.json.
+    :return: Словарь {район: GeoDataFrame с границей района} для найденных районов.
+    """
+    if boundaries.empty:
+        return {}
+    geometries = boundaries.geometry.to_numpy()
+    shapely.prepare(city_area)
+    # Остаются полигоны, лежащие внутри города; сам город и объемлющие его границы отбрасываются
+    inside = np.isin(shapely.get_type_id(geometries), POLYGON_TYPE_IDS) \
+        & shapely.contains(city_area, shapely.point_on_surface(geometries)) \
+        & (shapely.area(geometries) < 0.99 * city_area.area)
+    boundaries = boundaries[inside]
+    return {district_name: _district_gdf(boundaries, position, f'{city_name}, {district_name}')
+            for district_name, position in match_districts(boundaries, district_list).items()}
+
+
+class BoundaryResolver:
+    """
+    Класс BoundaryResolver - обертка над источником данных OSM, которая находит границы всех районов города
+    за два запроса: геокодирование города и загрузку административных границ внутри него одним запросом объектов
+    (см. resolve_boundaries). Найденные границы города и районов запоминаются и отдаются из geocode_to_gdf
+    по тем же строкам запроса ("Город" и "Город, Район"), поэтому повторное геокодирование (например, при записи
+    GeoJSON) не обращается к сети. Районы, которые не удалось сопоставить, геокодируются источником по одному.
+    """
+
+    def __init__(self, source=None):
+        """
+        :param source: Источник данных OSM с интерфейсом osmnx (например, TiledSource); по умолчанию osmnx.
+        """
+        self.source = source
+        self.resolved: dict[str, GeoDataFrame] = {}
+
+    def __getstate__(self):
+        # Модуль osmnx нельзя сериализовать; найденные границы дочерним процессам не нужны
+        state = self.__dict__.copy()
+        if state['source'] is ox:
+            state['source'] = None
+        state['resolved'] = {}
+        return state
+
+    @property
+    def _source(self):
+        return ox if self.source is None else self.source
+
+    @property
+    def light_fetch(self) -> bool:
+        return getattr(self._source, 'light_fetch', False)
+
+    def remember(self, city_name: str, city_gdf: GeoDataFrame, district_gdfs: dict[str, GeoDataFrame]) -> None:
+        """
+        Запоминает найденные границы города и районов.
+        :param city_name: Название города.
+        :param city_gdf: Граница города.
+        :param district_gdfs: Словарь {район: GeoDataFrame с границей района}.
+        """
+        self.resolved[city_name] = city_gdf
+        for district_name, district_gdf in district_gdfs.items():
+            self.resolved[f'{city_name}, {district_name}'] = district_gdf
+
+    def resolve_districts(self, city_name: str, district_list: list[str]) -> dict[str, GeoDataFrame]:
+        """
+        Находит границы города и его районов и запоминает их.
+        :param city_name: Название города.
+        :param district_list: Названия районов из districts.json.
+        :return: Словарь {район: GeoDataFrame с границей района} для сопоставленных районов.
+        """
+        city_gdf = self.geocode_to_gdf(city_name, which_result=1)
+        city_area = city_gdf.geometry.iloc[0]
+        with profiler.stage('resolve_boundaries', city=city_name) as record:
+            try:
+                boundaries = self._source.features_from_polygon(city_area, tags=ADMIN_TAGS)
+            except EmptyOverpassResponse:
+                boundaries = GeoDataFrame(geometry=[], crs='epsg:4326')
+            record['features'] = len(boundaries)
+            district_gdfs = resolve_boundaries(city_name, city_area, boundaries, district_list)
+        if unmatched := [district_name for district_name in district_list if district_name not in district_gdfs]:
+            logging.info(f'{len(unmatched)} districts of {city_name} are not matched to boundaries, geocode them')
+        self.remember(city_name, city_gdf, district_gdfs)
+        return district_gdfs
+
+    def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        if which_result in (None, 1) and query in self.resolved:
+            return self.resolved[query]
+        return self._source.geocode_to_gdf(query, which_result=which_result)
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        return self._source.features_from_polygon(polygon, tags=tags)
+
+    def count_from_polygon(self, polygon: Polygon | MultiPolygon, tag_sets: list[dict]) -> list[int]:
+        return self._source.count_from_polygon(polygon, tag_sets)
+
+    def tags_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict, required_key: str = None) -> pd.DataFrame:
+        return self._source.tags_from_polygon(polygon, tags, required_key)
+
+
+async def resolve_districts_async(client, city_name: str,
+                                  district_list: list[str]) -> tuple[GeoDataFrame, dict[str, GeoDataFrame]]:
+    """
+    Асинхронный аналог BoundaryResolver.resolve_districts.
+    :param client: Открытый AsyncOverpassClient.
+    :param city_name: Название города.
+    :param district_list: Названия районов из districts.json.
+    :return: Граница города и словарь {район: GeoDataFrame с границей района} для сопоставленных районов.
+    """
+    city_gdf = await client.geocode_to_gdf(city_name, which_result=1)
+    city_area = city_gdf.geometry.iloc[0]
+    boundaries = await client.features_from_polygon(city_area, ADMIN_TAGS)
+    return city_gdf, resolve_boundaries(city_name, city_area, boundaries, district_list)
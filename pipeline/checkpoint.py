@@ -0,0 +1,148 @@
+import logging
+import os
+import time
+from collections.abc import Callable, Iterator, Mapping
+from pathlib import Path
+
+import orjson
+
+
+class RunCheckpoint:
+    """
+    Класс RunCheckpoint - контрольные точки сбора метрик в формате NDJSON.
+    Метрики каждого района дописываются в metrics.ndjson сразу после его сбора, а ошибки - отдельно
+    в failures.ndjson. При возобновлении запуска уже собранные районы пропускаются,
+    а районы с ошибками собираются заново. В памяти хранятся только смещения строк районов в metrics.ndjson:
+    метрики читаются с диска, когда нужны (см. raw_metrics).
+    """
+
+    def __init__(self, checkpoint_dir: str | Path = 'data/checkpoint', resume: bool = False):
+        """
+        :param checkpoint_dir: Каталог с файлами контрольных точек.
+        :param resume: Продолжить предыдущий запуск; иначе контрольные точки начинаются заново.
+        """
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self.metrics_path = self.checkpoint_dir.joinpath('metrics.ndjson')
+        self.failures_path = self.checkpoint_dir.joinpath('failures.ndjson')
+        if not resume:
+            for path in (self.metrics_path, self.failures_path):
+                path.unlink(missing_ok=True)
+        self._completed = {
+            (record['city'], record['district']): offset
+            for offset, record in self._scan(self.metrics_path)
+        }
+        if self._completed:
+            logging.info(f'Resume run: {len(self._completed)} districts are already collected')
+
+    @staticmethod
+    def _scan(path: Path) -> Iterator[tuple[int, dict]]:
+        if not path.exists():
+            return
+        with open(path, 'rb') as file:
+            offset = 0
+            for line in file:
+                try:
+                    yield offset, orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Недописанная строка, если запуск прервался во время записи
+                    logging.warning(f'Skip broken checkpoint line in {path}')
+                offset += len(line)
+
+    @staticmethod
+    def _append(path: Path, record: dict) -> int:
+        with open(path, 'ab') as file:
+            offset = file.seek(0, os.SEEK_END)
+            file.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY) + b'\n')
+            file.flush()
+            os.fsync(file.fileno())
+        return offset
+
+    def is_completed(self, city_name: str, district_name: str) -> bool:
+        return (city_name, district_name) in self._completed
+
+    def record_success(self, city_name: str, district_name: str, metrics: dict) -> None:
+        """
+        Сохраняет метрики собранного района.
+        :param city_name: Название города.
+        :param district_name: Название района.
+        :param metrics: FeatureCollection с метриками района.
+        """
+        self._completed[(city_name, district_name)] = self._append(
+            self.metrics_path, {'city': city_name, 'district': district_name, 'metrics': metrics})
+
+    def record_failure(self, city_name: str, district_name: str, error: str) -> None:
+        """
+        Сохраняет информацию о районе, который не удалось собрать.
+        :param city_name: Название города.
+        :param district_name: Название района.
+        :param error: Описание ошибки.
+        """
+        self._append(self.failures_path, {
+            'city': city_name, 'district': district_name, 'error': error, 'time': time.time(),
+        })
+
+    def failures(self) -> list[dict]:
+        """
+        :return: Записи об ошибках для районов, которые так и не были собраны.
+        """
+        return [record for _, record in self._scan(self.failures_path)
+                if not self.is_completed(record['city'], record['district'])]
+
+    def completed_metrics(self, city_name: str, district_name: str) -> dict | None:
+        offset = self._completed.get((city_name, district_name))
+        if offset is None:
+            return None
+        with open(self.metrics_path, 'rb') as file:
+            file.seek(offset)
+            return orjson.loads(file.readline())['metrics']
+
+    def raw_metrics(self, cities: dict[str, list[str]]) -> 'CityMetrics':
+        """
+        :param cities: Словарь {город: [районы]}.
+        :return: Сырые метрики собранных районов этих городов в формате fetch_raw_metrics, которые читаются
+            с диска по одному городу (см. CityMetrics).
+        """
+        offsets = {}
+        for city_name, district_list in cities.items():
+            city_offsets = {district_name: self._completed[(city_name, district_name)]
+                            for district_name in district_list if self.is_completed(city_name, district_name)}
+            if city_offsets:
+                offsets[city_name] = city_offsets
+
+        def load(city_name: str) -> dict:
+            districts = {}
+            with open(self.metrics_path, 'rb') as file:
+                for district_name, offset in offsets[city_name].items():
+                    file.seek(offset)
+                    districts[district_name] = orjson.loads(file.readline())['metrics']
+            return {'districts': districts}
+
+        return CityMetrics(list(offsets), load)
+
+
+class CityMetrics(Mapping):
+    """
+    Класс CityMetrics - сырые метрики в формате fetch_raw_metrics ({город: {'districts': {район: ...}}}),
+    которые хранятся вне памяти (в контрольных точках или в очереди задач). Метрики города загружаются при каждом
+    обращении к нему, поэтому при обходе городов (items) в памяти находятся границы районов только одного города.
+    """
+
+    def __init__(self, cities: list[str], load: Callable[[str], dict]):
+        """
+        :param cities: Города в порядке обхода.
+        :param load: Функция, которая загружает {'districts': {район: FeatureCollection с метриками}} города.
+        """
+        self.cities = cities
+        self.load = load
+
+    def __getitem__(self, city_name: str) -> dict:
+        if city_name not in self.cities:
+            raise KeyError(city_name)
+        return self.load(city_name)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.cities)
+
+    def __len__(self) -> int:
+        return len(self.cities)
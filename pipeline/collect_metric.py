@@ -1,196 +1,555 @@
 import logging  # Импорт модуля для логирования
+import math
 from collections import defaultdict  # Импорт функции defaultdict из модуля collections
+from dataclasses import dataclass
 from typing import Literal, Any  # Импорт типов Literal и Any из модуля typing
 
-import orjson.orjson
 import osmnx as ox  # Импорт библиотеки osmnx с псевдонимом ox
+from osmnx._errors import EmptyOverpassResponse
+import numpy as np
 import pandas as pd
-from geopandas import GeoDataFrame, overlay  # Импорт класса GeoDataFrame и функции overlay из модуля geopandas
-from shapely import Polygon, MultiPolygon  # Импорт класса Polygon и функции union_all из модуля shapely
+import shapely
+from geopandas import GeoDataFrame  # Импорт класса GeoDataFrame из модуля geopandas
+from shapely import Polygon, MultiPolygon, STRtree  # Импорт классов геометрий и пространственного индекса из shapely
 
-MetricLiterals = Literal[
-    'beers_per_square_km', 'shop_numbers', 'green_area', 'station_numbers', 'avg_altitude_apartments', 'garage_area', 'retail_area']
+from area_engine import POLYGON_TYPE_IDS, ClippedAreaEngine, from_equal_area, to_equal_area
+from profiler import profiler
+
+MetricKind = Literal['count', 'density', 'area', 'mean']
+# Название метрики; список метрик задается реестром METRICS
+MetricLiterals = str
+
+
+@dataclass(frozen=True)
+class MetricSpec:
+    """
+    Описание метрики: по нему планируется общий запрос объектов OSM и выбирается способ расчета.
+    """
+    name: str
+    # Фильтр объектов OSM в формате osmnx: {ключ: [значения]}
+    tags: dict[str, list[str]]
+    # count - число объектов, density - число объектов на кв. км, area - доля площади района под объектами,
+    # mean - среднее числового атрибута объектов
+    kind: MetricKind
+    # Направление метрики в индексе: 1 - метрика входит в индекс как x, -1 - как 1 - x
+    direction: int
+    # Атрибут объектов для метрик вида mean
+    attribute: str | None = None
+
+
+METRICS: dict[MetricLiterals, MetricSpec] = {}
+
+
+def register_metric(spec: MetricSpec) -> MetricSpec:
+    """
+    Добавляет метрику в реестр; ее теги попадают в общий запрос объектов, а значение - в индекс и результаты.
+    :param spec: Описание метрики.
+    :return: То же описание.
+    """
+    if spec.kind == 'mean' and spec.attribute is None:
+        raise ValueError(f'Metric {spec.name} of kind mean needs an attribute')
+    METRICS[spec.name] = spec
+    return spec
+
+
+register_metric(MetricSpec(
+    'beers_per_square_km',
+    {'shop': ['brewing_supplies', 'alcohol'], 'amenity': ['pub']},
+    kind='density', direction=-1,
+))
+# Спар, SPAR, Spar, Spar Express, SPAR Express, Spar express, Спар экспресс, Евроспар, ЕВРОСПАР, EUROSPAR,
+# Eurospar, EuroSPAR, Eurospar Express. EuroSPAR Express, Eurospar express, Interspar, Интерспар Пятёрочка (
+# е/ё); иногда дублируется ритейл и магаз
+register_metric(MetricSpec('shop_numbers', {'name': ['Пятёрочка']}, kind='count', direction=-1))
+register_metric(MetricSpec(
+    'green_area',
+    {
+        'leisure': ['park', 'garden', 'nature_reserve'],
+        'landuse': ['grass', 'forest', 'recreation_ground'],
+        'natural': ['wood', 'grassland', 'tree', 'tree_row', 'scrub'],
+    },
+    kind='area', direction=1,
+))
+register_metric(MetricSpec('station_numbers', {'highway': ['bus_stop']}, kind='count', direction=1))
+register_metric(MetricSpec(
+    'avg_altitude_apartments',
+    {'building': ['apartments', 'residential']},  # 'residential' is discussing
+    kind='mean', direction=-1, attribute='building:levels',
+))
+register_metric(MetricSpec(
+    'garage_area', {'building': ['garages', 'garage'], 'landuse': ['garages']}, kind='area', direction=-1))
+register_metric(MetricSpec(
+    'retail_area', {'landuse': ['retail'], 'amenity': ['marketplace']}, kind='area', direction=-1))
+
+
+# Виды метрик, которым не нужна геометрия объектов: в легком режиме они считаются по числу объектов (out count)
+# или по тегам объектов (out tags)
+LIGHT_KINDS: tuple[MetricKind, ...] = ('count', 'density', 'mean')
+
+# Оценки для выбора размера чанка по бюджету памяти (см. chunk_size): средний объем одного объекта в GeoDataFrame
+# вместе с тегами и геометрией и число объектов метрик на кв. км в плотной застройке
+FEATURE_BYTES = 4_000
+FEATURES_PER_SQUARE_KM = 3_000
+# Чанк со стороной меньше этой (в метрах) не дробится, даже если его объекты не укладываются в бюджет
+MIN_CHUNK_SIZE = 250.0
+# Запас в метрах: запрос объектов чанка расширяется на него, а объекты внутри чанка, сжатого на него,
+# не могут попасть в запрос соседнего чанка и учитываются без запоминания идентификаторов
+CHUNK_MARGIN = 1.0
+
+
+def chunk_size(memory_budget: float) -> float:
+    """
+    :param memory_budget: Бюджет памяти на объекты одного чанка в мегабайтах.
+    :return: Сторона квадратного чанка в метрах, объекты которого при ожидаемой плотности укладываются в бюджет.
+    """
+    features = memory_budget * 2 ** 20 / FEATURE_BYTES
+    return max(math.sqrt(features / FEATURES_PER_SQUARE_KM) * 1000, MIN_CHUNK_SIZE)
+
+
+def frame_bytes(features: GeoDataFrame) -> int:
+    """
+    :param features: GeoDataFrame с объектами.
+    :return: Примерный объем объектов в памяти: колонки и индекс плюс 16 байт на каждую координату геометрий.
+    """
+    if features.empty:
+        return 0
+    attributes = features.drop(columns=features.geometry.name).memory_usage(deep=True).sum()
+    return int(attributes + shapely.get_num_coordinates(features.geometry.to_numpy()).sum() * 16)
+
+
+def record_features(record: dict, features: pd.DataFrame) -> None:
+    """
+    Дописывает в запись этапа профилировщика число объектов и их объем (frame_bytes; для объектов без геометрии -
+    объем колонок). Объем считается обходом всех колонок, поэтому только при включенном профилировщике.
+    :param record: Запись этапа из profiler.stage.
+    :param features: Загруженные объекты.
+    """
+    record['features'] = len(features)
+    if profiler.enabled:
+        record['bytes'] = frame_bytes(features) if isinstance(features, GeoDataFrame) \
+            else int(features.memory_usage(deep=True).sum())
+
+
+def _polygonal(geometries: np.ndarray) -> list[Polygon | MultiPolygon]:
+    """
+    :param geometries: Результаты обрезки полигона.
+    :return: Непустые полигональные части; линии и точки касания отбрасываются.
+    """
+    pieces = []
+    for geometry in geometries:
+        if shapely.get_type_id(geometry) not in POLYGON_TYPE_IDS:
+            parts = shapely.get_parts(geometry)
+            parts = parts[np.isin(shapely.get_type_id(parts), POLYGON_TYPE_IDS)]
+            geometry = shapely.union_all(parts) if len(parts) else None
+        if geometry is not None and geometry.area > 0:
+            pieces.append(geometry)
+    return pieces
+
+
+def district_chunks(district: Polygon | MultiPolygon, size: float) -> list[Polygon | MultiPolygon]:
+    """
+    Делит район на квадратные чанки. Стороны чанков параллельны осям, поэтому при перепроецировании
+    в EPSG:4326 соседние чанки по-прежнему смыкаются без щелей и наложений.
+    :param district: Граница района в EQUAL_AREA_CRS.
+    :param size: Сторона чанка в метрах.
+    :return: Непересекающиеся части района.
+    """
+    minx, miny, maxx, maxy = district.bounds
+    x, y = np.meshgrid(np.arange(minx, maxx, size), np.arange(miny, maxy, size))
+    cells = shapely.box(x.ravel(), y.ravel(), x.ravel() + size, y.ravel() + size)
+    return _polygonal(shapely.intersection(cells, district))
+
+
+def _quarters(chunk: Polygon | MultiPolygon) -> list[Polygon | MultiPolygon]:
+    minx, miny, maxx, maxy = chunk.bounds
+    return district_chunks(chunk, max(maxx - minx, maxy - miny) / 2)
+
+
+def metrics_of_kind(kind: MetricKind) -> tuple[MetricLiterals, ...]:
+    """
+    :param kind: Вид метрики.
+    :return: Названия метрик этого вида в порядке реестра.
+    """
+    return tuple(metric_name for metric_name, spec in METRICS.items() if spec.kind == kind)
 
 
 class MetricCollector:
     """
     Класс MetricCollector содержит методы для сбора различных метрик в заданных географических районах.
+    Все объекты OSM, нужные метрикам района, загружаются одним запросом (см. fetch_features),
+    после чего разбиваются на слои по тегам каждой метрики.
+    Если источник поддерживает легкий режим (source.light_fetch, см. overpass_client.OverpassSource),
+    метрики видов LIGHT_KINDS считаются без загрузки геометрий (см. fetch_light_values).
+    Крупные районы можно собирать по чанкам с ограниченным объемом объектов в памяти (см. fetch_chunked_values).
     """
 
-    @classmethod
-    def _pub_numbers(cls, district: Polygon, common_area: float) -> float:
+    @staticmethod
+    def merge_tags(metrics: list[MetricLiterals]) -> dict[str, list[str]]:
         """
-        Метод собирает метрику, связанную с количеством пабов в заданном районе (district).
-        :param district: Полигон, представляющий географический район.
-        :param common_area: Площадь общего района, на которую приходится этот полигон.
-        :return: Значение собранной метрики (число пабов на площадь в квадратных километрах).
+        Объединяет словари тегов нескольких метрик в один словарь для общего запроса к Overpass.
+        :param metrics: Список метрик, которые нужно собрать.
+        :return: Словарь тегов вида {ключ: [значения]}.
         """
+        merged = defaultdict(set)
+        for metric_name in metrics:
+            for key, values in METRICS[metric_name].tags.items():
+                merged[key].update(values)
+        return {key: sorted(values) for key, values in merged.items()}
 
+    @staticmethod
+    def select_layer(features: GeoDataFrame, tags: dict[str, list[str]]) -> GeoDataFrame:
         """
-        - 'amenity': 'pub':
-        - 'shop': ['brewing_supplies', 'alcohol']
-        :param district:
-        :return:
+        Выбирает из общего набора объектов те, что подходят под теги одной метрики.
+        :param features: GeoDataFrame со всеми загруженными объектами района.
+        :param tags: Словарь тегов в формате osmnx: {ключ: True | значение | [значения]}.
+        :return: GeoDataFrame с объектами метрики.
         """
-        beers = ox.features_from_polygon(district, tags={
-            'shop': ['brewing_supplies', 'alcohol'],
-            'amenity': ['pub']
-        })
-        # logging.debug(f"{beers}")
-        return len(beers) / (common_area / 1e6)
+        mask = pd.Series(False, index=features.index)
+        for key, values in tags.items():
+            if key not in features.columns:
+                continue
+            if values is True:
+                mask |= features[key].notna()
+            else:
+                mask |= features[key].isin([values] if isinstance(values, str) else values)
+        return features[mask]
 
     @classmethod
-    def _shop_numbers(cls, district: Polygon) -> int:
+    def fetch_features(cls, area: Polygon | MultiPolygon, metrics: list[MetricLiterals], source=None) -> GeoDataFrame:
         """
-        - 'amenity': 'pub':
-        - 'shop': ['brewing_supplies', 'alcohol']
-        :param district:
-        :return:
+        Загружает объекты OSM, нужные перечисленным метрикам, одним запросом.
+        :param area: Полигон района или всего города.
+        :param metrics: Список метрик, которые нужно собрать.
+        :param source: Источник данных OSM с интерфейсом osmnx (например, OsmCache); по умолчанию osmnx.
+        :return: GeoDataFrame со всеми найденными объектами.
         """
-        shops = ox.features_from_polygon(district, tags={
-            'name': ['Пятёрочка']
-        })
-        # Спар, SPAR, Spar, Spar Express, SPAR Express, Spar express, Спар экспресс, Евроспар, ЕВРОСПАР, EUROSPAR,
-        # Eurospar, EuroSPAR, Eurospar Express. EuroSPAR Express, Eurospar express, Interspar, Интерспар Пятёрочка (
-        # е/ё); иногда дублируется ритейл и магаз logging.debug(f"{beers}")
+        if source is None:
+            source = ox
+        if not metrics:
+            return GeoDataFrame(geometry=[], crs='epsg:4326')
+        try:
+            return source.features_from_polygon(area, tags=cls.merge_tags(metrics))
+        except EmptyOverpassResponse:
+            # В полигоне нет ни одного подходящего объекта
+            return GeoDataFrame(geometry=[], crs='epsg:4326')
 
-        return len(shops)
+    @staticmethod
+    def light_metrics(metrics: list[MetricLiterals], source=None) -> list[MetricLiterals]:
+        """
+        :param metrics: Список метрик, которые нужно собрать.
+        :param source: Источник данных OSM.
+        :return: Метрики, которые источник посчитает без геометрий; пустой список, если легкий режим не поддерживается.
+        """
+        if not getattr(source, 'light_fetch', False):
+            return []
+        return [metric_name for metric_name in metrics if METRICS[metric_name].kind in LIGHT_KINDS]
 
     @classmethod
-    def _green_area(cls, district: GeoDataFrame, common_area: float) -> float:
-        """
-        Метод собирает метрику, связанную с зелеными зонами в заданном районе (district).
-        :param district: GeoDataFrame, представляющий географический район.
-        :param common_area: Площадь общего района, на которую приходится этот район.
-        :return: Значение доли зеленых зон на общей площади района.
-        """
-        greens: GeoDataFrame = ox.features_from_polygon(district['geometry'].all(), tags={
-            'leisure': ['park', 'garden', 'nature_reserve'],
-            'landuse': ['grass', 'forest', 'recreation_ground'],
-            'natural': ['wood', 'grassland', 'tree', 'tree_row', 'scrub', 'wood']
-        })
-        clipped_greens = overlay(greens[greens.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])],
-                                 district, how='intersection', keep_geom_type=True)
-        # print(clipped_greens)
-        # united_clipped_greens = union_all(clipped_greens['geometry']).area
-        # green_area = united_clipped_greens.area
-        green_area = clipped_greens.to_crs(epsg=6933).area.sum()
-        logging.debug(f'green area = {green_area}')
-        logging.debug(f'common area = {common_area}')
-
-        return green_area / common_area
+    def geometry_metrics(cls, metrics: list[MetricLiterals], source=None) -> list[MetricLiterals]:
+        """
+        :param metrics: Список метрик, которые нужно собрать.
+        :param source: Источник данных OSM.
+        :return: Метрики, для которых нужно загружать объекты с геометрией (см. fetch_features).
+        """
+        light = cls.light_metrics(metrics, source)
+        return [metric_name for metric_name in metrics if metric_name not in light]
 
     @classmethod
-    def _station_numbers(cls, district: Polygon) -> int:
+    def fetch_light_values(cls, area: Polygon | MultiPolygon, metrics: list[MetricLiterals], common_area: float,
+                           source) -> dict[MetricLiterals, Any]:
         """
-        - 'amenity': 'pub':
-        - 'shop': ['brewing_supplies', 'alcohol']
-        :param district:
-        :return:
+        Считает метрики без загрузки геометрий: числа объектов всех метрик видов count и density
+        запрашиваются одним запросом out count, а для метрик вида mean загружаются только теги объектов,
+        у которых задан атрибут метрики.
+        :param area: Полигон района.
+        :param metrics: Метрики видов LIGHT_KINDS.
+        :param common_area: Площадь района в квадратных метрах.
+        :param source: Источник данных OSM с легким режимом (count_from_polygon, tags_from_polygon).
+        :return: Словарь {метрика: значение}.
         """
-        stations = ox.features_from_polygon(district, tags={
-            'highway': ['bus_stop']
-        })
-        # Спар, SPAR, Spar, Spar Express, SPAR Express, Spar express, Спар экспресс, Евроспар, ЕВРОСПАР, EUROSPAR, Eurospar, EuroSPAR, Eurospar Express. EuroSPAR Express, Eurospar express, Interspar, Интерспар
-        # Пятёрочка (е/ё); иногда дублируется ритейл и магаз
-        # logging.debug(f"{beers}")
-
-        return len(stations)
+        values = {}
+        counted = [metric_name for metric_name in metrics if METRICS[metric_name].kind in ('count', 'density')]
+        if counted:
+            counts = source.count_from_polygon(area, [METRICS[metric_name].tags for metric_name in counted])
+            for metric_name, count in zip(counted, counts):
+                values[metric_name] = count if METRICS[metric_name].kind == 'count' else count / (common_area / 1e6)
+        for metric_name in metrics:
+            spec = METRICS[metric_name]
+            if spec.kind == 'mean':
+                values[metric_name] = cls._attribute_mean(
+                    source.tags_from_polygon(area, spec.tags, spec.attribute), spec.attribute)
+        return values
 
     @classmethod
-    def _avg_altitude_apartments(cls, district: Polygon) -> float:
+    def fetch_chunked_values(cls, area: Polygon | MultiPolygon, area_equal_area: Polygon | MultiPolygon,
+                             metrics: list[MetricLiterals], common_area: float, source,
+                             memory_budget: float) -> dict[MetricLiterals, Any]:
         """
-        Метод собирает метрику, связанную со средней высотой зданий типа "апартаменты" в заданном районе (district).
-        :param district: Полигон, представляющий географический район.
-        :return: Значение средней высоты апартаментов.
+        Считает метрики района по чанкам, чтобы в памяти были объекты только одного чанка.
+        Район делится на чанки (см. district_chunks, chunk_size); объекты каждого чанка загружаются отдельно
+        и сворачиваются в частичные результаты, которые затем складываются:
+            count, density - число объектов;
+            mean - сумма и число значений атрибута (та же свертка _attribute_total, что и для района целиком);
+            area - площадь объединения полигонов, обрезанных по чанку; чанки не пересекаются, поэтому площади
+            складываются без двойного учета.
+        Объект на границе чанков попадает в запросы нескольких чанков, поэтому для таких объектов запоминаются
+        идентификаторы и каждый учитывается один раз. Если источник умеет считать объекты (легкий режим),
+        объем чанка оценивается до загрузки по числу объектов (out count, FEATURE_BYTES на объект), и чанк,
+        который не укладывается в бюджет, делится на четыре части без загрузки объектов. Если бюджет превышают
+        уже загруженные объекты, чанк тоже делится на четыре части, которые загружаются заново.
+        Если значения атрибута метрики вида mean в каком-то чанке не числовые, метрика не считается (None),
+        как и при расчете района целиком.
+        :param area: Полигон района.
+        :param area_equal_area: Полигон района в EQUAL_AREA_CRS.
+        :param metrics: Метрики, которым нужны объекты с геометрией.
+        :param common_area: Площадь района в квадратных метрах.
+        :param source: Источник данных OSM с интерфейсом osmnx.
+        :param memory_budget: Бюджет памяти на объекты одного чанка в мегабайтах.
+        :return: Словарь {метрика: значение}.
         """
-        apartments: GeoDataFrame = ox.features_from_polygon(district, tags={
-            'building': ['apartments', 'residential'],  # 'residential' is discussing
-        })
-        apartments_with_defined_floors = apartments[apartments['building:levels'].notnull()]
+        budget = memory_budget * 2 ** 20
+        seen = {metric_name: set() for metric_name in metrics}
+        counts = dict.fromkeys(metrics, 0)
+        sums = dict.fromkeys(metrics, 0.0)
+        areas = dict.fromkeys(metrics, 0.0)
+        failed = set()
+        shapely.prepare(area)
+        chunks = district_chunks(area_equal_area, chunk_size(memory_budget))
+        counted_tags = cls.merge_tags(metrics) if getattr(source, 'light_fetch', False) else None
+        while chunks:
+            chunk = chunks.pop()
+            minx, miny, maxx, maxy = chunk.bounds
+            divisible = max(maxx - minx, maxy - miny) > MIN_CHUNK_SIZE
+            chunk_area = from_equal_area(shapely.buffer(chunk, CHUNK_MARGIN))
+            if divisible and counted_tags:
+                # Объем чанка оценивается по числу объектов до загрузки: заведомо крупный чанк делится сразу
+                with profiler.stage('count_chunk') as record:
+                    record['features'] = sum(source.count_from_polygon(chunk_area, [counted_tags]))
+                if record['features'] * FEATURE_BYTES > budget:
+                    chunks.extend(_quarters(chunk))
+                    continue
+            with profiler.stage('fetch_chunk') as record:
+                features = cls.fetch_features(chunk_area, metrics, source)
+                size = frame_bytes(features)
+                record['features'] = len(features)
+                record['bytes'] = size
+            if size > budget and divisible:
+                del features
+                chunks.extend(_quarters(chunk))
+                continue
+            features = features[~features.index.duplicated()]
+            features = features[shapely.intersects(area, features.geometry.to_numpy())]
+            interior = shapely.contains_properly(from_equal_area(shapely.buffer(chunk, -CHUNK_MARGIN)),
+                                                 features.geometry.to_numpy())
+            layers = cls._split_layers(features, metrics)
+            area_layers = [layers[metric_name] for metric_name in metrics if METRICS[metric_name].kind == 'area']
+            with profiler.stage('overlay') as record:
+                engine = ClippedAreaEngine(chunk, pd.concat(area_layers)) if area_layers else None
+                record['features'] = sum(len(layer) for layer in area_layers)
+            for metric_name, layer in layers.items():
+                spec = METRICS[metric_name]
+                if spec.kind == 'area':
+                    areas[metric_name] += engine.area(layer)
+                    continue
+                # Объекты внутри чанка не попадут в другие чанки; объекты на границе учитываются один раз
+                inside = interior[features.index.get_indexer(layer.index)]
+                first = np.array([key not in seen[metric_name] for key in layer.index[~inside]], dtype=bool)
+                seen[metric_name].update(layer.index[~inside])
+                counted = pd.concat([layer[inside], layer[~inside][first]])
+                if spec.kind == 'mean':
+                    if metric_name in failed:
+                        continue
+                    try:
+                        total, count = cls._attribute_total(counted, spec.attribute)
+                    except ValueError:
+                        logging.warning(f'Something went wrong with {metric_name} in a chunk', exc_info=True)
+                        failed.add(metric_name)
+                        continue
+                    sums[metric_name] += total
+                    counts[metric_name] += count
+                else:
+                    counts[metric_name] += len(counted)
+            del features, layers, area_layers, engine
+
+        values = {}
+        for metric_name in metrics:
+            match METRICS[metric_name].kind:
+                case 'count':
+                    values[metric_name] = counts[metric_name]
+                case 'density':
+                    values[metric_name] = counts[metric_name] / (common_area / 1e6)
+                case 'area':
+                    values[metric_name] = areas[metric_name] / common_area
+                case 'mean':
+                    values[metric_name] = sums[metric_name] / counts[metric_name] \
+                        if counts[metric_name] and metric_name not in failed else None
+        return values
 
-        return pd.to_numeric(apartments_with_defined_floors['building:levels'],downcast='float').sum() / len(
-            apartments_with_defined_floors)
+    @staticmethod
+    def partition_features(features: GeoDataFrame, districts: GeoDataFrame) -> list[GeoDataFrame]:
+        """
+        Распределяет объекты, загруженные для всего города, по районам с помощью STRtree.
+        Объект на границе попадает во все районы, с которыми пересекается.
+        :param features: GeoDataFrame с объектами города.
+        :param districts: GeoDataFrame с районами города.
+        :return: Список GeoDataFrame с объектами каждого района в порядке строк districts.
+        """
+        if features.empty:
+            return [features] * len(districts)
+        tree = STRtree(features.geometry.values)
+        district_idx, feature_idx = tree.query(districts.geometry.values, predicate='intersects')
+        return [features.iloc[feature_idx[district_idx == position]] for position in range(len(districts))]
 
     @classmethod
-    def _garage_area(cls, district: GeoDataFrame, common_area: float) -> float:
+    def _split_layers(cls, features: GeoDataFrame, metrics: list[MetricLiterals]) -> dict[MetricLiterals, GeoDataFrame]:
+        """
+        Разбивает объекты OSM района на слои по метрикам.
+        :param features: Объекты района.
+        :param metrics: Список метрик, которые нужно собрать.
+        :return: Словарь {метрика: GeoDataFrame с объектами метрики}.
+        """
+        return {metric_name: cls.select_layer(features, METRICS[metric_name].tags) for metric_name in metrics}
+
+    @staticmethod
+    def _count(layer: GeoDataFrame) -> int:
+        """
+        :param layer: GeoDataFrame с объектами метрики в районе.
+        :return: Число объектов.
         """
-        Метод собирает метрику, связанную с площадью гаражей в заданном районе (district).
-        :param district: GeoDataFrame, представляющий географический район.
-        :param common_area: Площадь общего района, на которую приходится этот район.
-        :return: Значение доли площади гаражей на общей площади района.
+        return len(layer)
+
+    @staticmethod
+    def _density(layer: GeoDataFrame, common_area: float) -> float:
+        """
+        :param layer: GeoDataFrame с объектами метрики в районе.
+        :param common_area: Площадь района в квадратных метрах.
+        :return: Число объектов на квадратный километр.
+        """
+        return len(layer) / (common_area / 1e6)
+
+    @staticmethod
+    def _clipped_area(layer: GeoDataFrame, areas: ClippedAreaEngine, common_area: float) -> float:
+        """
+        :param layer: GeoDataFrame с объектами метрики в районе.
+        :param areas: Площади объектов, обрезанных по границе района.
+        :param common_area: Площадь района в квадратных метрах.
+        :return: Доля площади района под объектами.
         """
-        garages: GeoDataFrame = ox.features_from_polygon(district['geometry'].all(), tags={
-            'building': ['garages', 'garage'],
-            'landuse': ['garages'],
-        })
-        clipped_garages = overlay(garages[garages.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])],
-                                  district, how='intersection', keep_geom_type=True)
-        garage_area = clipped_garages.to_crs(epsg=6933).area.sum()
-        logging.debug(f'garage area = {garage_area}')
-        logging.debug(f'common area = {common_area}')
+        return areas.area(layer) / common_area
 
-        return garage_area / common_area
+    @staticmethod
+    def _attribute_total(layer: GeoDataFrame, attribute: str) -> tuple[float, int]:
+        """
+        Сворачивает значения атрибута в сумму и число; общая свертка для района целиком и для чанков.
+        Не числовое значение атрибута вызывает ValueError.
+        :param layer: GeoDataFrame с объектами метрики.
+        :param attribute: Числовой атрибут объектов, например building:levels.
+        :return: Сумма значений атрибута и число объектов, где он задан.
+        """
+        if attribute not in layer.columns:
+            return 0.0, 0
+        values = layer[attribute][layer[attribute].notnull()]
+        return pd.to_numeric(values, downcast='float').sum(), len(values)
 
     @classmethod
-    def _retail_area(cls, district: GeoDataFrame, common_area: float) -> float:
+    def _attribute_mean(cls, layer: GeoDataFrame, attribute: str) -> float | None:
         """
-        Метод собирает метрику, связанную с площадью оптовых рынков в заданном районе (district).
-        :param district: GeoDataFrame, представляющий географический район.
-        :param common_area: Площадь общего района, на которую приходится этот район.
-        :return: Значение доли площади оптовых рынков на общей площади района.
+        :param layer: GeoDataFrame с объектами метрики в районе.
+        :param attribute: Числовой атрибут объектов, например building:levels.
+        :return: Среднее значение атрибута у объектов, где он задан; None, если таких объектов нет.
         """
-        retails: GeoDataFrame = ox.features_from_polygon(district['geometry'].all(), tags={
-            'landuse': ['retail'], 'amenity': ['marketplace']
-        })
-        clipped_retails = overlay(retails[retails.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])],
-                                  district, how='intersection', keep_geom_type=True)
-        retail_area = clipped_retails.to_crs(epsg=6933).area.sum()
-        logging.debug(f'retail area = {retail_area}')
-        logging.debug(f'common area = {common_area}')
+        total, count = cls._attribute_total(layer, attribute)
+        return total / count if count else None
 
-        return retail_area / common_area
+    @classmethod
+    def _calculate_metric(cls, metric_name: MetricLiterals, layer: GeoDataFrame, areas: ClippedAreaEngine | None,
+                          common_area: float):
+        """
+        Считает одну метрику района по ее слою объектов способом, заданным видом метрики в реестре.
+        :param metric_name: Название метрики.
+        :param layer: GeoDataFrame с объектами метрики (см. _split_layers).
+        :param areas: Площади объектов внутри района для метрик вида area.
+        :param common_area: Площадь района в квадратных метрах.
+        :return: Значение метрики.
+        """
+        spec = METRICS[metric_name]
+        match spec.kind:
+            case 'count':
+                return cls._count(layer)
+            case 'density':
+                return cls._density(layer, common_area)
+            case 'area':
+                return cls._clipped_area(layer, areas, common_area)
+            case 'mean':
+                return cls._attribute_mean(layer, spec.attribute)
+        raise ValueError(f'Unknown metric kind: {spec.kind}')
 
     @classmethod
-    def fetch_metrics(cls, districts: GeoDataFrame, metrics) -> dict[
-        MetricLiterals, Any]:
+    def fetch_metrics(cls, districts: GeoDataFrame, metrics, features: GeoDataFrame = None, source=None,
+                      memory_budget: float = None) -> dict[MetricLiterals, Any]:
         """
         Приватный статический метод для сбора метрик для всех переданных географических районов.
+        Ошибка загрузки объектов района (например, таймаут или 429 от Overpass) не перехватывается,
+        чтобы вызывающий код учел район как несобранный и мог повторить его; None получают только метрики,
+        расчет которых не удался по уже загруженным объектам.
         :param districts: GeoDataFrame с информацией о географических районах.
         :param metrics: Переменное число аргументов для указания, какие метрики собирать.
+        :param features: Заранее загруженные объекты OSM, покрывающие все районы (например, для всего города);
+            в легком режиме - только объекты метрик из geometry_metrics.
+        :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+        :param memory_budget: Бюджет памяти на объекты OSM в мегабайтах; если задан, объекты районов загружаются
+            по чанкам (см. fetch_chunked_values). Заранее загруженные объекты (features) уже в памяти и не делятся.
         :return: Словарь с результатами собранных метрик.
         """
         data = defaultdict(list)
-        crs = districts.to_crs({'proj': 'cea'})
+        # Каждый район перепроецируется в равновеликую проекцию один раз
+        with profiler.stage('reproject') as record:
+            districts_equal_area = to_equal_area(districts.geometry.to_numpy(), districts.crs or 'EPSG:4326')
+            record['features'] = len(districts_equal_area)
+        requested = requested_metrics(metrics)
+        light = cls.light_metrics(requested, source)
+        geometric = [metric_name for metric_name in requested if metric_name not in light]
+        partitions = None if features is None else cls.partition_features(features, districts)
+        chunked = memory_budget is not None and partitions is None
 
         for index, district in districts.iterrows():
             data['title'].append(district['display_name'])
-            common_area = crs.iloc[[index]]['geometry'].area.sum()
-            # print(f'{}')
+            common_area = districts_equal_area[index].area
             data['common_area'].append(common_area / 1e6)
-            for metric_name, is_metric_collected in metrics.items():
-                if not is_metric_collected:
-                    continue
+            if chunked:
+                with profiler.stage('chunked'):
+                    values = cls.fetch_chunked_values(district['geometry'], districts_equal_area[index],
+                                                      geometric, common_area, source, memory_budget)
+                layers, areas = {}, None
+            else:
+                with profiler.stage('fetch' if partitions is None else 'partition') as record:
+                    district_features = cls.fetch_features(district['geometry'], geometric, source) \
+                        if partitions is None else partitions[index]
+                    record_features(record, district_features)
+                layers = cls._split_layers(district_features, geometric)
+                area_layers = [layers[metric_name] for metric_name in geometric
+                               if METRICS[metric_name].kind == 'area']
+                with profiler.stage('overlay') as record:
+                    areas = ClippedAreaEngine(districts_equal_area[index], pd.concat(area_layers)) \
+                        if area_layers else None
+                    record['features'] = sum(len(layer) for layer in area_layers)
+                values = {}
+            with profiler.stage('fetch_light'):
+                if light:
+                    values |= cls.fetch_light_values(district['geometry'], light, common_area, source)
+
+            for metric_name in requested:
                 try:
-                    match metric_name:
-                        case 'beers_per_square_km':
-                            data[metric_name].append(cls._pub_numbers(district['geometry'], common_area))
-                        case 'shop_numbers':
-                            data[metric_name].append(cls._shop_numbers(district['geometry']))
-                        case 'green_area':
-                            data[metric_name].append(cls._green_area(districts.iloc[[index]], common_area))
-                        case 'station_numbers':
-                            data[metric_name].append(cls._station_numbers(district['geometry']))
-                        case 'avg_altitude_apartments':
-                            data[metric_name].append(cls._avg_altitude_apartments(district['geometry']))
-                        case 'garage_area':
-                            data[metric_name].append(cls._garage_area(districts.iloc[[index]], common_area))
-                        case 'retail_area':
-                            data[metric_name].append(cls._retail_area(districts.iloc[[index]], common_area))
-
-                except Exception as exc:
-                    logging.warning(f'Something went wrong with {metric_name} for {district["display_name"]}')
-                    print(f'{exc.args}')
+                    with profiler.stage('metric', metric=metric_name) as record:
+                        if metric_name in values:
+                            value = values[metric_name]
+                        else:
+                            record_features(record, layers[metric_name])
+                            value = cls._calculate_metric(metric_name, layers[metric_name], areas, common_area)
+                    data[metric_name].append(value)
+                except Exception:
+                    logging.warning(f'Something went wrong with {metric_name} for {district["display_name"]}',
+                                    exc_info=True)
                     data[metric_name].append(None)
 
         return data
@@ -199,27 +558,33 @@ class MetricCollector:
 logging.getLogger().setLevel(logging.INFO)
 logging.getLogger("urllib3").setLevel(logging.INFO)
 
-measurable_metrics = {
-        'beers_per_square_km': True,
-        'shop_numbers': True,
-        'green_area': True,
-        'station_numbers': True,
-        'avg_altitude_apartments': True,
-        'garage_area': True,
-        'retail_area': True
-    }
+measurable_metrics = {metric_name: True for metric_name in METRICS}
 
-def collect_metrics(districts: GeoDataFrame, metrics: dict[str,bool] = None):
+
+def requested_metrics(metrics: dict[str, bool]) -> list[MetricLiterals]:
+    """
+    Функция возвращает список метрик, отмеченных для сбора.
+    :param metrics: Словарь {метрика: собирать ли её}.
+    :return: Список имен метрик.
+    """
+    return [metric_name for metric_name, is_metric_collected in metrics.items() if is_metric_collected]
+
+
+def collect_metrics(districts: GeoDataFrame, metrics: dict[str,bool] = None, features: GeoDataFrame = None,
+                    source=None, memory_budget: float = None):
     """
     Функция для сбора метрик для заданных географических районов по их именам.
     :param districts:
     :param metrics: Переменное число аргументов для указания, какие метрики собирать.
+    :param features: Заранее загруженные объекты OSM, покрывающие районы (режим загрузки по городу).
+    :param source: Источник данных OSM с интерфейсом osmnx (например, OsmCache); по умолчанию osmnx.
+    :param memory_budget: Бюджет памяти на объекты OSM в мегабайтах для загрузки районов по чанкам.
     :return: DataFrame с результатами собранных метрик.
     """
 
     if metrics is None:
         metrics = measurable_metrics
-    metrics_for_districts = MetricCollector.fetch_metrics(districts, metrics)
+    metrics_for_districts = MetricCollector.fetch_metrics(districts, metrics, features, source, memory_budget)
     geos = []
     for geo in districts.geometry.to_list():
         if isinstance(geo, MultiPolygon):
@@ -228,6 +593,9 @@ def collect_metrics(districts: GeoDataFrame, metrics: dict[str,bool] = None):
             geos.append(MultiPolygon([geo]))
 
     metrics_for_districts['geometry'] = geos
-    # print(metrics_for_districts)
-    return orjson.loads(GeoDataFrame(metrics_for_districts).to_json())
+    # FeatureCollection собирается напрямую, без сериализации в JSON и обратного разбора
+    return {
+        'type': 'FeatureCollection',
+        'features': list(GeoDataFrame(metrics_for_districts).iterfeatures(na='null')),
+    }
     # return DataFrame(metrics_for_districts)
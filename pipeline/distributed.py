@@ -0,0 +1,239 @@
+import logging
+import os
+import socket
+import time
+from multiprocessing import Process
+
+import click
+
+from geojson_writer import GEOJSON_FORMATS
+from main import _collect_district, _geocode_districts, make_source, publish_index, read_districts_list
+from osm_cache import CACHE_MODES
+from overpass_client import OVERPASS_URL
+from query_tiling import MAX_QUERY_AREA, SIMPLIFY_TOLERANCE
+from work_queue import LeaseQueue, open_queue
+
+
+def run_worker(queue: LeaseQueue, source, worker_id: str = None, poll_interval: float = 5.0,
+               memory_budget: float = None) -> int:
+    """
+    Забирает задачи из очереди и собирает метрики районов, пока все задачи не будут завершены.
+    Пока исполнитель собирает район, аренда задачи продлевается; ошибка района возвращает задачу в очередь.
+    Исполнитель не выходит, пока у других исполнителей есть задачи в аренде: если чья-то аренда истечет,
+    задача достанется ему.
+    :param queue: Очередь задач.
+    :param source: Источник данных OSM с интерфейсом osmnx.
+    :param worker_id: Идентификатор исполнителя; по умолчанию имя машины и номер процесса.
+    :param poll_interval: Пауза между попытками забрать задачу, когда свободных задач нет.
+    :param memory_budget: Бюджет памяти на объекты OSM района в мегабайтах (загрузка по чанкам).
+    :return: Число собранных районов.
+    """
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    collected = 0
+    while True:
+        task = queue.claim(worker_id)
+        if task is None:
+            if queue.is_finished():
+                logging.info(f'Worker {worker_id} is done: {collected} districts collected')
+                return collected
+            time.sleep(poll_interval)
+            continue
+        city_name, district_name = task
+        try:
+            with queue.leased(worker_id, city_name, district_name):
+                district_gdfs = _geocode_districts(city_name, [district_name], source)
+                if district_name not in district_gdfs:
+                    raise LookupError('District boundary was not resolved')
+                district_metrics = _collect_district(city_name, district_name, district_gdfs[district_name],
+                                                     None, source, memory_budget)
+        except Exception as exc:
+            logging.error(f'Something went wrong with {city_name} {district_name}', exc_info=True)
+            queue.fail(worker_id, city_name, district_name, repr(exc))
+            continue
+        queue.complete(worker_id, city_name, district_name, district_metrics)
+        collected += 1
+
+
+def wait_for_queue(queue: LeaseQueue, poll_interval: float = 5.0, workers_alive=None) -> bool:
+    """
+    Ждет завершения всех задач очереди, периодически сообщая о ходе сбора.
+    :param queue: Очередь задач.
+    :param poll_interval: Пауза между проверками очереди.
+    :param workers_alive: Функция, которая сообщает, остались ли исполнители; по умолчанию исполнители считаются живыми.
+    :return: Все ли задачи завершены.
+    """
+    while not queue.is_finished():
+        if workers_alive is not None and not workers_alive():
+            logging.error(f'All workers exited before the queue was finished: {queue.counts()}')
+            return False
+        logging.info(f'Work queue: {queue.counts()}')
+        time.sleep(poll_interval)
+    logging.info(f'Work queue is finished: {queue.counts()}')
+    return True
+
+
+def _worker_process(queue_target: str, lease: float, max_attempts: int, source_settings: dict, worker_id: str,
+                    poll_interval: float, memory_budget: float) -> None:
+    queue = open_queue(queue_target, lease_seconds=lease, max_attempts=max_attempts)
+    run_worker(queue, make_source(**source_settings), worker_id, poll_interval, memory_budget)
+
+
+def source_options(cache_mode: str = 'read-through'):
+    """
+    Добавляет команде параметры источника данных OSM (см. main.make_source).
+    :param cache_mode: Режим кэша по умолчанию.
+    """
+    options = [
+        click.option("--cache_mode", type=click.Choice(CACHE_MODES), default=cache_mode,
+                     help="OSM cache mode: read-through, refresh or offline"),
+        click.option("--cache_dir", default='data/cache', help="Enter the directory for the OSM response cache"),
+        click.option("--pbf", default=None, help="Enter the local OSM extract (.osm.pbf) to use instead of Overpass"),
+        click.option("--max_query_area", default=MAX_QUERY_AREA, type=click.FloatRange(min=0),
+                     help="Max area of one feature query in square km (0 - no tiling)"),
+        click.option("--simplify_tolerance", default=SIMPLIFY_TOLERANCE, type=click.FloatRange(min=0),
+                     help="Simplification tolerance of query boundaries in meters (0 - no simplification)"),
+        click.option("--light_fetch", is_flag=True, default=False,
+                     help="Fetch counts and tags without geometry for metrics that need no geometry"),
+        click.option("--overpass_url", default=OVERPASS_URL, help="Overpass interpreter URL for light fetch mode"),
+        click.option("--batch_boundaries", is_flag=True, default=False,
+                     help="Resolve the city and all its district boundaries with one query per city "
+                          "(workers geocode their single districts directly)"),
+    ]
+
+    def decorator(command):
+        for option in reversed(options):
+            command = option(command)
+        return command
+
+    return decorator
+
+
+memory_budget_option = click.option(
+    "--memory_budget", default=None, type=click.FloatRange(min=1),
+    help="Memory budget in MB for OSM features of one chunk; large districts are collected in chunks")
+
+
+def queue_options(command):
+    """
+    Добавляет команде параметры очереди задач.
+    """
+    options = [
+        click.option("--queue", "queue_target", default='data/work_queue.sqlite',
+                     help="Enter the work queue: a postgresql:// DSN shared by workers on several hosts "
+                          "or a SQLite file on a local disk (single host only)"),
+        click.option("--lease", default=300.0, type=click.FloatRange(min=1),
+                     help="Task lease in seconds; workers renew it every third of the lease"),
+        click.option("--max_attempts", default=3, type=click.IntRange(min=1),
+                     help="Number of attempts to collect a district"),
+        click.option("--poll_interval", default=5.0, type=click.FloatRange(min=0),
+                     help="Pause in seconds between polls of the queue"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def publish_options(command):
+    """
+    Добавляет команде параметры итогового расчета индекса и записи результатов.
+    """
+    options = [
+        click.option("--cities", default='Томск Новосибирск Санкт-Петербург',
+                     help="Enter list of cities between spaces"),
+        click.option("--reset", is_flag=True, default=False, help="Clear the work queue before enqueueing"),
+        click.option("--file_geojson", default='data/districts_indexed.json',
+                     help="Enter the file with results of calculated index for districts in json"),
+        click.option("--file_simple_md_result", default='data/districts_indexed.md',
+                     help="Enter the file with results"),
+        click.option("--geojson_format", type=click.Choice(GEOJSON_FORMATS), default='geojson',
+                     help="GeoJSON output format"),
+        click.option("--file_geoparquet", default=None, help="Enter the file to also write results in GeoParquet"),
+        click.option("--index_state", default=None,
+                     help="Enter the directory of the persisted index state to recompute only changed cities"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def _enqueue(queue: LeaseQueue, cities: str, reset: bool) -> None:
+    added = queue.enqueue(read_districts_list(set(cities.split(' '))), reset=reset)
+    logging.info(f'Enqueued {added} new districts: {queue.counts()}')
+
+
+def _publish(queue: LeaseQueue, source_settings: dict, file_geojson: str, file_simple_md_result: str,
+             geojson_format: str, file_geoparquet: str, index_state: str) -> None:
+    if failures := queue.failures():
+        logging.warning(f'{len(failures)} districts failed after all attempts: {failures}')
+    publish_index(queue.results(), make_source(**source_settings), file_geojson, file_simple_md_result,
+                  geojson_format, file_geoparquet=file_geoparquet, index_state=index_state)
+
+
+@click.group()
+def cli():
+    """Распределенный сбор метрик: координатор ставит районы в общую очередь, исполнители их собирают.
+
+    Очередь в Postgres (--queue postgresql://...) общая для исполнителей на нескольких машинах; очередь SQLite
+    рассчитана на одну машину: координатор и исполнители должны работать там, где лежит файл очереди.
+    """
+
+
+@cli.command('coordinator')
+@queue_options
+@publish_options
+@source_options()
+def coordinator(queue_target: str, lease: float, max_attempts: int, poll_interval: float, cities: str, reset: bool,
+                file_geojson: str, file_simple_md_result: str, geojson_format: str, file_geoparquet: str,
+                index_state: str, **source_settings):
+    """Ставит районы городов в очередь, ждет их сбора исполнителями и считает индекс."""
+    queue = open_queue(queue_target, lease_seconds=lease, max_attempts=max_attempts)
+    _enqueue(queue, cities, reset)
+    wait_for_queue(queue, poll_interval)
+    _publish(queue, source_settings, file_geojson, file_simple_md_result, geojson_format, file_geoparquet,
+             index_state)
+
+
+@cli.command('worker')
+@queue_options
+@source_options()
+@click.option("--worker_id", default=None, help="Worker name in the queue, defaults to host name and process id")
+@memory_budget_option
+def worker(queue_target: str, lease: float, max_attempts: int, poll_interval: float, worker_id: str,
+           memory_budget: float, **source_settings):
+    """Собирает метрики районов из очереди, пока все задачи не будут завершены."""
+    queue = open_queue(queue_target, lease_seconds=lease, max_attempts=max_attempts)
+    run_worker(queue, make_source(**source_settings), worker_id, poll_interval, memory_budget)
+
+
+@cli.command('local')
+@queue_options
+@publish_options
+@source_options()
+@click.option("--workers", default=2, type=click.IntRange(min=1), help="Number of local worker processes")
+@memory_budget_option
+def local(queue_target: str, lease: float, max_attempts: int, poll_interval: float, cities: str, reset: bool,
+          file_geojson: str, file_simple_md_result: str, geojson_format: str, file_geoparquet: str,
+          index_state: str, workers: int, memory_budget: float, **source_settings):
+    """Координатор и несколько исполнителей в отдельных процессах на одной машине."""
+    queue = open_queue(queue_target, lease_seconds=lease, max_attempts=max_attempts)
+    _enqueue(queue, cities, reset)
+    processes = [
+        Process(target=_worker_process, args=(queue_target, lease, max_attempts, source_settings,
+                                              f'{socket.gethostname()}-local-{number}', poll_interval,
+                                              memory_budget))
+        for number in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    finished = wait_for_queue(queue, poll_interval, lambda: any(process.is_alive() for process in processes))
+    for process in processes:
+        process.join()
+    if not finished:
+        raise click.ClickException('Workers exited before all districts were collected, see the log')
+    _publish(queue, source_settings, file_geojson, file_simple_md_result, geojson_format, file_geoparquet,
+             index_state)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+from typing import Literal
+
+import orjson
+
+GeoJsonFormat = Literal['geojson', 'geojsonseq']
+GEOJSON_FORMATS: tuple[GeoJsonFormat, ...] = ('geojson', 'geojsonseq')
+
+DUMPS_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+
+class GeoJsonWriter:
+    """
+    Класс GeoJsonWriter - потоковая запись FeatureCollection: объекты пишутся на диск по одному,
+    поэтому в памяти не нужно держать всю коллекцию. Байты результата совпадают с
+    orjson.dumps({'type': 'FeatureCollection', 'features': [...]}).
+    Запись идет во временный файл, который заменяет результат только при успешном выходе из with,
+    поэтому прерванный запуск не оставляет усеченный файл, похожий на готовый результат.
+
+    Используется как контекстный менеджер:
+        with GeoJsonWriter('data/districts_indexed.json') as writer:
+            writer.write(feature)
+    """
+
+    header = b'{"type":"FeatureCollection","features":['
+    separator = b','
+    footer = b']}'
+
+    def __init__(self, path: str | Path):
+        """
+        :param path: Файл, в который записывается результат.
+        """
+        self.path = Path(path)
+        self.count = 0
+        self._file = None
+        self._tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+
+    def __enter__(self):
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(self.header)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        file, self._file = self._file, None
+        try:
+            if exc_type is None:
+                file.write(self.footer)
+            file.close()
+        except BaseException:
+            self._tmp_path.unlink(missing_ok=True)
+            raise
+        if exc_type is None:
+            os.replace(self._tmp_path, self.path)
+        else:
+            self._tmp_path.unlink(missing_ok=True)
+
+    def write(self, feature: dict) -> None:
+        """
+        Записывает один объект GeoJSON.
+        :param feature: Объект GeoJSON (Feature).
+        """
+        if self.count:
+            self._file.write(self.separator)
+        self._file.write(orjson.dumps(feature, option=DUMPS_OPTIONS))
+        self.count += 1
+
+
+class GeoJsonSeqWriter(GeoJsonWriter):
+    """
+    Класс GeoJsonSeqWriter - запись объектов в формате GeoJSONSeq/NDJSON: по одному Feature на строку.
+    """
+
+    header = b''
+    separator = b''
+    footer = b''
+
+    def write(self, feature: dict) -> None:
+        self._file.write(orjson.dumps(feature, option=DUMPS_OPTIONS | orjson.OPT_APPEND_NEWLINE))
+        self.count += 1
+
+
+def open_geojson_writer(path: str | Path, output_format: GeoJsonFormat = 'geojson') -> GeoJsonWriter:
+    """
+    Создает потоковый писатель нужного формата.
+    :param path: Файл, в который записывается результат.
+    :param output_format: geojson (FeatureCollection) или geojsonseq (объект на строку).
+    :return: Писатель; открывается через with.
+    """
+    match output_format:
+        case 'geojson':
+            return GeoJsonWriter(path)
+        case 'geojsonseq':
+            return GeoJsonSeqWriter(path)
+    raise ValueError(f'Unknown GeoJSON format: {output_format}')
@@ -0,0 +1,208 @@
+import math
+from typing import Literal
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+from shapely import MultiPolygon, Polygon, STRtree
+
+import osmnx as ox
+from area_engine import POLYGON_TYPE_IDS, clipped_union_areas, local_crs, reproject
+from collect_metric import METRICS, MetricCollector, measurable_metrics, record_features, requested_metrics
+from profiler import profiler
+
+GridShape = Literal['hex', 'square']
+GRID_SHAPES: tuple[GridShape, ...] = ('hex', 'square')
+# Размер ячейки в метрах: сторона квадрата или расстояние между противоположными сторонами шестиугольника
+GRID_CELL_SIZE = 500.0
+
+
+def _square_cells(bounds: tuple, size: float) -> np.ndarray:
+    minx, miny, maxx, maxy = bounds
+    x, y = np.meshgrid(np.arange(minx, maxx, size), np.arange(miny, maxy, size))
+    return shapely.box(x.ravel(), y.ravel(), x.ravel() + size, y.ravel() + size)
+
+
+def _hex_cells(bounds: tuple, size: float) -> np.ndarray:
+    minx, miny, maxx, maxy = bounds
+    radius = size / math.sqrt(3)
+    x, y = np.meshgrid(np.arange(minx, maxx + size, size), np.arange(miny, maxy + radius, 1.5 * radius))
+    # Каждый второй ряд шестиугольников сдвинут на половину ширины
+    x = x + (np.arange(x.shape[0]) % 2)[:, None] * size / 2
+    angles = np.radians(np.arange(30, 390, 60))
+    coords = np.stack([x.ravel()[:, None] + radius * np.cos(angles), y.ravel()[:, None] + radius * np.sin(angles)],
+                      axis=-1)
+    return shapely.polygons(coords)
+
+
+def city_grid(city_area: Polygon | MultiPolygon, cell_size: float = GRID_CELL_SIZE,
+              grid_shape: GridShape = 'hex') -> GeoDataFrame:
+    """
+    Покрывает город равномерной сеткой: ячейки строятся в равновеликой проекции с центром в городе (local_crs),
+    поэтому все внутренние ячейки одинаковы по площади и форме на местности; ячейки на границе обрезаются по городу.
+    :param city_area: Граница города.
+    :param cell_size: Размер ячейки в метрах на местности.
+    :param grid_shape: hex (шестиугольники) или square (квадраты).
+    :return: GeoDataFrame с номером ячейки cell и ее границей.
+    """
+    crs = local_crs(city_area.bounds)
+    area_ea = reproject(city_area, 'EPSG:4326', crs)
+    match grid_shape:
+        case 'hex':
+            cells = _hex_cells(area_ea.bounds, cell_size)
+        case 'square':
+            cells = _square_cells(area_ea.bounds, cell_size)
+        case _:
+            raise ValueError(f'Unknown grid shape: {grid_shape}')
+    shapely.prepare(area_ea)
+    cells = shapely.intersection(cells[shapely.intersects(area_ea, cells)], area_ea)
+    cells = cells[np.isin(shapely.get_type_id(cells), POLYGON_TYPE_IDS)]
+    return GeoDataFrame({'cell': np.arange(len(cells))}, geometry=reproject(cells, crs, 'EPSG:4326'), crs='epsg:4326')
+
+
+def additive_columns(metric_name: str) -> list[str]:
+    """
+    :param metric_name: Название метрики.
+    :return: Колонки аддитивных величин, из которых метрика получается для любой группы ячеек.
+    """
+    match METRICS[metric_name].kind:
+        case 'count' | 'density':
+            return [f'{metric_name}_count']
+        case 'area':
+            return [f'{metric_name}_area_m2']
+        case 'mean':
+            return [f'{metric_name}_sum', f'{metric_name}_count']
+
+
+def grid_aggregates(cells: GeoDataFrame, features: GeoDataFrame, metrics: dict[str, bool] = None) -> DataFrame:
+    """
+    Считает аддитивные величины метрик по ячейкам, из которых метрика получается для любой группы ячеек
+    (см. finalize_metrics). Точечный объект относится ровно к одной ячейке - той, в которой лежит его точка
+    на поверхности, поэтому суммы по ячейкам не считают объекты дважды; площадные объекты обрезаются по ячейкам.
+    :param cells: Ячейки сетки из city_grid.
+    :param features: Объекты OSM города.
+    :param metrics: Словарь {метрика: собирать ли её}; по умолчанию все метрики.
+    :return: DataFrame в порядке строк cells с площадью ячейки area_m2 и колонками additive_columns каждой метрики.
+    """
+    if metrics is None:
+        metrics = measurable_metrics
+    # Площади считаются в той же проекции с центром в городе, в которой строится сетка (см. city_grid)
+    crs = local_crs(cells.total_bounds)
+    cells_ea = reproject(cells.geometry.to_numpy(), cells.crs or 'EPSG:4326', crs)
+    result = DataFrame({'area_m2': shapely.area(cells_ea)}, index=cells.index)
+    features = features[~features.index.duplicated()]
+    geometries = reproject(features.geometry.to_numpy(), features.crs or 'EPSG:4326', crs)
+    tree = STRtree(cells_ea)
+    point_idx, point_cells = tree.query(shapely.point_on_surface(geometries), predicate='intersects')
+    # Точка на общей границе двух ячеек относится к первой из них
+    point_idx, first = np.unique(point_idx, return_index=True)
+    point_cells = point_cells[first]
+
+    for metric_name in requested_metrics(metrics):
+        spec = METRICS[metric_name]
+        in_layer = features.index.isin(MetricCollector.select_layer(features, spec.tags).index)
+        layer_points = in_layer[point_idx]
+        match spec.kind:
+            case 'count' | 'density':
+                result[f'{metric_name}_count'] = np.bincount(point_cells[layer_points], minlength=len(cells))
+            case 'area':
+                polygons = np.flatnonzero(in_layer & np.isin(shapely.get_type_id(geometries), POLYGON_TYPE_IDS))
+                feature_idx, cell_idx = tree.query(geometries[polygons], predicate='intersects')
+                result[f'{metric_name}_area_m2'] = clipped_union_areas(geometries, cells_ea, polygons[feature_idx],
+                                                                       cell_idx)
+            case 'mean':
+                values = pd.to_numeric(features[spec.attribute], errors='coerce').to_numpy() \
+                    if spec.attribute in features.columns else np.full(len(features), np.nan)
+                values = values[point_idx]
+                defined = layer_points & ~np.isnan(values)
+                result[f'{metric_name}_sum'] = np.bincount(point_cells[defined], weights=values[defined],
+                                                           minlength=len(cells))
+                result[f'{metric_name}_count'] = np.bincount(point_cells[defined], minlength=len(cells))
+    return result
+
+
+def finalize_metrics(aggregates: DataFrame) -> DataFrame:
+    """
+    Получает значения метрик из аддитивных величин grid_aggregates; строки могут быть ячейками
+    или суммами по группам ячеек (районам, городам).
+    :param aggregates: DataFrame с колонками grid_aggregates.
+    :return: DataFrame с common_area (кв. км) и колонкой на каждую метрику.
+    """
+    area = aggregates['area_m2']
+    result = DataFrame({'common_area': area / 1e6}, index=aggregates.index)
+    for metric_name, spec in METRICS.items():
+        if not set(additive_columns(metric_name)).issubset(aggregates.columns):
+            continue
+        match spec.kind:
+            case 'count':
+                result[metric_name] = aggregates[f'{metric_name}_count']
+            case 'density':
+                result[metric_name] = aggregates[f'{metric_name}_count'] / (area / 1e6)
+            case 'area':
+                result[metric_name] = aggregates[f'{metric_name}_area_m2'] / area
+            case 'mean':
+                result[metric_name] = aggregates[f'{metric_name}_sum'] / \
+                    aggregates[f'{metric_name}_count'].replace(0, np.nan)
+    return result
+
+
+def assign_districts(cells: GeoDataFrame, districts: GeoDataFrame) -> pd.Series:
+    """
+    Относит ячейки к районам по точке на поверхности ячейки; при изменении границ районов
+    достаточно пересчитать только это соответствие, а не метрики ячеек.
+    :param cells: Ячейки сетки.
+    :param districts: GeoDataFrame с колонкой district и границами районов.
+    :return: Название района для каждой ячейки; None для ячеек вне районов.
+    """
+    cell_idx, district_idx = STRtree(districts.geometry.to_numpy()).query(
+        shapely.point_on_surface(cells.geometry.to_numpy()), predicate='intersects')
+    cell_idx, first = np.unique(cell_idx, return_index=True)
+    assigned = pd.Series(None, index=cells.index, dtype=object)
+    assigned.iloc[cell_idx] = districts['district'].to_numpy()[district_idx[first]]
+    return assigned
+
+
+def rollup(grid: DataFrame, by: list[str]) -> DataFrame:
+    """
+    Сводит ячейки в районы или города: аддитивные величины суммируются, а метрики считаются заново.
+    :param grid: DataFrame с ячейками из collect_grid (колонки группировки и аддитивные величины).
+    :param by: Колонки группировки, например ['city'] или ['city', 'district'].
+    :return: DataFrame с колонками группировки, common_area и метриками.
+    """
+    additive = ['area_m2', *(column for metric_name in METRICS for column in additive_columns(metric_name)
+                             if column in grid.columns)]
+    sums = grid.dropna(subset=by).groupby(by, sort=False)[additive].sum()
+    return finalize_metrics(sums).reset_index()
+
+
+def collect_grid(city_name: str, districts: GeoDataFrame = None, source=None, cell_size: float = GRID_CELL_SIZE,
+                 grid_shape: GridShape = 'hex', metrics: dict[str, bool] = None) -> GeoDataFrame:
+    """
+    Строит сетку над городом и считает метрики ячеек по объектам, загруженным одним запросом на весь город.
+    :param city_name: Название города.
+    :param districts: GeoDataFrame с колонкой district и границами районов города для сводки по районам.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :param cell_size: Размер ячейки в метрах.
+    :param grid_shape: hex или square.
+    :param metrics: Словарь {метрика: собирать ли её}; по умолчанию все метрики.
+    :return: GeoDataFrame с колонками city, district, cell, аддитивными величинами, common_area, метриками и границами.
+    """
+    if source is None:
+        source = ox
+    if metrics is None:
+        metrics = measurable_metrics
+    city_area = source.geocode_to_gdf(city_name, which_result=1).geometry.iloc[0]
+    cells = city_grid(city_area, cell_size, grid_shape)
+    with profiler.stage('fetch_city', city=city_name) as record:
+        features = MetricCollector.fetch_features(city_area, requested_metrics(metrics), source)
+        record_features(record, features)
+    with profiler.stage('grid_metrics', city=city_name) as record:
+        aggregates = grid_aggregates(cells, features, metrics)
+        record['features'] = len(cells)
+    grid = pd.concat([aggregates, finalize_metrics(aggregates)], axis=1)
+    grid.insert(0, 'city', city_name)
+    grid.insert(1, 'district', None if districts is None else assign_districts(cells, districts))
+    grid.insert(2, 'cell', cells['cell'])
+    return GeoDataFrame(grid, geometry=cells.geometry, crs='epsg:4326')
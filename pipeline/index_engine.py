@@ -0,0 +1,217 @@
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from collect_metric import METRICS
+
+# Направление метрики в индексе: 1 - метрика входит в индекс как x, -1 - как 1 - x (см. реестр METRICS)
+METRIC_DIRECTIONS = {metric_name: spec.direction for metric_name, spec in METRICS.items()}
+KEYS = ['city', 'district']
+
+
+def _weights() -> np.ndarray:
+    return np.array(list(METRIC_DIRECTIONS.values()), dtype=float)
+
+
+def normalize_by_city(metrics: DataFrame, cities: pd.Series) -> DataFrame:
+    """
+    Нормализует метрики min-max внутри каждого города; пропуски и города с одинаковыми значениями дают NaN.
+    :param metrics: DataFrame с колонками метрик.
+    :param cities: Город каждой строки.
+    :return: DataFrame с нормализованными метриками без заполнения пропусков.
+    """
+    by_city = metrics.groupby(cities, sort=False)
+    minimum = by_city.transform('min')
+    return (metrics - minimum) / (by_city.transform('max') - minimum)
+
+
+def index_levels(normalized: DataFrame) -> np.ndarray:
+    """
+    :param normalized: DataFrame с заполненными нормализованными метриками.
+    :return: Индекс - взвешенная сумма метрик с весами +1/-1.
+    """
+    weights = _weights()
+    # 1 - x для метрик с весом -1 дает постоянное слагаемое, равное числу таких метрик
+    return normalized[list(METRIC_DIRECTIONS)].to_numpy() @ weights + np.count_nonzero(weights < 0)
+
+
+def index_districts(df: DataFrame) -> DataFrame:
+    """
+    Считает индекс благополучности районов без циклов по городам и строкам.
+    Каждая метрика нормализуется min-max внутри своего города, пропуски заполняются средним
+    нормализованным значением метрики, а индекс - взвешенная сумма метрик с весами +1/-1.
+    :param df: DataFrame с колонками city, district и колонками метрик.
+    :return: DataFrame с колонками city, district, нормализованными метриками и index_level.
+    """
+    metric_names = list(METRIC_DIRECTIONS)
+    normalized = normalize_by_city(df[metric_names].astype(float), df['city'])
+    normalized = normalized.fillna(normalized.mean())
+
+    processed_df = df[KEYS].copy()
+    processed_df[metric_names] = normalized
+    processed_df['index_level'] = index_levels(normalized)
+    return processed_df
+
+
+class IndexState:
+    """
+    Класс IndexState - сохраняемое состояние индекса для инкрементального пересчета.
+    Для каждого города хранятся min, max, сумма и число нормализованных значений каждой метрики,
+    для каждого района - сырые метрики, нормализованные метрики без заполнения пропусков, итоговые
+    нормализованные метрики и index_level. Состояние описывает последний запуск по каждому городу: у городов
+    из новых метрик удаляются районы, которых в них нет, а города, которых в новых метриках нет, остаются
+    как есть (запуск по части городов не стирает остальные). При обновлении пересчитываются только города
+    с изменившимися, новыми или удаленными районами, а в остальных городах - только районы с пропусками
+    в метриках, чье среднее (значение заполнения) изменилось. Результат совпадает с index_districts
+    по всем районам состояния.
+
+    Состояние хранится в каталоге в двух файлах parquet:
+        cities.parquet - агрегаты городов;
+        districts.parquet - районы.
+    """
+
+    def __init__(self, state_dir: str | Path = 'data/index_state'):
+        """
+        :param state_dir: Каталог состояния; если в нем уже есть состояние, оно загружается.
+        """
+        self.state_dir = Path(state_dir)
+        self.metric_names = list(METRIC_DIRECTIONS)
+        aggregates = [f'{metric_name}_{aggregate}' for metric_name in self.metric_names
+                      for aggregate in ('min', 'max', 'sum', 'count')]
+        district_columns = [*self.metric_names, *self._norm_columns, *self._final_columns, 'index_level']
+        if self.cities_path.exists() and self.districts_path.exists():
+            self.cities = pd.read_parquet(self.cities_path)
+            self.districts = pd.read_parquet(self.districts_path)
+        else:
+            self.cities = DataFrame(columns=aggregates, index=pd.Index([], name='city'), dtype=float)
+            self.districts = DataFrame(columns=district_columns, dtype=float,
+                                       index=pd.MultiIndex.from_arrays([[], []], names=KEYS))
+
+    @property
+    def cities_path(self) -> Path:
+        return self.state_dir.joinpath('cities.parquet')
+
+    @property
+    def districts_path(self) -> Path:
+        return self.state_dir.joinpath('districts.parquet')
+
+    @property
+    def _norm_columns(self) -> list[str]:
+        return [f'{metric_name}_norm' for metric_name in self.metric_names]
+
+    @property
+    def _final_columns(self) -> list[str]:
+        return [f'{metric_name}_normalized' for metric_name in self.metric_names]
+
+    def fill_values(self) -> pd.Series:
+        """
+        :return: Среднее нормализованное значение каждой метрики по всем районам всех городов.
+        """
+        sums = self.cities[[f'{metric_name}_sum' for metric_name in self.metric_names]].sum().to_numpy()
+        counts = self.cities[[f'{metric_name}_count' for metric_name in self.metric_names]].sum().to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.Series(sums / counts, index=self.metric_names)
+
+    @staticmethod
+    def _raw(df: DataFrame, metric_names: list[str]) -> DataFrame:
+        raw = df.set_index(KEYS)[metric_names].astype(float)
+        return raw[~raw.index.duplicated(keep='last')]
+
+    def changed_districts(self, df: DataFrame) -> pd.MultiIndex:
+        """
+        :param df: DataFrame с колонками city, district и колонками метрик.
+        :return: Ключи (город, район) районов df, которых нет в состоянии или у которых изменились сырые метрики.
+        """
+        raw = self._raw(df, self.metric_names)
+        known = self.districts.reindex(raw.index)[self.metric_names]
+        same = ((known == raw) | (known.isna() & raw.isna())).all(axis=1) & raw.index.isin(self.districts.index)
+        return raw.index[~same.to_numpy()]
+
+    def update(self, df: DataFrame) -> DataFrame:
+        """
+        Обновляет состояние сырыми метриками районов; районы с теми же значениями ничего не стоят.
+        :param df: DataFrame с колонками city, district и колонками метрик всех районов запуска по этим городам;
+            районы этих городов, которых в нем нет, удаляются из состояния, а остальные города не меняются.
+        :return: Районы, у которых изменились нормализованные метрики или index_level, в формате index_districts.
+        """
+        raw = self._raw(df, self.metric_names)
+        changed = raw.loc[self.changed_districts(df)]
+        in_input = self.districts.index.get_level_values('city').isin(raw.index.get_level_values('city'))
+        removed = self.districts.index[in_input].difference(raw.index)
+        if changed.empty and removed.empty:
+            return self._indexed(self.districts.iloc[0:0])
+        affected = changed.index.get_level_values('city').union(removed.get_level_values('city'))
+        old_fill = self.fill_values()
+
+        self.districts = self.districts.drop(removed)
+        new_keys = changed.index.difference(self.districts.index)
+        if len(new_keys):
+            self.districts = pd.concat([self.districts, DataFrame(index=new_keys, columns=self.districts.columns,
+                                                                  dtype=float)])
+        if not changed.empty:
+            self.districts.loc[changed.index, self.metric_names] = changed.to_numpy()
+
+        # Город пересчитывается целиком: min и max нельзя обновить при уменьшении значений без полного прохода
+        in_affected = self.districts.index.get_level_values('city').isin(affected)
+        city_raw = self.districts.loc[in_affected, self.metric_names]
+        city_names = pd.Series(city_raw.index.get_level_values('city'), index=city_raw.index)
+        normalized = normalize_by_city(city_raw, city_names)
+        self.districts.loc[in_affected, self._norm_columns] = normalized.to_numpy()
+        by_city = city_raw.groupby(level='city', sort=False)
+        by_city_normalized = normalized.groupby(level='city', sort=False)
+        aggregates = pd.concat([
+            by_city.min().add_suffix('_min'),
+            by_city.max().add_suffix('_max'),
+            by_city_normalized.sum().add_suffix('_sum'),
+            by_city_normalized.count().add_suffix('_count'),
+        ], axis=1)[self.cities.columns]
+        self.cities = pd.concat([self.cities.drop(affected, errors='ignore'), aggregates])
+
+        new_fill = self.fill_values()
+        fill_changed = [metric_name for metric_name in self.metric_names
+                        if not np.isclose(old_fill[metric_name], new_fill[metric_name], rtol=0, atol=1e-12,
+                                          equal_nan=True)]
+        candidates = in_affected
+        if fill_changed:
+            norms = self.districts[[f'{metric_name}_norm' for metric_name in fill_changed]]
+            candidates = candidates | norms.isna().any(axis=1).to_numpy()
+
+        rows = self.districts.loc[candidates]
+        final = rows[self._norm_columns].set_axis(self.metric_names, axis=1).fillna(new_fill)
+        levels = index_levels(final)
+        previous = rows[[*self._final_columns, 'index_level']].to_numpy()
+        current = np.column_stack([final.to_numpy(), levels])
+        moved = ~np.isclose(previous, current, rtol=0, atol=1e-12, equal_nan=True).all(axis=1)
+        self.districts.loc[candidates, self._final_columns] = final.to_numpy()
+        self.districts.loc[candidates, 'index_level'] = levels
+        logging.info(f'Index state: {len(changed)} districts changed and {len(removed)} removed '
+                     f'in {len(affected)} cities, '
+                     f'{int(moved.sum())} indexed districts updated')
+        return self._indexed(self.districts.loc[rows.index[moved]])
+
+    def _indexed(self, districts: DataFrame) -> DataFrame:
+        indexed = districts[[*self._final_columns, 'index_level']].rename(
+            columns=dict(zip(self._final_columns, self.metric_names)))
+        return indexed.reset_index()[[*KEYS, *self.metric_names, 'index_level']]
+
+    def indexed(self, df: DataFrame = None) -> DataFrame:
+        """
+        :param df: DataFrame с колонками city и district, задающий районы и их порядок; по умолчанию все районы.
+        :return: Проиндексированные районы в формате index_districts.
+        """
+        districts = self.districts if df is None else self.districts.loc[pd.MultiIndex.from_frame(df[KEYS])]
+        return self._indexed(districts)
+
+    def save(self) -> None:
+        """
+        Сохраняет состояние; файлы заменяются атомарно, поэтому прерванная запись не портит прежнее состояние.
+        """
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        for frame, path in ((self.cities, self.cities_path), (self.districts, self.districts_path)):
+            tmp_path = path.with_suffix('.tmp')
+            frame.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
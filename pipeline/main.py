@@ -1,59 +1,384 @@
+import asyncio
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
 import osmnx as ox
-from collect_metric import collect_metrics, measurable_metrics
+from blocks import STREET_TAGS, block_features, collect_blocks
+from boundaries import BoundaryResolver, resolve_districts_async
+from checkpoint import RunCheckpoint
+from geojson_writer import GEOJSON_FORMATS, GeoJsonFormat, open_geojson_writer
+from collect_metric import (METRICS, MetricCollector, collect_metrics, measurable_metrics, record_features,
+                            requested_metrics)
+from geopandas import GeoDataFrame
+from grid import GRID_CELL_SIZE, GRID_SHAPES, GridShape, collect_grid, rollup
+from index_engine import METRIC_DIRECTIONS, IndexState, index_districts
+from osm_cache import CACHE_MODES, AsyncOsmCache, OsmCache
+from parquet_store import (raw_metrics_to_gdf, read_metrics_frame, read_raw_metrics, write_blocks, write_grid,
+                           write_indexed_districts, write_raw_metrics)
+from overpass_client import NOMINATIM_URL, OVERPASS_URL, AsyncOverpassClient, OverpassSource
+from pbf_source import PbfFeatureSource
+from postgis_loader import LOAD_MODES, load_to_postgis
+from profiler import cprofiled, profiler
+from query_tiling import MAX_QUERY_AREA, SIMPLIFY_TOLERANCE, TiledSource, merge_cell_features, query_cells
 import traceback
+from functools import partial
 import orjson
 from collections import defaultdict
-from shapely import Polygon, MultiPolygon
+from shapely import Polygon, MultiPolygon, unary_union
+from shapely.geometry import mapping
 
 import click
 
-def fetch_raw_metrics(
-        target_cities: set[str],
-        districts_list_filepath:str=None):
-    if districts_list_filepath is None:
-        districts_list_filepath = 'data/districts.json'
-    raw_metrics = {}
-    with open('data/districts.json', 'rb') as file:
-        cities = orjson.loads(file.read())
+def _geocode_districts(city_name: str, district_list: list[str], source=None) -> dict[str, GeoDataFrame]:
+    """
+    Находит границы районов города через геокодер.
+    :param city_name: Название города.
+    :param district_list: Названия районов города.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :return: Словарь {район: GeoDataFrame с границей района}; районы, которые не удалось найти, пропускаются.
+    """
+    if source is None:
+        source = ox
+    if isinstance(source, BoundaryResolver) and len(district_list) > 1:
+        # Границы районов находятся одним запросом на город и затем отдаются геокодером из памяти; для одного
+        # района (например, у исполнителя distributed.py) запрос на весь город дороже обычного геокодирования
+        try:
+            source.resolve_districts(city_name, district_list)
+        except Exception:
+            logging.error(f'Something went wrong with resolving boundaries of {city_name}, fallback to geocoding',
+                          exc_info=True)
+    district_gdfs = {}
+    for district_name in district_list:
+        try:
+            with profiler.stage('geocode', city=city_name, district=district_name):
+                district_gdfs[district_name] = source.geocode_to_gdf(f'{city_name}, {district_name}', which_result=1)
+        except Exception:
+            logging.error(f'Something went wrong with geocoding {city_name} {district_name}', exc_info=True)
+    return district_gdfs
+
+
+def _fetch_city_features(city_name: str, district_gdfs: dict[str, GeoDataFrame],
+                         source=None) -> list[GeoDataFrame] | None:
+    """
+    Загружает объекты OSM для всех метрик одним запросом по объединению районов города
+    и распределяет их по районам.
+    :param city_name: Название города.
+    :param district_gdfs: Словарь {район: GeoDataFrame с границей района}.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :return: Список GeoDataFrame с объектами каждого района в порядке district_gdfs
+        или None, если загрузка не удалась.
+    """
+    districts = pd.concat(district_gdfs.values(), ignore_index=True)
+    try:
+        logging.info(f"Start fetching features for whole city: {city_name}")
+        with profiler.stage('fetch_city', city=city_name) as record:
+            city_features = MetricCollector.fetch_features(
+                unary_union(districts.geometry.values),
+                MetricCollector.geometry_metrics(requested_metrics(measurable_metrics), source), source)
+            record_features(record, city_features)
+    except Exception:
+        logging.error(f'Something went wrong with fetching features for {city_name}, fallback to districts',
+                      exc_info=True)
+        return None
+    return MetricCollector.partition_features(city_features, districts)
+
+
+# Источник данных OSM и бюджет памяти дочернего процесса; передаются один раз при запуске процесса,
+# а не с каждой задачей
+_worker_source = None
+_worker_memory_budget = None
+
+
+def _init_worker(source, profile: bool = False, memory_budget: float = None) -> None:
+    global _worker_source, _worker_memory_budget
+    _worker_source = source
+    _worker_memory_budget = memory_budget
+    if profile:
+        profiler.enable()
+
+
+def _collect_district(city_name: str, district_name: str, district_gdf: GeoDataFrame,
+                      features: GeoDataFrame = None, source=None, memory_budget: float = None):
+    """
+    Собирает метрики одного района; выполняется в том числе в дочерних процессах.
+    :return: FeatureCollection с метриками района.
+    """
+    if source is None:
+        source = _worker_source
+    if memory_budget is None:
+        memory_budget = _worker_memory_budget
+    logging.info(f"Start collection from district: {district_name}")
+    with profiler.context(city=city_name, district=district_name), profiler.stage('collect') as record:
+        district_metrics = collect_metrics(district_gdf, measurable_metrics, features, source, memory_budget)
+        if features is not None:
+            record['features'] = len(features)
+    return district_metrics
+
+
+def _collect_district_in_worker(*task) -> tuple:
+    """
+    Собирает метрики района в дочернем процессе.
+    :return: Метрики района и записи профилировщика процесса, которые переносятся в основной процесс.
+    """
+    return _collect_district(*task), profiler.drain()
+
+
+def _worker_result(future):
+    district_metrics, records = future.result()
+    profiler.extend(records)
+    return district_metrics
+
+
+def _run_district_tasks(tasks: list[tuple], workers: int = 1, source=None, checkpoint: RunCheckpoint = None,
+                        memory_budget: float = None) -> list:
+    """
+    Выполняет сбор метрик районов последовательно или в пуле процессов.
+    Результаты возвращаются в порядке задач; ошибка в одном районе не прерывает остальные.
+    :param tasks: Список аргументов _collect_district (город, район, граница района, объекты района).
+    :param workers: Число процессов.
+    :param source: Источник данных OSM с интерфейсом osmnx; должен сериализоваться через pickle.
+    :param checkpoint: Контрольные точки, в которые записывается каждый район сразу после сбора.
+    :param memory_budget: Бюджет памяти на объекты OSM района в мегабайтах (загрузка по чанкам).
+    :return: Список результатов _collect_district; None для районов, которые не удалось собрать.
+        Если заданы контрольные точки, метрики районов только записываются в них и в списке не хранятся
+        (все элементы - None), а читаются через RunCheckpoint.raw_metrics.
+    """
+    results = [None] * len(tasks)
+
+    def finish(position: int, collect) -> None:
+        city_name, district_name, *_ = tasks[position]
+        try:
+            district_metrics = collect()
+        except Exception as exc:
+            logging.error(f'Something went wrong with {city_name} {district_name}', exc_info=True)
+            if checkpoint is not None:
+                checkpoint.record_failure(city_name, district_name, repr(exc))
+            return
+        if checkpoint is not None:
+            checkpoint.record_success(city_name, district_name, district_metrics)
+        else:
+            results[position] = district_metrics
+
+    if workers <= 1:
+        for position, task in enumerate(tasks):
+            finish(position, lambda: _collect_district(*task, source, memory_budget))
+        return results
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(source, profiler.enabled, memory_budget)) as executor:
+        futures = {executor.submit(_collect_district_in_worker, *task): position
+                   for position, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            # Если дочерний процесс упал целиком, future.result() тоже выбросит исключение
+            finish(futures[future], partial(_worker_result, future))
+    return results
+
+
+def _prepare_district_tasks(cities: dict[str, list[str]], city_level: bool = False, source=None) -> list[tuple]:
+    """
+    Находит границы районов и, в режиме загрузки по городу, объекты OSM районов.
+    :param cities: Словарь {город: [районы]}.
+    :param city_level: Загружать объекты OSM один раз на весь город и распределять их по районам.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :return: Список аргументов _collect_district в порядке cities.
+    """
+    tasks = []
     for [city_name, district_list] in cities.items():
-        if city_name not in target_cities:
-            continue
         logging.info(f"Start collection from city: {city_name}")
-        for district_name in district_list:
-            try:
-                logging.info(f"Start collection from district: {district_name}")
-                district_gdf = ox.geocode_to_gdf(f'{city_name}, {district_name}', which_result=1)
-                district_metrics = collect_metrics(district_gdf, measurable_metrics)
-                if raw_metrics.get(city_name) is None:
-                    raw_metrics[city_name] = {
-                        'districts': {}
-                    }
-                raw_metrics[city_name]['districts'][district_name] = district_metrics
-            except Exception as exc:
-                # traceback.print_tb(exc.__traceback__)
-                logging.error(f'Something went wrong with {city_name} {district_name}')
-    return raw_metrics
+        district_gdfs = _geocode_districts(city_name, district_list, source)
+        district_features = None
+        if city_level and district_gdfs:
+            district_features = _fetch_city_features(city_name, district_gdfs, source)
+        for position, (district_name, district_gdf) in enumerate(district_gdfs.items()):
+            features = None if district_features is None else district_features[position]
+            tasks.append((city_name, district_name, district_gdf, features))
+    return tasks
 
 
-def calculate_index(raw_metrics=None):
-    if raw_metrics is None:
+async def _prefetch_city_async(client: AsyncOverpassClient, city_name: str, district_list: list[str],
+                               city_level: bool = False, max_area: float = MAX_QUERY_AREA,
+                               tolerance: float = SIMPLIFY_TOLERANCE, metrics: list[str] = None,
+                               resolver: BoundaryResolver = None) -> list[tuple]:
+    """
+    Асинхронно находит границы районов города и загружает их объекты OSM.
+    Если загрузка объектов не удалась, объекты района будут загружены при сборе метрик через обычный источник.
+    :param client: Открытый асинхронный клиент Overpass и Nominatim (или AsyncOsmCache над ним).
+    :param city_name: Название города.
+    :param district_list: Названия районов города.
+    :param city_level: Загружать объекты OSM один раз на весь город и распределять их по районам.
+    :param max_area: Предельная площадь ячейки запроса в кв. км (см. query_tiling.query_cells).
+    :param tolerance: Допуск упрощения границы запроса в метрах.
+    :param metrics: Метрики, объекты которых загружаются с геометрией; по умолчанию все метрики.
+    :param resolver: Если задан, границы районов находятся одним запросом на город (см. boundaries.py)
+        и запоминаются в нем для повторного использования.
+    :return: Список аргументов _collect_district для найденных районов в порядке district_list.
+    """
+    resolved = {}
+    if resolver is not None:
         try:
-            with open('data/metrics_outputs.json', 'r') as result_file:
-                districts_data = orjson.loads(result_file.read())
-        except FileNotFoundError as exc:
-            logging.error(f'file {"data/metrics_outputs.json"} doesn\'t exist!')
-            raise exc
+            city_gdf, resolved = await resolve_districts_async(client, city_name, district_list)
+            resolver.remember(city_name, city_gdf, resolved)
+        except Exception:
+            logging.error(f'Something went wrong with resolving boundaries of {city_name}, fallback to geocoding',
+                          exc_info=True)
+
+    async def geocode(district_name: str) -> GeoDataFrame | None:
+        if district_name in resolved:
+            return resolved[district_name]
+        try:
+            return await client.geocode_to_gdf(f'{city_name}, {district_name}', which_result=1)
+        except Exception:
+            logging.error(f'Something went wrong with geocoding {city_name} {district_name}', exc_info=True)
+            return None
+
+    async def fetch(area: Polygon | MultiPolygon, title: str) -> GeoDataFrame | None:
+        if not tags:
+            return GeoDataFrame(geometry=[], crs='epsg:4326')
+        try:
+            cell_features = await asyncio.gather(*(
+                client.features_from_polygon(cell, tags) for cell in query_cells(area, max_area, tolerance)))
+            return merge_cell_features(area, list(cell_features))
+        except Exception:
+            logging.error(f'Something went wrong with fetching features for {title}', exc_info=True)
+            return None
+
+    tags = MetricCollector.merge_tags(requested_metrics(measurable_metrics) if metrics is None else metrics)
+    district_gdfs = await asyncio.gather(*(geocode(district_name) for district_name in district_list))
+    geocoded = [(district_name, district_gdf) for district_name, district_gdf in zip(district_list, district_gdfs)
+                if district_gdf is not None]
+    if not geocoded:
+        return []
+    if city_level:
+        districts = pd.concat([district_gdf for _, district_gdf in geocoded], ignore_index=True)
+        city_features = await fetch(unary_union(districts.geometry.values), city_name)
+        district_features = [None] * len(geocoded) if city_features is None \
+            else MetricCollector.partition_features(city_features, districts)
+    else:
+        district_features = await asyncio.gather(*(
+            fetch(district_gdf.geometry.iloc[0], f'{city_name} {district_name}')
+            for district_name, district_gdf in geocoded))
+    return [(city_name, district_name, district_gdf, features)
+            for (district_name, district_gdf), features in zip(geocoded, district_features)]
+
+
+async def _prefetch_async(cities: dict[str, list[str]], city_level: bool = False, max_area: float = MAX_QUERY_AREA,
+                          tolerance: float = SIMPLIFY_TOLERANCE, metrics: list[str] = None,
+                          resolver: BoundaryResolver = None, cache: OsmCache = None,
+                          **client_options) -> list[tuple]:
+    """
+    Асинхронно готовит задачи сбора метрик для всех городов сразу.
+    :param cities: Словарь {город: [районы]}.
+    :param city_level: Загружать объекты OSM один раз на весь город и распределять их по районам.
+    :param max_area: Предельная площадь ячейки запроса в кв. км (см. query_tiling.query_cells).
+    :param tolerance: Допуск упрощения границы запроса в метрах.
+    :param metrics: Метрики, объекты которых загружаются с геометрией; по умолчанию все метрики.
+    :param resolver: Если задан, границы районов находятся одним запросом на город.
+    :param cache: Кэш ответов; если задан, асинхронные запросы идут через него (см. osm_cache.AsyncOsmCache).
+    :param client_options: Параметры AsyncOverpassClient (адреса сервисов, concurrency, частота запросов).
+    :return: Список аргументов _collect_district в порядке cities.
+    """
+    async with AsyncOverpassClient(**client_options) as client:
+        fetcher = client if cache is None else AsyncOsmCache(client, cache)
+        city_tasks = await asyncio.gather(*(
+            _prefetch_city_async(fetcher, city_name, district_list, city_level, max_area, tolerance, metrics, resolver)
+            for city_name, district_list in cities.items()))
+    logging.info(f'Overpass client stats: {client.stats.summary()}')
+    return [task for tasks in city_tasks for task in tasks]
+
+
+def read_districts_list(target_cities: set[str], districts_list_filepath: str = None) -> dict[str, list[str]]:
+    """
+    :param target_cities: Множество городов.
+    :param districts_list_filepath: Файл со списком районов городов; по умолчанию data/districts.json.
+    :return: Словарь {город: [районы]} для городов из target_cities в порядке файла.
+    """
+    if districts_list_filepath is None:
+        districts_list_filepath = 'data/districts.json'
+    with open(districts_list_filepath, 'rb') as file:
+        cities = orjson.loads(file.read())
+    return {city_name: district_list for city_name, district_list in cities.items() if city_name in target_cities}
+
+
+def fetch_raw_metrics(
+        target_cities: set[str],
+        districts_list_filepath:str=None,
+        city_level: bool = False,
+        source=None,
+        workers: int = 1,
+        async_options: dict = None,
+        checkpoint: RunCheckpoint = None,
+        memory_budget: float = None):
+    """
+    Собирает сырые метрики для районов указанных городов.
+    :param target_cities: Множество городов.
+    :param districts_list_filepath: Файл со списком районов городов.
+    :param city_level: Загружать объекты OSM один раз на весь город и распределять их по районам.
+    :param source: Источник данных OSM с интерфейсом osmnx (например, OsmCache); по умолчанию osmnx.
+    :param workers: Число процессов для параллельного сбора метрик районов.
+    :param async_options: Параметры AsyncOverpassClient; если заданы, границы и объекты районов
+        загружаются асинхронно для всех городов сразу.
+    :param checkpoint: Контрольные точки запуска; уже собранные в них районы пропускаются.
+    :param memory_budget: Бюджет памяти на объекты OSM района в мегабайтах; если задан, крупные районы
+        загружаются по чанкам (см. MetricCollector.fetch_chunked_values).
+    :return: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}; с контрольными точками -
+        CityMetrics того же вида, который читает метрики города с диска при обращении к городу.
+    """
+    raw_metrics = {}
+    cities = read_districts_list(target_cities, districts_list_filepath)
+    pending = cities
+    if checkpoint is not None:
+        pending = {
+            city_name: [district_name for district_name in district_list
+                        if not checkpoint.is_completed(city_name, district_name)]
+            for city_name, district_list in cities.items()
+        }
+        pending = {city_name: district_list for city_name, district_list in pending.items() if district_list}
+    if async_options is not None:
+        # В легком режиме метрики без геометрии считаются при сборе района, а заранее загружаются только остальные
+        metrics = MetricCollector.geometry_metrics(requested_metrics(measurable_metrics), source)
+        resolver = source if isinstance(source, BoundaryResolver) else None
+        tasks = asyncio.run(_prefetch_async(pending, city_level, metrics=metrics, resolver=resolver, **async_options))
     else:
-        districts_data = raw_metrics
+        tasks = _prepare_district_tasks(pending, city_level, source)
+    if checkpoint is not None:
+        prepared = {(city_name, district_name) for city_name, district_name, *_ in tasks}
+        for city_name, district_list in pending.items():
+            for district_name in district_list:
+                if (city_name, district_name) not in prepared:
+                    checkpoint.record_failure(city_name, district_name, 'District boundary was not resolved')
+
+    results = _run_district_tasks(tasks, workers, source, checkpoint, memory_budget)
+    if checkpoint is not None:
+        return checkpoint.raw_metrics(cities)
+    collected = {
+        (city_name, district_name): district_metrics
+        for (city_name, district_name, *_), district_metrics in zip(tasks, results)
+        if district_metrics is not None
+    }
+    for city_name, district_list in cities.items():
+        for district_name in district_list:
+            district_metrics = collected.get((city_name, district_name))
+            if district_metrics is None:
+                continue
+            if raw_metrics.get(city_name) is None:
+                raw_metrics[city_name] = {
+                    'districts': {}
+                }
+            raw_metrics[city_name]['districts'][district_name] = district_metrics
+    return raw_metrics
+
 
+def raw_metrics_frame(raw_metrics: dict) -> DataFrame:
+    """
+    Преобразует сырые метрики из fetch_raw_metrics в DataFrame: строка на район.
+    :param raw_metrics: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}.
+    :return: DataFrame с колонками city, district и свойствами района.
+    """
     data_dict = defaultdict(list)
-    for city_name, city in districts_data.items():
+    for city_name, city in raw_metrics.items():
         for district_name, district in city['districts'].items():
             data_dict['city'].append(city_name)
             data_dict['district'].append(district_name)
@@ -61,111 +386,411 @@ def calculate_index(raw_metrics=None):
                 if metric_name == 'name':
                     continue
                 data_dict[metric_name].append(metric)
-    df = pd.DataFrame(data_dict)
-    metrics_processes = {
-        'beers_per_square_km': lambda x: 1 - x,
-        'shop_numbers': lambda x: 1 - x,
-        'green_area': lambda x: x,
-        'station_numbers': lambda x: x,
-        'avg_altitude_apartments': lambda x: 1 - x,
-        'garage_area': lambda x: 1 - x,
-        'retail_area': lambda x: 1 - x
-    }
+    return pd.DataFrame(data_dict)
+
+
+def load_raw_metrics(metrics_filepath: str = 'data/metrics_outputs.json') -> dict:
+    """
+    Загружает сырые метрики, сохраненные в JSON или GeoParquet (по расширению файла).
+    :param metrics_filepath: Файл с сырыми метриками.
+    :return: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}.
+    """
+    try:
+        if metrics_filepath.endswith('.parquet'):
+            return read_raw_metrics(metrics_filepath)
+        with open(metrics_filepath, 'r') as result_file:
+            return orjson.loads(result_file.read())
+    except FileNotFoundError as exc:
+        logging.error(f'file {metrics_filepath} doesn\'t exist!')
+        raise exc
+
+
+def save_raw_metrics(raw_metrics: dict, metrics_filepath: str) -> None:
+    """
+    Сохраняет сырые метрики в JSON или GeoParquet (по расширению файла).
+    :param raw_metrics: Сырые метрики из fetch_raw_metrics.
+    :param metrics_filepath: Файл результата.
+    """
+    if metrics_filepath.endswith('.parquet'):
+        write_raw_metrics(raw_metrics, metrics_filepath)
+        return
+    # JSON пишется по одному городу, поэтому сырые метрики могут читаться с диска по городам (CityMetrics);
+    # байты результата совпадают с orjson.dumps всего словаря
+    with open(metrics_filepath, 'wb') as file:
+        file.write(b'{')
+        for position, (city_name, city) in enumerate(raw_metrics.items()):
+            file.write((b',' if position else b'') + orjson.dumps(city_name) + b':'
+                       + orjson.dumps(city, option=orjson.OPT_SERIALIZE_NUMPY))
+        file.write(b'}')
+
+
+def calculate_index(raw_metrics=None, metrics_filepath: str = 'data/metrics_outputs.json',
+                    state: IndexState = None):
+    """
+    Считает индекс благополучности районов.
+    :param raw_metrics: Сырые метрики из fetch_raw_metrics; если не заданы, читаются из metrics_filepath.
+    :param metrics_filepath: Файл с сырыми метриками в JSON или GeoParquet; из GeoParquet читаются
+        только колонки города, района и метрик.
+    :param state: Сохраняемое состояние индекса; если задано, пересчитываются только города с изменившимися
+        районами (см. IndexState), а состояние сохраняется.
+    :return: DataFrame с нормализованными метриками и index_level.
+    """
+    if raw_metrics is not None:
+        df = raw_metrics_frame(raw_metrics)
+    elif metrics_filepath.endswith('.parquet'):
+        try:
+            df = read_metrics_frame(metrics_filepath, ['city', 'district', *METRIC_DIRECTIONS])
+        except FileNotFoundError as exc:
+            logging.error(f'file {metrics_filepath} doesn\'t exist!')
+            raise exc
+    else:
+        df = raw_metrics_frame(load_raw_metrics(metrics_filepath))
+    if state is None:
+        return index_districts(df)
+    state.update(df)
+    state.save()
+    return state.indexed(df)
+
+
+def index_records(indexed_districts: DataFrame) -> dict[tuple[str, str], dict]:
+    """
+    Раскладывает результаты расчета индекса по ключу (город, район).
+    Значения один раз проходят через DataFrame.to_json, поэтому округление чисел такое же,
+    как при сериализации отдельных строк.
+    :param indexed_districts: DataFrame с результатами calculate_index.
+    :return: Словарь {(город, район): {колонка: значение}}; при повторах ключа берется первая строка.
+    """
+    records = {}
+    for record in orjson.loads(indexed_districts.to_json(orient='records')):
+        records.setdefault((record['city'], record['district']), record)
+    return records
+
 
-    normalized_df = df[['city', 'district']]
-    for metric_index, metric_name in enumerate(metrics_processes.keys()):
-        normalized_metric_value = []
-        for city_name in normalized_df['city'].unique():
-            df_by_city = df[df['city'] == city_name]
-            metric_col = df_by_city[metric_name]
-            normalized_metric_value.extend(
-                list((metric_col - metric_col.min()) / (metric_col.max() - metric_col.min())))
-        normalized_df.insert(2 + metric_index, f'{metric_name}', normalized_metric_value)
-    processed_df = df[['city', 'district']]
-    for metric_index, metric_name in enumerate(metrics_processes.keys()):
-        mean = normalized_df[metric_name].mean()
-        notnull_column = normalized_df[metric_name].replace(np.nan, mean)
-        processed_df.insert(len(processed_df.columns), metric_name, notnull_column)
-    levels = [sum(
-        metric_fun(float(row[metric_name]))
-        for metric_name, metric_fun in metrics_processes.items())
-        for row_index, row in processed_df.iterrows()
-    ]
-    processed_df.insert(len(processed_df.columns), 'index_level', levels)
-    return processed_df
+def _city_geometry(city_name: str, source) -> MultiPolygon:
+    """
+    Находит границу города через геокодер.
+    :param city_name: Название города.
+    :param source: Источник данных OSM с интерфейсом osmnx.
+    :return: Граница города в виде MultiPolygon.
+    """
+    with profiler.stage('geocode_city', city=city_name):
+        city_gdf = source.geocode_to_gdf(f'{city_name}', which_result=1)
+    city_geom, *_ = city_gdf.geometry
+    if isinstance(city_geom, Polygon):
+        city_geom = MultiPolygon([city_geom])
+    return city_geom
+
+
+def fetch_city_blocks(city_names, source=None) -> dict[str, GeoDataFrame]:
+    """
+    Строит кварталы городов и считает их метрики (см. blocks.collect_blocks).
+    :param city_names: Названия городов.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :return: Словарь {город: GeoDataFrame с кварталами}; города, для которых не удалось построить кварталы,
+        пропускаются.
+    """
+    city_blocks = {}
+    for city_name in city_names:
+        logging.info(f"Start collection of blocks for city: {city_name}")
+        try:
+            city_blocks[city_name] = collect_blocks(city_name, source)
+        except Exception:
+            logging.error(f'Something went wrong with blocks for {city_name}', exc_info=True)
+    return city_blocks
+
+
+def form_grid(metrics_outputs: dict, grid_filepath: str = 'data/city_grid.parquet', source=None,
+              cell_size: float = GRID_CELL_SIZE, grid_shape: GridShape = 'hex') -> None:
+    """
+    Считает метрики на равномерной сетке над каждым городом и сводит ячейки в районы и города.
+    Ячейки пишутся в grid_filepath, сводки - в соседний файл *_rollup.parquet (см. parquet_store.write_grid).
+    :param metrics_outputs: Сырые метрики районов из fetch_raw_metrics; их границы используются для сводки по районам.
+    :param grid_filepath: Файл GeoParquet с ячейками.
+    :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию osmnx.
+    :param cell_size: Размер ячейки в метрах.
+    :param grid_shape: hex или square.
+    """
+    city_grids = {}
+    for city_name, city in metrics_outputs.items():
+        logging.info(f"Start grid collection for city: {city_name}")
+        try:
+            city_districts = raw_metrics_to_gdf({city_name: city})
+            city_grids[city_name] = collect_grid(city_name, city_districts, source, cell_size, grid_shape)
+        except Exception:
+            logging.error(f'Something went wrong with grid for {city_name}', exc_info=True)
+    grid = pd.concat(city_grids.values(), ignore_index=True) if city_grids \
+        else pd.DataFrame(columns=['city', 'district'])
+    rollups = pd.concat([
+        rollup(grid, ['city', 'district']).assign(level='district'),
+        rollup(grid, ['city']).assign(level='city', district=None),
+    ], ignore_index=True) if city_grids else pd.DataFrame(columns=['city', 'district', 'level'])
+    write_grid(city_grids, rollups, grid_filepath)
+
+
+def form_geo_parquet(indexed_districts: DataFrame, metrics_outputs: dict,
+                     districts_geoparquet_filepath='data/districts_indexed.parquet', source=None,
+                     city_blocks: dict[str, GeoDataFrame] = None):
+    """
+    Записывает проиндексированные районы и границы городов в GeoParquet.
+    :param indexed_districts: DataFrame с результатами calculate_index.
+    :param metrics_outputs: Сырые метрики районов из fetch_raw_metrics.
+    :param districts_geoparquet_filepath: Файл с районами; границы городов пишутся в соседний файл *_cities.parquet.
+    :param source: Источник данных OSM с интерфейсом osmnx для границ городов; по умолчанию osmnx.
+    :param city_blocks: Кварталы городов из fetch_city_blocks; пишутся в соседний файл *_blocks.parquet.
+    """
+    if source is None:
+        source = ox
+    city_geometries = {city_name: _city_geometry(city_name, source) for city_name in metrics_outputs}
+    write_indexed_districts(indexed_districts, metrics_outputs, city_geometries, districts_geoparquet_filepath)
+    if city_blocks is not None:
+        write_blocks(city_blocks, districts_geoparquet_filepath)
 
 
 def form_geo_json(indexed_districts: DataFrame, metrics_outputs:dict,
-                  districts_geojson_filepath='data/districts_indexed.json'):
-    geo_json = {
-        'type': "FeatureCollection",
-        'features': []
-    }
+                  districts_geojson_filepath='data/districts_indexed.json', source=None,
+                  output_format: GeoJsonFormat = 'geojson', city_blocks: dict[str, GeoDataFrame] = None):
+    """
+    Записывает города с проиндексированными районами в GeoJSON.
+    Каждый город пишется на диск сразу после обработки, поэтому в памяти не копится вся коллекция.
+    :param indexed_districts: DataFrame с результатами calculate_index.
+    :param metrics_outputs: Сырые метрики районов из fetch_raw_metrics.
+    :param districts_geojson_filepath: Файл результата.
+    :param source: Источник данных OSM с интерфейсом osmnx для границ городов; по умолчанию osmnx.
+    :param output_format: geojson (FeatureCollection) или geojsonseq (город на строку).
+    :param city_blocks: Кварталы городов из fetch_city_blocks; если заданы, у города появляется
+        FeatureCollection blocks.
+    """
+    if source is None:
+        source = ox
 
-    metrics_processes = {
-        'beers_per_square_km',
-        'shop_numbers',
-        'green_area',
-        'station_numbers',
-        'avg_altitude_apartments',
-        'garage_area',
-        'retail_area',
-    }
-    for city_index, (city_name, city) in enumerate(metrics_outputs.items()):
-        city_gdf = ox.geocode_to_gdf(f'{city_name}', which_result=1)
-        city_geom, *_ = city_gdf.geometry
-        if isinstance(city_geom, Polygon):
-            city_geom = MultiPolygon([city_geom])
-        city_gdf.geometry[0] = city_geom
-
-        geo_json['features'].append(
-            {
+    indexed_records = index_records(indexed_districts)
+    with open_geojson_writer(districts_geojson_filepath, output_format) as writer:
+        for city_index, (city_name, city) in enumerate(metrics_outputs.items()):
+            city_geom = _city_geometry(city_name, source)
+            city_feature = {
                 "type": "Feature",
                 "properties": {
                     "title": city_name
                 },
-                "geometry": orjson.loads(city_gdf.to_json())['features'][0]['geometry'],
+                "geometry": mapping(city_geom),
                 "districts": {
                     "type": "FeatureCollection",
                     "features": []
                 },
-            },
-        )
-        for district_index, (district_name, district) in enumerate(city['districts'].items()):
-            try:
-                district_feature, *_ = district['features']
-                district_feature.pop('id')
-
-                indexed_json = orjson.loads(
-                    indexed_districts[(indexed_districts['city'] == city_name)
-                                      & (indexed_districts['district'] == district_name)].to_json())
-                processed_indexed_json = {}
-                for key, val in indexed_json.items():
-                    processed_indexed_json[key] = val[list(val.keys())[0]]
-                for prop in metrics_processes:
-                    district_feature['properties'][f'{prop}_normalized'] = processed_indexed_json[prop]
-                district_feature['properties']['index_level'] = processed_indexed_json['index_level']
-                district_feature['properties']['title'] = processed_indexed_json['district']
-                geo_json['features'][-1]['districts']['features'].append(district_feature)
-
-            except Exception as exc:
-                traceback.print_tb(exc.__traceback__)
-    with open(districts_geojson_filepath, 'wb') as file:
-        file.write(orjson.dumps(geo_json))
-
-    return geo_json
+            }
+            for district_index, (district_name, district) in enumerate(city['districts'].items()):
+                try:
+                    district_feature, *_ = district['features']
+                    district_feature.pop('id')
+
+                    processed_indexed_json = indexed_records[(city_name, district_name)]
+                    for prop in METRICS:
+                        district_feature['properties'][f'{prop}_normalized'] = processed_indexed_json[prop]
+                    district_feature['properties']['index_level'] = processed_indexed_json['index_level']
+                    district_feature['properties']['title'] = processed_indexed_json['district']
+                    city_feature['districts']['features'].append(district_feature)
+
+                except Exception as exc:
+                    traceback.print_tb(exc.__traceback__)
+            if city_blocks is not None and city_name in city_blocks:
+                city_feature['blocks'] = {
+                    'type': 'FeatureCollection',
+                    'features': block_features(city_blocks[city_name]),
+                }
+            writer.write(city_feature)
+
 
 @click.command()
 @click.option("--cities", default=['Томск', 'Новосибирск', 'Санкт-Петербург'], help="Enter list of cities between spaces")
 @click.option("--file_geojson", default='data/districts_indexed.json', help="Enter the file with results of calculated index for districts in json")
 @click.option("--file_simple_md_result", default='data/districts_indexed.md', help="Enter the file with results")
-def calc_index(cities: str,file_geojson: str, file_simple_md_result:str):
-    cities_set = set(cities.split(' '))
-    districts_raw_metrics = fetch_raw_metrics(target_cities=cities_set)
-    indexed_districts = calculate_index(districts_raw_metrics)
+@click.option("--city_level", is_flag=True, default=False,
+              help="Fetch OSM features once per city and split them between districts")
+@click.option("--cache_mode", type=click.Choice(CACHE_MODES), default='read-through',
+              help="OSM cache mode: read-through, refresh or offline")
+@click.option("--cache_dir", default='data/cache', help="Enter the directory of OSM responses cache")
+@click.option("--workers", default=1, type=click.IntRange(min=1), help="Number of processes collecting districts")
+@click.option("--async_concurrency", default=0, type=click.IntRange(min=0),
+              help="Fetch boundaries and features asynchronously with this many requests in flight (0 - disabled)")
+@click.option("--overpass_rate", default=1.0, type=float, help="Max Overpass requests per second in async mode")
+@click.option("--overpass_url", default=OVERPASS_URL, help="Overpass interpreter URL for async and light fetch modes")
+@click.option("--nominatim_url", default=NOMINATIM_URL, help="Nominatim URL for async mode")
+@click.option("--pbf", default=None, type=click.Path(exists=True, dir_okay=False),
+              help="Compute metrics offline from a local .osm.pbf/.osm extract instead of Overpass")
+@click.option("--checkpoint_dir", default='data/checkpoint', help="Enter the directory of per-district checkpoints")
+@click.option("--resume", is_flag=True, default=False,
+              help="Skip districts already collected in checkpoints and retry the failed ones")
+@click.option("--geojson_format", type=click.Choice(GEOJSON_FORMATS), default='geojson',
+              help="Write a single FeatureCollection or GeoJSONSeq with one city per line")
+@click.option("--file_raw_metrics", default=None,
+              help="Enter the file to save raw district metrics to (.json or .parquet)")
+@click.option("--file_geoparquet", default=None,
+              help="Enter the GeoParquet file for indexed districts, city boundaries go to *_cities.parquet")
+@click.option("--load_db", type=click.Choice(LOAD_MODES), default=None,
+              help="Bulk load the results into the backend PostGIS database: replace or upsert")
+@click.option("--db_dsn", default=None, help="PostgreSQL DSN, defaults to the backend DB_* environment variables")
+@click.option("--max_query_area", default=MAX_QUERY_AREA, type=click.FloatRange(min=0),
+              help="Split OSM feature queries into cells of at most this many square km (0 - disabled)")
+@click.option("--simplify_tolerance", default=SIMPLIFY_TOLERANCE, type=click.FloatRange(min=0),
+              help="Simplify query boundaries with this tolerance in meters (0 - disabled)")
+@click.option("--grid", "grid_shape", type=click.Choice(GRID_SHAPES), default=None,
+              help="Also compute metrics on a uniform hex or square grid over each city")
+@click.option("--grid_cell_size", default=GRID_CELL_SIZE, type=click.FloatRange(min=1), help="Grid cell size in meters")
+@click.option("--file_grid", default='data/city_grid.parquet',
+              help="Enter the GeoParquet file for grid cells, district and city rollups go to *_rollup.parquet")
+@click.option("--blocks", is_flag=True, default=False,
+              help="Derive city blocks from the street network and compute their metrics")
+@click.option("--index_state", default=None,
+              help="Enter the directory of the persisted index state to recompute only changed cities")
+@click.option("--light_fetch", is_flag=True, default=False,
+              help="Fetch counts and tags without geometry for metrics that need no geometry")
+@click.option("--batch_boundaries", is_flag=True, default=False,
+              help="Resolve the city and all its district boundaries with one query per city")
+@click.option("--memory_budget", default=None, type=click.FloatRange(min=1),
+              help="Memory budget in MB for OSM features of one chunk; large districts are collected in chunks")
+@click.option("--profile", is_flag=True, default=False,
+              help="Record wall time, features and bytes per stage, metric and district")
+@click.option("--profile_trace", default='data/profile_trace.json',
+              help="Enter the file for the profile trace (.json or .csv)")
+@click.option("--profile_cprofile", default=None, help="Enter the file to dump cProfile stats to")
+def calc_index(cities: str,file_geojson: str, file_simple_md_result:str, city_level: bool,
+               cache_mode: str, cache_dir: str, workers: int, async_concurrency: int, overpass_rate: float,
+               overpass_url: str, nominatim_url: str, pbf: str, checkpoint_dir: str, resume: bool,
+               geojson_format: str, file_raw_metrics: str, file_geoparquet: str, load_db: str, db_dsn: str,
+               max_query_area: float, simplify_tolerance: float, grid_shape: str, grid_cell_size: float,
+               file_grid: str, blocks: bool, index_state: str, light_fetch: bool, batch_boundaries: bool,
+               memory_budget: float, profile: bool, profile_trace: str, profile_cprofile: str):
+    if profile:
+        profiler.enable()
+    with cprofiled(profile_cprofile):
+        _calc_index(cities, file_geojson, file_simple_md_result, city_level, cache_mode, cache_dir, workers,
+                    async_concurrency, overpass_rate, overpass_url, nominatim_url, pbf, checkpoint_dir, resume,
+                    geojson_format, file_raw_metrics, file_geoparquet, load_db, db_dsn, max_query_area,
+                    simplify_tolerance, grid_shape, grid_cell_size, file_grid, blocks, index_state,
+                    light_fetch, batch_boundaries, memory_budget)
+    if profile:
+        profiler.report(profile_trace)
+
+
+def make_source(pbf: str = None, cache_dir: str = 'data/cache', cache_mode: str = 'read-through',
+                max_query_area: float = MAX_QUERY_AREA, simplify_tolerance: float = SIMPLIFY_TOLERANCE,
+                light_fetch: bool = False, overpass_url: str = OVERPASS_URL, batch_boundaries: bool = False,
+                blocks: bool = False):
+    """
+    Собирает источник данных OSM из параметров запуска.
+    :param pbf: Локальная выгрузка OSM; если задана, сеть не используется.
+    :param cache_dir: Каталог кэша ответов.
+    :param cache_mode: Режим кэша.
+    :param max_query_area: Предельная площадь ячейки запроса в кв. км.
+    :param simplify_tolerance: Допуск упрощения границы запроса в метрах.
+    :param light_fetch: Легкий режим загрузки для метрик без геометрии.
+    :param overpass_url: Адрес интерпретатора Overpass для легкого режима.
+    :param batch_boundaries: Находить границы районов одним запросом на город.
+    :param blocks: Нужны ли улицы для кварталов (только для выгрузки).
+    :return: Источник данных OSM с интерфейсом osmnx.
+    """
+    if pbf is not None and light_fetch:
+        raise click.UsageError('--light_fetch needs Overpass and cannot be used with --pbf')
+    if pbf is not None:
+        tags = MetricCollector.merge_tags(requested_metrics(measurable_metrics))
+        if blocks:
+            tags = {**tags, 'highway': sorted({*tags.get('highway', []), *STREET_TAGS['highway']})}
+        source = PbfFeatureSource(pbf, tags=tags)
+    else:
+        overpass_source = OverpassSource(overpass_url) if light_fetch else None
+        source = TiledSource(OsmCache(cache_dir, mode=cache_mode, source=overpass_source), max_area=max_query_area,
+                             tolerance=simplify_tolerance)
+    if batch_boundaries:
+        source = BoundaryResolver(source)
+    return source
+
+
+def publish_index(districts_raw_metrics: dict, source, file_geojson: str, file_simple_md_result: str,
+                  geojson_format: str = 'geojson', file_raw_metrics: str = None, file_geoparquet: str = None,
+                  load_db: str = None, db_dsn: str = None, grid_shape: str = None,
+                  grid_cell_size: float = GRID_CELL_SIZE, file_grid: str = 'data/city_grid.parquet',
+                  blocks: bool = False, index_state: str = None) -> DataFrame:
+    """
+    Считает индекс по собранным сырым метрикам и записывает все результаты запуска.
+    С состоянием индекса (index_state) в базу в режиме upsert загружаются только районы, сырые метрики
+    которых изменились с прошлого запуска: в базе хранятся сырые метрики и границы, а у остальных районов
+    они уже актуальны. Состояние сохраняется после загрузки, поэтому районы, которые не удалось загрузить,
+    загружаются при следующем запуске. Файлы результатов описывают все районы запуска.
+    :param districts_raw_metrics: Сырые метрики из fetch_raw_metrics.
+    :param source: Источник данных OSM с интерфейсом osmnx.
+    :return: DataFrame с результатами calculate_index.
+    """
+    if file_raw_metrics is not None:
+        save_raw_metrics(districts_raw_metrics, file_raw_metrics)
+    with profiler.stage('normalize') as record:
+        df = raw_metrics_frame(districts_raw_metrics)
+        state, changed = None, None
+        if index_state is None:
+            indexed_districts = index_districts(df)
+        else:
+            state = IndexState(index_state)
+            changed = state.changed_districts(df)
+            state.update(df)
+            indexed_districts = state.indexed(df)
+        record['features'] = len(indexed_districts)
     with open(file_simple_md_result,'w') as file:
         file.write(indexed_districts.to_markdown())
-    form_geo_json(indexed_districts,districts_raw_metrics,file_geojson)
+    city_blocks = fetch_city_blocks(districts_raw_metrics, source) if blocks else None
+    if grid_shape is not None:
+        with profiler.stage('grid'):
+            form_grid(districts_raw_metrics, file_grid, source, grid_cell_size, grid_shape)
+    if file_geoparquet is not None:
+        with profiler.stage('write_geoparquet'):
+            form_geo_parquet(indexed_districts, districts_raw_metrics, file_geoparquet, source=source,
+                             city_blocks=city_blocks)
+    with profiler.stage('write_geojson') as record:
+        form_geo_json(indexed_districts,districts_raw_metrics,file_geojson, source=source, output_format=geojson_format,
+                      city_blocks=city_blocks)
+        record['bytes'] = os.path.getsize(file_geojson)
+    districts_filter = set(changed) if changed is not None and load_db == 'upsert' else None
+    if load_db is not None and districts_filter is not None and not districts_filter and not blocks:
+        logging.info('No districts changed since the last run, the database is up to date')
+    elif load_db is not None:
+        with profiler.stage('load_db') as record:
+            asyncio.run(load_to_postgis(file_geoparquet or file_geojson, dsn=db_dsn, mode=load_db,
+                                        districts_filter=districts_filter))
+            record['features'] = len(districts_filter) if districts_filter is not None else len(indexed_districts)
+    if state is not None:
+        state.save()
+    return indexed_districts
+
+
+def _calc_index(cities: str, file_geojson: str, file_simple_md_result: str, city_level: bool,
+                cache_mode: str, cache_dir: str, workers: int, async_concurrency: int, overpass_rate: float,
+                overpass_url: str, nominatim_url: str, pbf: str, checkpoint_dir: str, resume: bool,
+                geojson_format: str, file_raw_metrics: str, file_geoparquet: str, load_db: str, db_dsn: str,
+                max_query_area: float, simplify_tolerance: float, grid_shape: str, grid_cell_size: float,
+                file_grid: str, blocks: bool, index_state: str, light_fetch: bool, batch_boundaries: bool,
+                memory_budget: float):
+    if memory_budget is not None and (city_level or async_concurrency):
+        raise click.UsageError('--memory_budget fetches each district in chunks and cannot be used with '
+                               '--city_level or --async_concurrency, which load all features up front')
+    if pbf is not None and async_concurrency:
+        raise click.UsageError('--async_concurrency prefetches districts from Overpass and Nominatim '
+                               'and cannot be used with --pbf')
+    cities_set = set(cities.split(' '))
+    source = make_source(pbf, cache_dir, cache_mode, max_query_area, simplify_tolerance, light_fetch, overpass_url,
+                         batch_boundaries, blocks)
+    async_options = None
+    if async_concurrency:
+        async_options = dict(concurrency=async_concurrency, overpass_rate=overpass_rate,
+                             overpass_url=overpass_url, nominatim_url=nominatim_url,
+                             max_area=max_query_area, tolerance=simplify_tolerance,
+                             cache=OsmCache(cache_dir, mode=cache_mode))
+    checkpoint = RunCheckpoint(checkpoint_dir, resume=resume)
+    districts_raw_metrics = fetch_raw_metrics(target_cities=cities_set, city_level=city_level, source=source,
+                                              workers=workers, async_options=async_options, checkpoint=checkpoint,
+                                              memory_budget=memory_budget)
+    if failures := checkpoint.failures():
+        logging.warning(f'{len(failures)} districts failed, see {checkpoint.failures_path}; rerun with --resume')
+    publish_index(districts_raw_metrics, source, file_geojson, file_simple_md_result, geojson_format,
+                  file_raw_metrics, file_geoparquet, load_db, db_dsn, grid_shape, grid_cell_size, file_grid, blocks,
+                  index_state)
 
 
 # Press the green button in the gutter to run the script.
@@ -0,0 +1,333 @@
+import asyncio
+import hashlib
+import math
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Literal
+
+import geopandas as gpd
+import orjson
+import osmnx as ox
+import pandas as pd
+from osmnx._errors import EmptyOverpassResponse
+import shapely
+from geopandas import GeoDataFrame
+from shapely import Polygon, MultiPolygon
+
+CacheMode = Literal['read-through', 'refresh', 'offline']
+CACHE_MODES: tuple[CacheMode, ...] = ('read-through', 'refresh', 'offline')
+
+# Индекс, который osmnx строит для объектов из features_from_polygon
+FEATURES_INDEX = ['element_type', 'osmid']
+# Доля предельного размера кэша, которую можно записать между проверками размера (см. OsmCache.evict)
+EVICT_FRACTION = 0.05
+
+
+def _tag_to_str(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return str(value)
+
+
+class CacheMissError(LookupError):
+    """
+    Запрошенного ответа нет в кэше, а режим offline запрещает обращаться к сети.
+    """
+
+
+class OsmCache:
+    """
+    Класс OsmCache - дисковый кэш ответов геокодера и Overpass с адресацией по содержимому запроса.
+    Повторяет интерфейс osmnx (geocode_to_gdf, features_from_polygon), поэтому может использоваться везде,
+    где ожидается источник данных OSM. Ответы хранятся в GeoParquet (геометрия в WKB).
+
+    Режимы работы:
+    - read-through: отдавать ответ из кэша, а при промахе или устаревании - запросить источник и сохранить;
+    - refresh: всегда запрашивать источник и перезаписывать кэш;
+    - offline: работать только с кэшем (в том числе с устаревшими записями), при промахе - CacheMissError.
+    """
+
+    def __init__(self, cache_dir: str | Path = 'data/cache', mode: CacheMode = 'read-through',
+                 max_size_mb: float = 2048, max_age_days: float = 30, source=None):
+        """
+        :param cache_dir: Каталог, в котором хранится кэш.
+        :param mode: Режим работы кэша.
+        :param max_size_mb: Предельный размер кэша; при превышении удаляются давно не читавшиеся записи.
+        :param max_age_days: Срок жизни записи.
+        :param source: Источник данных OSM с интерфейсом osmnx; по умолчанию сам osmnx.
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f'Unknown cache mode: {mode}')
+        self.cache_dir = Path(cache_dir)
+        self.mode = mode
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.source = source
+        # Объем записей с последнего вытеснения; None - вытеснения в этом процессе еще не было
+        self._written = None
+
+    def __getstate__(self):
+        # Модуль osmnx нельзя сериализовать, поэтому источник по умолчанию не передается в дочерние процессы
+        state = self.__dict__.copy()
+        if state['source'] is ox:
+            state['source'] = None
+        return state
+
+    @property
+    def _source(self):
+        return ox if self.source is None else self.source
+
+    @staticmethod
+    def _key(kind: str, *parts: bytes) -> str:
+        digest = hashlib.sha256(kind.encode())
+        for part in parts:
+            digest.update(b'\0')
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key[:2], f'{key}.parquet')
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        # Процессы с общим каталогом кэша могут записывать одну запись одновременно, поэтому у каждой записи
+        # свой временный файл; os.replace атомарно оставляет последнюю
+        return path.with_name(f'{path.stem}.{os.getpid()}.{uuid.uuid4().hex}.tmp')
+
+    def _is_fresh(self, path: Path) -> bool:
+        # Срок жизни считается от записи (mtime); чтение меняет только atime (см. _touch)
+        try:
+            return time.time() - path.stat().st_mtime <= self.max_age
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _touch(path: Path) -> None:
+        # Отметка о недавнем использовании для вытеснения; mtime (время записи) не меняется
+        try:
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except FileNotFoundError:
+            # Запись уже удалена другим процессом; прочитанный ответ остается верным
+            pass
+
+    @staticmethod
+    def _to_storable(gdf: GeoDataFrame) -> GeoDataFrame:
+        """
+        Приводит ответ к виду, который можно записать в parquet: индекс становится колонками,
+        списки узлов и членов отношений отбрасываются, а значения тегов приводятся к строкам.
+        """
+        gdf = gdf.reset_index() if gdf.index.names != [None] else gdf.reset_index(drop=True)
+        gdf = gdf.drop(columns=[column for column in ('nodes', 'ways') if column in gdf.columns])
+        for column in gdf.columns:
+            if column != gdf.geometry.name and gdf[column].dtype == object:
+                gdf[column] = gdf[column].map(_tag_to_str)
+        return gdf
+
+    def _read(self, path: Path) -> GeoDataFrame:
+        gdf = gpd.read_parquet(path)
+        self._touch(path)
+        if all(column in gdf.columns for column in FEATURES_INDEX):
+            gdf = gdf.set_index(FEATURES_INDEX)
+        return gdf
+
+    def _write(self, path: Path, gdf: GeoDataFrame) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._tmp_path(path)
+        self._to_storable(gdf).to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        self._after_write(path)
+
+    def _read_frame(self, path: Path) -> pd.DataFrame:
+        frame = pd.read_parquet(path)
+        self._touch(path)
+        if all(column in frame.columns for column in FEATURES_INDEX):
+            frame = frame.set_index(FEATURES_INDEX)
+        return frame
+
+    def _write_frame(self, path: Path, frame: pd.DataFrame) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._tmp_path(path)
+        frame = frame.reset_index() if frame.index.names != [None] else frame.reset_index(drop=True)
+        frame.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        self._after_write(path)
+
+    def _after_write(self, path: Path) -> None:
+        """
+        Вытесняет записи после первой записи в процессе и затем каждый раз, когда с прошлого вытеснения
+        записано больше EVICT_FRACTION предельного размера, а не после каждой записи: evict обходит весь кэш.
+        """
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            size = 0
+        if self._written is not None and self._written + size <= self.max_size * EVICT_FRACTION:
+            self._written += size
+            return
+        self._written = 0
+        self.evict()
+
+    def _lookup(self, key: str, frame: bool = False) -> GeoDataFrame | pd.DataFrame | None:
+        """
+        :param key: Ключ записи.
+        :param frame: Ответ - DataFrame без геометрии (легкий режим), а не GeoDataFrame.
+        :return: Ответ из кэша или None, если его нужно запросить у источника.
+        """
+        read = self._read_frame if frame else self._read
+        path = self._path(key)
+        if self.mode == 'offline':
+            if not path.exists():
+                raise CacheMissError(key)
+            return read(path)
+        if self.mode == 'read-through' and self._is_fresh(path):
+            return read(path)
+        return None
+
+    def _store(self, key: str, value: GeoDataFrame | pd.DataFrame, frame: bool = False) -> None:
+        (self._write_frame if frame else self._write)(self._path(key), value)
+
+    def _cached(self, key: str, fetch, frame: bool = False) -> GeoDataFrame | pd.DataFrame:
+        """
+        :param key: Ключ записи.
+        :param fetch: Функция запроса источника при промахе.
+        :param frame: Ответ - DataFrame без геометрии (легкий режим), а не GeoDataFrame.
+        """
+        cached = self._lookup(key, frame)
+        if cached is not None:
+            return cached
+        value = fetch()
+        self._store(key, value, frame)
+        return value
+
+    def evict(self) -> None:
+        """
+        Удаляет устаревшие записи (по времени записи), а затем давно не читавшиеся (по времени чтения),
+        пока кэш не уложится в предельный размер.
+        """
+        entries = []
+        now = time.time()
+        for path in self.cache_dir.glob('*/*.parquet'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Запись удалена другим процессом, который работает с тем же каталогом кэша
+                continue
+            if now - stat.st_mtime > self.max_age and self.mode != 'offline':
+                path.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+    def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        """
+        Геокодирует строку запроса с кэшированием.
+        :param query: Строка запроса к геокодеру, например "Томск, Кировский район".
+        :param which_result: Номер результата геокодера.
+        :return: GeoDataFrame с границей найденного объекта.
+        """
+        return self._cached(self._geocode_key(query, which_result),
+                            lambda: self._source.geocode_to_gdf(query, which_result=which_result))
+
+    def _geocode_key(self, query: str, which_result: int = None) -> str:
+        return self._key('geocode', query.encode(), str(which_result).encode())
+
+    def _features_key(self, polygon: Polygon | MultiPolygon, tags: dict) -> str:
+        return self._key('features', shapely.to_wkb(shapely.normalize(polygon)), self._tags_key(tags))
+
+    @property
+    def light_fetch(self) -> bool:
+        return getattr(self._source, 'light_fetch', False)
+
+    @staticmethod
+    def _tags_key(tags: dict) -> bytes:
+        normalized_tags = {key: sorted(values) if isinstance(values, list) else values for key, values in tags.items()}
+        return orjson.dumps(normalized_tags, option=orjson.OPT_SORT_KEYS)
+
+    def count_from_polygon(self, polygon: Polygon | MultiPolygon, tag_sets: list[dict]) -> list[int]:
+        """
+        Считает объекты внутри полигона с кэшированием (легкий режим, см. OverpassSource).
+        :param polygon: Полигон запроса.
+        :param tag_sets: Список словарей тегов.
+        :return: Число объектов для каждого набора тегов.
+        """
+        key = self._key('count', shapely.to_wkb(shapely.normalize(polygon)),
+                        *(self._tags_key(tags) for tags in tag_sets))
+        counts = self._cached(key, lambda: pd.DataFrame(
+            {'count': self._source.count_from_polygon(polygon, tag_sets)}), frame=True)
+        return counts['count'].tolist()
+
+    def tags_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict, required_key: str = None) -> pd.DataFrame:
+        """
+        Загружает теги объектов внутри полигона без геометрии с кэшированием (легкий режим, см. OverpassSource).
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов запроса.
+        :param required_key: Ключ, который обязательно должен быть у объекта.
+        :return: DataFrame с тегами объектов.
+        """
+        key = self._key('tags', shapely.to_wkb(shapely.normalize(polygon)), self._tags_key(tags),
+                        str(required_key).encode())
+        return self._cached(key, lambda: self._source.tags_from_polygon(polygon, tags, required_key), frame=True)
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        """
+        Загружает объекты OSM внутри полигона с кэшированием.
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов запроса.
+        :return: GeoDataFrame с найденными объектами.
+        """
+        key = self._features_key(polygon, tags)
+
+        def fetch() -> GeoDataFrame:
+            try:
+                return self._source.features_from_polygon(polygon, tags=tags)
+            except EmptyOverpassResponse:
+                # Пустой ответ тоже кэшируется, чтобы не повторять запрос
+                return GeoDataFrame(geometry=[], crs='epsg:4326')
+
+        features = self._cached(key, fetch)
+        if features.empty:
+            raise EmptyOverpassResponse('No matching features in cached response')
+        return features
+
+
+class AsyncOsmCache:
+    """
+    Класс AsyncOsmCache - асинхронная обертка над AsyncOverpassClient с дисковым кэшем OsmCache.
+    Ключи записей и режимы те же, что у OsmCache, поэтому асинхронная загрузка и обычный сбор метрик
+    используют одни и те же записи кэша (в том числе ячейки запросов TiledSource). Чтение и запись файлов кэша
+    выполняются в потоках (asyncio.to_thread), чтобы не останавливать цикл событий с другими запросами.
+    """
+
+    def __init__(self, client, cache: OsmCache):
+        """
+        :param client: Открытый AsyncOverpassClient.
+        :param cache: Кэш ответов; его режим (read-through, refresh, offline) действует и на асинхронные запросы.
+        """
+        self.client = client
+        self.cache = cache
+
+    async def _cached(self, key: str, fetch) -> GeoDataFrame:
+        cached = await asyncio.to_thread(self.cache._lookup, key)
+        if cached is not None:
+            return cached
+        value = await fetch()
+        await asyncio.to_thread(self.cache._store, key, value)
+        return value
+
+    async def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        return await self._cached(self.cache._geocode_key(query, which_result),
+                                  lambda: self.client.geocode_to_gdf(query, which_result=which_result))
+
+    async def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        # В отличие от OsmCache.features_from_polygon, пустой ответ возвращается, как у AsyncOverpassClient
+        return await self._cached(self.cache._features_key(polygon, tags),
+                                  lambda: self.client.features_from_polygon(polygon, tags))
@@ -0,0 +1,319 @@
+import gzip
+import logging
+import xml.etree.ElementTree as ElementTree
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import click
+import httpx
+import numpy as np
+import orjson
+import shapely
+from geopandas import GeoDataFrame
+from shapely import STRtree
+from shapely.geometry import shape
+
+from collect_metric import MetricCollector, measurable_metrics, requested_metrics
+from distributed import memory_budget_option, source_options
+from geojson_writer import GEOJSON_FORMATS
+from main import _run_district_tasks, load_raw_metrics, make_source, publish_index, save_raw_metrics
+from overpass_client import OverpassSource
+from parquet_store import raw_metrics_to_gdf
+
+CHANGE_SUFFIXES = ('.osc', '.osc.gz')
+
+
+def change_files(path: str | Path, after: str = None) -> list[Path]:
+    """
+    Находит файлы изменений OSM (.osc, .osc.gz). Каталог может быть устроен как каталог репликации
+    (000/001/234.osc.gz) или содержать файлы с возрастающими именами: файлы упорядочиваются по относительному пути.
+    :param path: Файл или каталог с файлами изменений.
+    :param after: Относительный путь последнего обработанного файла; обрабатываются только файлы после него.
+    :return: Файлы изменений по порядку.
+    """
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    files = sorted((file for file in path.rglob('*') if file.name.endswith(CHANGE_SUFFIXES)),
+                   key=lambda file: file.relative_to(path).as_posix())
+    if after is not None:
+        files = [file for file in files if file.relative_to(path).as_posix() > after]
+    return files
+
+
+def read_osc(path: Path) -> list[dict]:
+    """
+    Читает файл изменений OSM (osmChange XML).
+    :param path: Файл .osc или .osc.gz.
+    :return: Список элементов {element_type, osmid, action, timestamp, tags, lon, lat, refs, ways} в порядке файла;
+        refs - точки линии или отношения, ways - линии отношения.
+    """
+    opener = gzip.open if path.name.endswith('.gz') else open
+    elements = []
+    action = None
+    with opener(path, 'rb') as file:
+        for event, node in ElementTree.iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                if node.tag in ('create', 'modify', 'delete'):
+                    action = node.tag
+                continue
+            if node.tag not in ('node', 'way', 'relation'):
+                continue
+            members = [(child.get('type'), int(child.get('ref'))) for child in node if child.tag == 'member']
+            elements.append({
+                'element_type': node.tag,
+                'osmid': int(node.get('id')),
+                'action': action,
+                'timestamp': node.get('timestamp'),
+                'tags': {child.get('k'): child.get('v') for child in node if child.tag == 'tag'},
+                'lon': float(node.get('lon')) if node.get('lon') is not None else None,
+                'lat': float(node.get('lat')) if node.get('lat') is not None else None,
+                'refs': [int(child.get('ref')) for child in node if child.tag == 'nd']
+                + [ref for member_type, ref in members if member_type == 'node'],
+                'ways': [ref for member_type, ref in members if member_type == 'way'],
+            })
+            node.clear()
+    return elements
+
+
+def _matches(tags: dict, query_tags: dict) -> bool:
+    for key, values in query_tags.items():
+        value = tags.get(key)
+        if value is not None and (values is True or value in values):
+            return True
+    return False
+
+
+def _is_relevant(element: dict, query_tags: dict) -> bool:
+    if _matches(element['tags'], query_tags):
+        return True
+    if element['action'] == 'create':
+        return False
+    if element['element_type'] != 'node':
+        # В файле изменений нет прежних тегов: изменение могло снять теги метрик или поменять геометрию
+        return True
+    # Измененная точка с тегами могла потерять теги метрик; удаленные точки без тегов - вершины линий,
+    # удаление которых приходит в файле изменений как изменение самой линии
+    return element['action'] == 'modify' and bool(element['tags'])
+
+
+def changed_features(elements: list[dict], tags: dict = None) -> GeoDataFrame:
+    """
+    Отбирает изменения, которые могут повлиять на метрики, и определяет их расположение.
+    В файле изменений есть только новые теги объекта, поэтому учитываются: объекты, чьи теги подходят
+    под теги метрик; все изменения и удаления линий и отношений (они могли потерять теги метрик или геометрию);
+    изменения точек с любыми тегами (точка могла потерять теги метрик, сохранив остальные). Удаленные точки
+    без тегов - вершины линий - сами не учитываются и служат только для расположения линий.
+    Точка располагается по своим координатам, линия и отношение - по охватывающему прямоугольнику своих точек
+    из тех же файлов изменений. Смещение точек без тегов, принадлежащих не изменившейся линии, по файлу
+    изменений не связать с линией, поэтому такие изменения не учитываются.
+    Линия или отношение без точек в файлах изменений (например, изменены только теги) возвращается с пустой
+    геометрией: ее расположение находит locate_changes.
+    :param elements: Элементы из read_osc.
+    :param tags: Теги объектов метрик; по умолчанию теги всех метрик.
+    :return: GeoDataFrame с element_type, osmid, action, timestamp и геометрией изменения.
+    """
+    if tags is None:
+        tags = MetricCollector.merge_tags(requested_metrics(measurable_metrics))
+    query_tags = {key: True if values is True else set(values) for key, values in tags.items()}
+    locations = {element['osmid']: (element['lon'], element['lat']) for element in elements
+                 if element['element_type'] == 'node' and element['lon'] is not None}
+    way_nodes = {element['osmid']: element['refs'] for element in elements if element['element_type'] == 'way'}
+    records = []
+    for element in elements:
+        if not _is_relevant(element, query_tags):
+            continue
+        if element['element_type'] == 'node':
+            points = [(element['lon'], element['lat'])] if element['lon'] is not None else []
+        else:
+            refs = element['refs'] + [ref for way in element['ways'] for ref in way_nodes.get(way, [])]
+            points = [locations[ref] for ref in refs if ref in locations]
+        geometry = None
+        if points:
+            coords = np.array(points)
+            geometry = shapely.box(*coords.min(axis=0), *coords.max(axis=0)) if len(coords) > 1 \
+                else shapely.points(coords[0])
+        records.append({
+            'element_type': element['element_type'],
+            'osmid': element['osmid'],
+            'action': element['action'],
+            'timestamp': element.get('timestamp'),
+            'geometry': geometry,
+        })
+    if not records:
+        return GeoDataFrame({'element_type': [], 'osmid': [], 'action': [], 'timestamp': []}, geometry=[],
+                            crs='epsg:4326')
+    return GeoDataFrame(records, geometry='geometry', crs='epsg:4326')
+
+
+def _before(timestamp: str) -> str:
+    moment = datetime.fromisoformat(timestamp.replace('Z', '+00:00')) - timedelta(seconds=1)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def locate_changes(changes: GeoDataFrame, source: OverpassSource) -> GeoDataFrame:
+    """
+    Находит расположение изменений с пустой геометрией по охватывающим прямоугольникам объектов в Overpass.
+    Созданные и измененные объекты запрашиваются в текущих данных, удаленные - на секунду раньше удаления
+    (в текущих данных их уже нет); удаленные объекты группируются по времени удаления, на каждое время
+    нужен отдельный запрос. Изменения, которые не нашлись или запрос которых не удался, остаются с пустой геометрией.
+    :param changes: Изменения из changed_features.
+    :param source: Источник Overpass.
+    :return: Изменения с найденными расположениями.
+    """
+    unlocated = changes.geometry.isna()
+    if not unlocated.any():
+        return changes
+    queries, keys = defaultdict(lambda: defaultdict(list)), []
+    rows = changes.loc[unlocated, ['element_type', 'osmid', 'action', 'timestamp']].itertuples(index=False)
+    for element_type, osmid, action, timestamp in rows:
+        date = _before(timestamp) if action == 'delete' and timestamp else None
+        queries[date][element_type].append(int(osmid))
+        keys.append((element_type, int(osmid)))
+    bounds = {}
+    for date, ids in queries.items():
+        try:
+            bounds |= source.bounds_from_ids(ids, date=date)
+        except httpx.HTTPError:
+            logging.warning(f'Failed to locate changed features at {date or "now"}', exc_info=True)
+    changes = changes.copy()
+    changes.loc[unlocated, 'geometry'] = [bounds.get(key) for key in keys]
+    return changes
+
+
+def affected_districts(changes: GeoDataFrame, districts: GeoDataFrame) -> list[tuple[str, str]]:
+    """
+    Находит районы, в которых есть изменения: кандидаты выбираются по STRtree прямоугольников районов,
+    а затем проверяются по точной границе района.
+    :param changes: Изменения из changed_features.
+    :param districts: GeoDataFrame с колонками city, district и границами районов.
+    :return: Список (город, район) в порядке districts.
+    """
+    changes = changes[changes.geometry.notna()]
+    if changes.empty or districts.empty:
+        return []
+    geometries = districts.geometry.to_numpy()
+    tree = STRtree(shapely.envelope(geometries))
+    change_idx, district_idx = tree.query(changes.geometry.to_numpy(), predicate='intersects')
+    exact = shapely.intersects(geometries[district_idx], changes.geometry.to_numpy()[change_idx])
+    positions = np.unique(district_idx[exact])
+    return list(zip(districts['city'].to_numpy()[positions], districts['district'].to_numpy()[positions]))
+
+
+def _has_metrics(district_metrics: dict) -> bool:
+    return any(feature['properties'].get(metric_name) is not None for feature in district_metrics['features']
+               for metric_name in requested_metrics(measurable_metrics))
+
+
+def refresh_raw_metrics(raw_metrics: dict, affected: list[tuple[str, str]], source, workers: int = 1,
+                        memory_budget: float = None) -> int:
+    """
+    Заново собирает метрики районов по их сохраненным границам, без геокодирования.
+    Районы, которые не удалось собрать или у которых не собралась ни одна метрика, считаются несобранными:
+    их прежние метрики не заменяются.
+    :param raw_metrics: Сырые метрики из fetch_raw_metrics; обновляются на месте.
+    :param affected: Районы (город, район) для пересбора.
+    :param source: Источник данных OSM; кэш не должен отдавать устаревшие ответы (режим refresh).
+    :param workers: Число процессов.
+    :param memory_budget: Бюджет памяти на объекты OSM района в мегабайтах (загрузка по чанкам).
+    :return: Число обновленных районов.
+    """
+    tasks = []
+    for city_name, district_name in affected:
+        feature, *_ = raw_metrics[city_name]['districts'][district_name]['features']
+        district_gdf = GeoDataFrame({'display_name': [feature['properties'].get('title', district_name)]},
+                                    geometry=[shape(feature['geometry'])], crs='epsg:4326')
+        tasks.append((city_name, district_name, district_gdf, None))
+    refreshed = 0
+    for (city_name, district_name, *_), district_metrics in zip(
+            tasks, _run_district_tasks(tasks, workers, source, memory_budget=memory_budget)):
+        if district_metrics is None:
+            continue
+        if not _has_metrics(district_metrics):
+            logging.warning(f'No metrics were collected for {city_name} {district_name}, keeping the previous ones')
+            continue
+        raw_metrics[city_name]['districts'][district_name] = district_metrics
+        refreshed += 1
+    return refreshed
+
+
+def _read_state(path: Path) -> str | None:
+    if not path.exists():
+        return None
+    with open(path, 'rb') as file:
+        return orjson.loads(file.read()).get('last_file')
+
+
+def _write_state(path: Path, last_file: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(orjson.dumps({'last_file': last_file}))
+
+
+@click.command()
+@click.option("--changes", default='data/osm_changes', type=click.Path(exists=True),
+              help="Enter the change file or the directory with change files (.osc, .osc.gz, replication layout)")
+@click.option("--state", "state_path", default='data/osm_changes_state.json',
+              help="Enter the file that remembers the last processed change file")
+@click.option("--file_raw_metrics", default='data/metrics_outputs.json', type=click.Path(exists=True),
+              help="Enter the raw metrics of the previous run (JSON or GeoParquet); it is updated in place")
+@click.option("--file_geojson", default='data/districts_indexed.json',
+              help="Enter the file with results of calculated index for districts in json")
+@click.option("--file_simple_md_result", default='data/districts_indexed.md', help="Enter the file with results")
+@click.option("--geojson_format", type=click.Choice(GEOJSON_FORMATS), default='geojson',
+              help="GeoJSON output format")
+@click.option("--file_geoparquet", default=None, help="Enter the file to also write results in GeoParquet")
+@click.option("--index_state", default=None,
+              help="Enter the directory of the persisted index state to recompute only changed cities")
+@click.option("--workers", default=1, type=click.IntRange(min=1), help="Number of processes to collect districts")
+@memory_budget_option
+@source_options(cache_mode='refresh')
+def refresh(changes: str, state_path: str, file_raw_metrics: str, file_geojson: str, file_simple_md_result: str,
+            geojson_format: str, file_geoparquet: str, index_state: str, workers: int, memory_budget: float,
+            **source_settings):
+    """
+    Пересобирает метрики только тех районов, в которых есть изменения OSM, и публикует индекс.
+    Последний обработанный файл запоминается, только если расположены все изменения и пересобраны все
+    затронутые районы; иначе следующий запуск снова обработает те же файлы.
+    Изменения без расположения в файлах изменений ищутся в Overpass (см. locate_changes); с --pbf сеть
+    не используется, и такие изменения остаются нерасположенными.
+    """
+    state_path = Path(state_path)
+    files = change_files(changes, _read_state(state_path))
+    if not files:
+        logging.info('No new change files')
+        return
+    elements = [element for path in files for element in read_osc(path)]
+    changes_gdf = changed_features(elements)
+    if source_settings['pbf'] is None:
+        changes_gdf = locate_changes(changes_gdf, OverpassSource(source_settings['overpass_url']))
+    unlocated = int(changes_gdf.geometry.isna().sum())
+    raw_metrics = load_raw_metrics(file_raw_metrics)
+    affected = affected_districts(changes_gdf, raw_metrics_to_gdf(raw_metrics))
+    total = sum(len(city['districts']) for city in raw_metrics.values())
+    logging.info(f'{len(files)} change files, {len(elements)} changed elements, {len(changes_gdf)} relevant '
+                 f'({unlocated} not located); {len(affected)} of {total} districts are affected')
+    refreshed = 0
+    if affected:
+        source = make_source(**source_settings)
+        refreshed = refresh_raw_metrics(raw_metrics, affected, source, workers, memory_budget)
+        logging.info(f'Refreshed {refreshed} districts')
+        if refreshed:
+            save_raw_metrics(raw_metrics, file_raw_metrics)
+            publish_index(raw_metrics, source, file_geojson, file_simple_md_result, geojson_format,
+                          file_geoparquet=file_geoparquet, index_state=index_state)
+    if refreshed < len(affected):
+        logging.warning(f'{len(affected) - refreshed} affected districts were not refreshed, '
+                        f'the change files will be processed again on the next run')
+        return
+    if unlocated:
+        logging.warning(f'{unlocated} changed features were not located, '
+                        f'the change files will be processed again on the next run')
+        return
+    if Path(changes).is_dir():
+        _write_state(state_path, files[-1].relative_to(changes).as_posix())
+
+
+if __name__ == '__main__':
+    refresh()
@@ -0,0 +1,527 @@
+import asyncio
+import logging
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import httpx
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from shapely import LineString, MultiPolygon, Point, Polygon
+from shapely.geometry import shape
+
+import osmnx as ox
+from profiler import profiler
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/'
+USER_AGENT = 'pred-city-env pipeline'
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Замкнутые линии с такими ключами остаются линиями, а не превращаются в полигоны
+LINEAR_KEYS = {'highway', 'barrier', 'railway', 'waterway'}
+
+
+class TokenBucket:
+    """
+    Асинхронный ограничитель частоты запросов по алгоритму token bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: Число запросов в секунду.
+        :param capacity: Размер всплеска; по умолчанию равен rate, но не меньше одного запроса.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+@dataclass
+class RequestStats:
+    """
+    Статистика запросов клиента: число запросов, повторов, ошибок, объем ответов и время по сервисам.
+    """
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    bytes_received: int = 0
+    timings: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+
+    def summary(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'bytes_received': self.bytes_received,
+            'timings': {
+                service: {
+                    'count': len(durations),
+                    'total_s': sum(durations),
+                    'mean_s': sum(durations) / len(durations),
+                    'max_s': max(durations),
+                }
+                for service, durations in self.timings.items() if durations
+            },
+        }
+
+
+def _tag_filter(key: str, values) -> str:
+    if values is True:
+        return f'["{key}"]'
+    if isinstance(values, str):
+        values = [values]
+    pattern = '|'.join(re.escape(value) for value in values)
+    return f'["{key}"~"^({pattern})$"]'
+
+
+def _hole_free_parts(polygon: Polygon) -> list[Polygon]:
+    """
+    Делит полигон с дырами на полосы вертикальными линиями через середину каждой дыры: линия рассекает дыру,
+    поэтому ее части становятся вырезами на внешних границах полос, а полосы вместе дают ровно исходный полигон.
+    """
+    if not polygon.interiors:
+        return [polygon]
+    minx, miny, maxx, maxy = polygon.bounds
+    cuts = sorted({(hole.bounds[0] + hole.bounds[2]) / 2 for hole in polygon.interiors})
+    xs = [minx, *cuts, maxx]
+    strips = shapely.intersection(shapely.box(xs[:-1], miny, xs[1:], maxy), polygon)
+    parts = shapely.get_parts(strips)
+    return [piece for part in parts[shapely.get_type_id(parts) == 3] for piece in _hole_free_parts(part)]
+
+
+def _poly_filters(area: Polygon | MultiPolygon) -> list[str]:
+    """
+    Формирует фильтры (poly:"lat lon ...") для каждой части полигона. Фильтр poly учитывает только внешнюю
+    границу, поэтому полигоны с дырами делятся на части без дыр (см. _hole_free_parts), и объекты внутри дыр
+    не попадают в запрос.
+    """
+    polygons = area.geoms if isinstance(area, MultiPolygon) else [area]
+    return [
+        '(poly:"' + ' '.join(f'{lat:.7f} {lon:.7f}' for lon, lat in part.exterior.coords[:-1]) + '")'
+        for polygon in polygons
+        for part in _hole_free_parts(polygon)
+    ]
+
+
+def _statements(area: Polygon | MultiPolygon, tags: dict, required_key: str = None) -> str:
+    key_filter = '' if required_key is None else f'["{required_key}"]'
+    return ''.join(
+        f'nwr{_tag_filter(key, values)}{key_filter}{poly};'
+        for key, values in tags.items()
+        for poly in _poly_filters(area)
+    )
+
+
+def build_query(area: Polygon | MultiPolygon, tags: dict, out: str = 'geom', timeout: int = 180,
+                required_key: str = None) -> str:
+    """
+    Формирует запрос Overpass QL на объекты внутри полигона, подходящие хотя бы под один тег.
+    :param area: Полигон запроса.
+    :param tags: Словарь тегов в формате osmnx: {ключ: True | значение | [значения]}.
+    :param out: Режим вывода Overpass (geom, tags, count).
+    :param timeout: Таймаут запроса на стороне сервера в секундах.
+    :param required_key: Ключ, который обязательно должен быть у объекта (например, building:levels).
+    :return: Текст запроса.
+    """
+    return f'[out:json][timeout:{timeout}];({_statements(area, tags, required_key)});out {out};'
+
+
+def build_count_query(area: Polygon | MultiPolygon, tag_sets: list[dict], timeout: int = 180) -> str:
+    """
+    Формирует запрос Overpass QL, который возвращает только число объектов внутри полигона (out count)
+    отдельно для каждого набора тегов; все наборы считаются одним запросом.
+    :param area: Полигон запроса.
+    :param tag_sets: Список словарей тегов в формате osmnx.
+    :param timeout: Таймаут запроса на стороне сервера в секундах.
+    :return: Текст запроса.
+    """
+    counts = ''.join(f'({_statements(area, tags)});out count;' for tags in tag_sets)
+    return f'[out:json][timeout:{timeout}];{counts}'
+
+
+def build_bounds_query(ids: dict[str, list[int]], timeout: int = 180, date: str = None) -> str:
+    """
+    Формирует запрос Overpass QL на охватывающие прямоугольники объектов по их id (out bb).
+    :param ids: Словарь {тип элемента: [id]}.
+    :param timeout: Таймаут запроса на стороне сервера в секундах.
+    :param date: Момент времени (ISO 8601), на который нужны объекты, например для удаленных объектов;
+        по умолчанию текущие данные.
+    :return: Текст запроса.
+    """
+    settings = f'[out:json][timeout:{timeout}]' + ('' if date is None else f'[date:"{date}"]')
+    statements = ''.join(f'{element_type}(id:{",".join(map(str, osmids))});'
+                         for element_type, osmids in ids.items() if osmids)
+    return f'{settings};({statements});out bb;'
+
+
+def bounds_from_elements(elements: list[dict]) -> dict[tuple[str, int], Point | Polygon]:
+    """
+    :param elements: Список элементов из ответа Overpass (out bb).
+    :return: Словарь {(тип элемента, id): точка или охватывающий прямоугольник}.
+    """
+    bounds = {}
+    for element in elements:
+        if 'lon' in element:
+            bounds[element['type'], element['id']] = Point(element['lon'], element['lat'])
+        elif 'bounds' in element:
+            bbox = element['bounds']
+            bounds[element['type'], element['id']] = shapely.box(bbox['minlon'], bbox['minlat'], bbox['maxlon'],
+                                                                 bbox['maxlat'])
+    return bounds
+
+
+def counts_from_elements(elements: list[dict]) -> list[int]:
+    """
+    :param elements: Список элементов из ответа Overpass (out count).
+    :return: Число объектов для каждого набора тегов запроса в порядке build_count_query.
+    """
+    return [int(element['tags']['total']) for element in elements if element['type'] == 'count']
+
+
+def elements_to_frame(elements: list[dict]) -> pd.DataFrame:
+    """
+    Преобразует элементы ответа Overpass (out tags) в DataFrame без геометрии:
+    индекс (element_type, osmid) и по колонке на каждый тег, как у elements_to_gdf.
+    :param elements: Список элементов из ответа Overpass.
+    :return: DataFrame с тегами объектов.
+    """
+    records = [{'element_type': element['type'], 'osmid': element['id'], **element['tags']}
+               for element in elements if element.get('tags')]
+    if not records:
+        return pd.DataFrame(index=pd.MultiIndex.from_arrays([[], []], names=['element_type', 'osmid']))
+    return pd.DataFrame(records).set_index(['element_type', 'osmid'])
+
+
+def _way_geometry(element: dict) -> LineString | Polygon | None:
+    coords = [(point['lon'], point['lat']) for point in element.get('geometry', []) if point]
+    if len(coords) < 2:
+        return None
+    tags = element.get('tags', {})
+    is_closed = len(coords) >= 4 and coords[0] == coords[-1]
+    if is_closed and tags.get('area') != 'no' and not LINEAR_KEYS.intersection(tags):
+        return Polygon(coords)
+    return LineString(coords)
+
+
+def _relation_geometry(element: dict) -> Polygon | MultiPolygon | None:
+    if element.get('tags', {}).get('type') not in ('multipolygon', 'boundary'):
+        return None
+    rings = defaultdict(list)
+    for member in element.get('members', []):
+        coords = [(point['lon'], point['lat']) for point in member.get('geometry', []) if point]
+        if member.get('type') == 'way' and len(coords) >= 2:
+            rings[member.get('role') or 'outer'].append(LineString(coords))
+    outer = shapely.union_all(shapely.get_parts(shapely.polygonize(rings['outer'])))
+    if outer.is_empty:
+        return None
+    if rings['inner']:
+        outer = outer.difference(shapely.union_all(shapely.get_parts(shapely.polygonize(rings['inner']))))
+    return outer
+
+
+def elements_to_gdf(elements: list[dict]) -> GeoDataFrame:
+    """
+    Преобразует элементы ответа Overpass (out geom) в GeoDataFrame того же вида, что возвращает osmnx:
+    индекс (element_type, osmid), по колонке на каждый тег и колонка geometry.
+    :param elements: Список элементов из ответа Overpass.
+    :return: GeoDataFrame с объектами.
+    """
+    records = []
+    for element in elements:
+        match element['type']:
+            case 'node':
+                geometry = Point(element['lon'], element['lat']) if 'lon' in element else None
+            case 'way':
+                geometry = _way_geometry(element)
+            case 'relation':
+                geometry = _relation_geometry(element)
+            case _:
+                geometry = None
+        if geometry is None or not element.get('tags'):
+            continue
+        records.append({
+            'element_type': element['type'],
+            'osmid': element['id'],
+            **element['tags'],
+            'geometry': geometry,
+        })
+    if not records:
+        return GeoDataFrame(geometry=[], crs='epsg:4326')
+    return GeoDataFrame(records, geometry='geometry', crs='epsg:4326').set_index(['element_type', 'osmid'])
+
+
+class AsyncOverpassClient:
+    """
+    Асинхронный клиент Overpass и Nominatim на общем пуле соединений httpx.AsyncClient.
+    Ограничивает число одновременных запросов и их частоту (отдельно для каждого сервиса),
+    повторяет неудачные запросы с экспоненциальной задержкой и собирает статистику запросов.
+    Адреса сервисов настраиваются, поэтому клиент можно направить на локальную замену Overpass.
+
+    Используется как асинхронный контекстный менеджер:
+        async with AsyncOverpassClient(concurrency=8) as client:
+            districts = await client.geocode_to_gdf('Томск, Кировский район', which_result=1)
+            features = await client.features_from_polygon(districts.geometry[0], tags)
+    """
+
+    def __init__(self, overpass_url: str = OVERPASS_URL, nominatim_url: str = NOMINATIM_URL,
+                 concurrency: int = 4, overpass_rate: float = 1.0, nominatim_rate: float = 1.0,
+                 timeout: float = 180, max_retries: int = 5, backoff: float = 1.0,
+                 transport: httpx.AsyncBaseTransport = None):
+        """
+        :param overpass_url: Адрес интерпретатора Overpass.
+        :param nominatim_url: Адрес Nominatim.
+        :param concurrency: Предельное число одновременных запросов.
+        :param overpass_rate: Предельная частота запросов к Overpass в секунду.
+        :param nominatim_rate: Предельная частота запросов к Nominatim в секунду (политика OSM - не больше 1).
+        :param timeout: Таймаут запроса в секундах.
+        :param max_retries: Число повторов неудачного запроса.
+        :param backoff: Базовая задержка перед повтором в секундах; удваивается с каждой попыткой.
+        :param transport: Транспорт httpx, например httpx.MockTransport для проверки без сети.
+        """
+        self.overpass_url = overpass_url
+        self.nominatim_url = nominatim_url.rstrip('/') + '/'
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = RequestStats()
+        self._overpass_rate = overpass_rate
+        self._nominatim_rate = nominatim_rate
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._buckets = {
+            'overpass': TokenBucket(self._overpass_rate),
+            'nominatim': TokenBucket(self._nominatim_rate),
+        }
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            headers={'User-Agent': USER_AGENT},
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            transport=self._transport,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+        self._client = None
+
+    async def _request(self, service: str, method: str, url: str, **kwargs) -> httpx.Response:
+        with profiler.stage(f'{service}_request') as record:
+            for attempt in range(self.max_retries + 1):
+                async with self._semaphore:
+                    await self._buckets[service].acquire()
+                    started_at = time.perf_counter()
+                    try:
+                        response = await self._client.request(method, url, **kwargs)
+                    except httpx.TransportError as exc:
+                        response, error = None, exc
+                    else:
+                        error = None
+                    self.stats.requests += 1
+                    self.stats.timings[service].append(time.perf_counter() - started_at)
+                if response is not None and response.status_code not in RETRY_STATUSES:
+                    if response.is_error:
+                        self.stats.failures += 1
+                        response.raise_for_status()
+                    self.stats.bytes_received += len(response.content)
+                    record['bytes'] = len(response.content)
+                    return response
+                if attempt == self.max_retries:
+                    break
+                self.stats.retries += 1
+                delay = self.backoff * 2 ** attempt
+                logging.debug(f'Retry {service} request in {delay}s: {error or response.status_code}')
+                await asyncio.sleep(delay)
+            self.stats.failures += 1
+            if error is not None:
+                raise error
+            response.raise_for_status()
+
+    async def overpass(self, query: str) -> dict:
+        """
+        Выполняет запрос Overpass QL.
+        :param query: Текст запроса.
+        :return: Разобранный JSON-ответ.
+        """
+        response = await self._request('overpass', 'POST', self.overpass_url, data={'data': query})
+        return response.json()
+
+    async def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        """
+        Асинхронный аналог ox.features_from_polygon.
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов в формате osmnx.
+        :return: GeoDataFrame с объектами, пересекающими полигон.
+        """
+        response = await self.overpass(build_query(polygon, tags, timeout=int(self.timeout)))
+        features = elements_to_gdf(response.get('elements', []))
+        if features.empty:
+            return features
+        return features[features.intersects(polygon)]
+
+    async def count_from_polygon(self, polygon: Polygon | MultiPolygon, tag_sets: list[dict]) -> list[int]:
+        """
+        Считает объекты внутри полигона без загрузки самих объектов (out count).
+        :param polygon: Полигон запроса.
+        :param tag_sets: Список словарей тегов в формате osmnx.
+        :return: Число объектов для каждого набора тегов.
+        """
+        response = await self.overpass(build_count_query(polygon, tag_sets, timeout=int(self.timeout)))
+        return counts_from_elements(response.get('elements', []))
+
+    async def tags_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict,
+                                required_key: str = None) -> pd.DataFrame:
+        """
+        Загружает только теги объектов внутри полигона, без геометрии (out tags).
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов в формате osmnx.
+        :param required_key: Ключ, который обязательно должен быть у объекта.
+        :return: DataFrame с тегами объектов.
+        """
+        response = await self.overpass(build_query(polygon, tags, out='tags', timeout=int(self.timeout),
+                                                   required_key=required_key))
+        return elements_to_frame(response.get('elements', []))
+
+    async def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        """
+        Асинхронный аналог ox.geocode_to_gdf.
+        :param query: Строка запроса к геокодеру.
+        :param which_result: Номер результата геокодера (с единицы); по умолчанию первый полигональный.
+        :return: GeoDataFrame с границей найденного объекта.
+        """
+        response = await self._request('nominatim', 'GET', self.nominatim_url + 'search', params={
+            'q': query, 'format': 'json', 'polygon_geojson': 1, 'limit': 50,
+        })
+        results = response.json()
+        if which_result is not None:
+            results = results[which_result - 1:which_result]
+        results = [result for result in results
+                   if result.get('geojson', {}).get('type') in ('Polygon', 'MultiPolygon')]
+        if not results:
+            raise ValueError(f'Nominatim did not geocode query "{query}" to a polygon')
+        result, *_ = results
+        south, north, west, east = map(float, result['boundingbox'])
+        return GeoDataFrame(pd.DataFrame([{
+            'geometry': shape(result['geojson']),
+            'bbox_north': north,
+            'bbox_south': south,
+            'bbox_east': east,
+            'bbox_west': west,
+            'place_id': result.get('place_id'),
+            'osm_type': result.get('osm_type'),
+            'osm_id': result.get('osm_id'),
+            'lat': float(result['lat']),
+            'lon': float(result['lon']),
+            'display_name': result['display_name'],
+            'class': result.get('class'),
+            'type': result.get('type'),
+            'importance': result.get('importance'),
+        }]), geometry='geometry', crs='epsg:4326')
+
+
+class OverpassSource:
+    """
+    Класс OverpassSource - синхронный источник данных OSM с легким режимом загрузки для метрик, которым
+    не нужна геометрия: число объектов (out count) и теги объектов (out tags) запрашиваются у Overpass напрямую,
+    без построения геометрий и GeoDataFrame. Геокодирование и загрузка объектов с геометрией передаются osmnx.
+    Содержит только адреса и параметры, поэтому передается в дочерние процессы.
+    """
+    # Признак легкого режима для MetricCollector; обертки (OsmCache, TiledSource) передают его дальше
+    light_fetch = True
+
+    def __init__(self, overpass_url: str = OVERPASS_URL, timeout: float = 180, max_retries: int = 5,
+                 backoff: float = 1.0):
+        """
+        :param overpass_url: Адрес интерпретатора Overpass.
+        :param timeout: Таймаут запроса в секундах.
+        :param max_retries: Число повторов неудачного запроса.
+        :param backoff: Базовая задержка перед повтором в секундах; удваивается с каждой попыткой.
+        """
+        self.overpass_url = overpass_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        return ox.geocode_to_gdf(query, which_result=which_result)
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        return ox.features_from_polygon(polygon, tags=tags)
+
+    def overpass(self, query: str) -> dict:
+        """
+        Выполняет запрос Overpass QL, повторяя его с экспоненциальной задержкой при перегрузке сервера.
+        :param query: Текст запроса.
+        :return: Разобранный JSON-ответ.
+        """
+        with profiler.stage('overpass_request') as record:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = httpx.post(self.overpass_url, data={'data': query}, timeout=self.timeout,
+                                          headers={'User-Agent': USER_AGENT})
+                except httpx.TransportError as exc:
+                    response, error = None, exc
+                else:
+                    error = None
+                if response is not None and response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    record['bytes'] = len(response.content)
+                    return response.json()
+                if attempt == self.max_retries:
+                    break
+                time.sleep(self.backoff * 2 ** attempt)
+            if error is not None:
+                raise error
+            response.raise_for_status()
+
+    def count_from_polygon(self, polygon: Polygon | MultiPolygon, tag_sets: list[dict]) -> list[int]:
+        """
+        Считает объекты внутри полигона без загрузки самих объектов (out count).
+        :param polygon: Полигон запроса.
+        :param tag_sets: Список словарей тегов в формате osmnx.
+        :return: Число объектов для каждого набора тегов.
+        """
+        response = self.overpass(build_count_query(polygon, tag_sets, timeout=int(self.timeout)))
+        return counts_from_elements(response.get('elements', []))
+
+    def tags_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict, required_key: str = None) -> pd.DataFrame:
+        """
+        Загружает только теги объектов внутри полигона, без геометрии (out tags).
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов в формате osmnx.
+        :param required_key: Ключ, который обязательно должен быть у объекта.
+        :return: DataFrame с тегами объектов.
+        """
+        response = self.overpass(build_query(polygon, tags, out='tags', timeout=int(self.timeout),
+                                             required_key=required_key))
+        return elements_to_frame(response.get('elements', []))
+
+    def bounds_from_ids(self, ids: dict[str, list[int]], date: str = None) -> dict[tuple[str, int], Point | Polygon]:
+        """
+        Загружает охватывающие прямоугольники объектов по их id, без геометрии (out bb).
+        :param ids: Словарь {тип элемента: [id]}.
+        :param date: Момент времени (ISO 8601), на который нужны объекты; по умолчанию текущие данные.
+        :return: Словарь {(тип элемента, id): точка или охватывающий прямоугольник}; ненайденных объектов в нем нет.
+        """
+        response = self.overpass(build_bounds_query(ids, timeout=int(self.timeout), date=date))
+        return bounds_from_elements(response.get('elements', []))
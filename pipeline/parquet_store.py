@@ -0,0 +1,152 @@
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+from shapely.geometry import mapping, shape
+
+from collect_metric import METRICS, metrics_of_kind
+
+METRIC_NAMES = list(METRICS)
+# Метрики-счетчики хранятся целыми числами с пропусками, остальные - float64
+INTEGER_METRICS = metrics_of_kind('count')
+
+
+def _typed(df: DataFrame) -> DataFrame:
+    for column in ('common_area', *METRIC_NAMES):
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column]).astype('Int64' if column in INTEGER_METRICS else 'float64')
+    return df
+
+
+def _native(value):
+    return None if pd.isna(value) else value
+
+
+def cities_path(path: str | Path) -> Path:
+    """
+    :param path: Файл с районами.
+    :return: Файл с границами городов, который хранится рядом с файлом районов.
+    """
+    path = Path(path)
+    return path.with_name(f'{path.stem}_cities{path.suffix}')
+
+
+def blocks_path(path: str | Path) -> Path:
+    """
+    :param path: Файл с районами.
+    :return: Файл с кварталами, который хранится рядом с файлом районов.
+    """
+    path = Path(path)
+    return path.with_name(f'{path.stem}_blocks{path.suffix}')
+
+
+def raw_metrics_to_gdf(raw_metrics: dict) -> GeoDataFrame:
+    """
+    Преобразует сырые метрики из fetch_raw_metrics в таблицу: строка на район, типизированные колонки метрик.
+    :param raw_metrics: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}.
+    :return: GeoDataFrame с колонками city, district, title, common_area, метриками и geometry.
+    """
+    rows = []
+    for city_name, city in raw_metrics.items():
+        for district_name, district in city['districts'].items():
+            feature, *_ = district['features']
+            rows.append({
+                'city': city_name,
+                'district': district_name,
+                **feature['properties'],
+                'geometry': shape(feature['geometry']),
+            })
+    return _typed(GeoDataFrame(rows, geometry='geometry', crs='epsg:4326'))
+
+
+def write_raw_metrics(raw_metrics: dict, path: str | Path) -> None:
+    """
+    Записывает сырые метрики в GeoParquet (геометрия в WKB).
+    :param raw_metrics: Сырые метрики из fetch_raw_metrics.
+    :param path: Файл результата.
+    """
+    raw_metrics_to_gdf(raw_metrics).to_parquet(path, compression='zstd')
+
+
+def read_metrics_frame(path: str | Path, columns: list[str] = None) -> DataFrame:
+    """
+    Читает из GeoParquet только нужные колонки, не разбирая геометрию, если она не запрошена.
+    :param path: Файл с сырыми метриками или проиндексированными районами.
+    :param columns: Список колонок; по умолчанию все.
+    :return: DataFrame с колонками.
+    """
+    if columns is not None and 'geometry' in columns:
+        return gpd.read_parquet(path, columns=columns)
+    return pd.read_parquet(path, columns=columns)
+
+
+def read_raw_metrics(path: str | Path) -> dict:
+    """
+    Читает сырые метрики из GeoParquet в формате fetch_raw_metrics.
+    :param path: Файл с сырыми метриками.
+    :return: Словарь {город: {'districts': {район: FeatureCollection с метриками}}}.
+    """
+    gdf = gpd.read_parquet(path)
+    property_columns = [column for column in gdf.columns if column not in ('city', 'district', 'geometry')]
+    raw_metrics = {}
+    for row in gdf.to_dict('records'):
+        city = raw_metrics.setdefault(row['city'], {'districts': {}})
+        city['districts'][row['district']] = {
+            'type': 'FeatureCollection',
+            'features': [{
+                'id': '0',
+                'type': 'Feature',
+                'properties': {column: _native(row[column]) for column in property_columns},
+                'geometry': mapping(row['geometry']),
+            }],
+        }
+    return raw_metrics
+
+
+def write_indexed_districts(indexed_districts: DataFrame, raw_metrics: dict, city_geometries: dict,
+                            path: str | Path) -> None:
+    """
+    Записывает проиндексированные районы и границы городов в GeoParquet.
+    Районы содержат сырые метрики, нормализованные метрики (с суффиксом _normalized) и index_level;
+    границы городов пишутся в соседний файл (см. cities_path).
+    :param indexed_districts: DataFrame с результатами calculate_index.
+    :param raw_metrics: Сырые метрики из fetch_raw_metrics.
+    :param city_geometries: Словарь {город: граница города}.
+    :param path: Файл с районами.
+    """
+    normalized = indexed_districts.drop_duplicates(['city', 'district']).rename(
+        columns={metric_name: f'{metric_name}_normalized' for metric_name in METRIC_NAMES})
+    districts = raw_metrics_to_gdf(raw_metrics).merge(normalized, on=['city', 'district'], how='inner')
+    # Как и в GeoJSON, названием района служит имя из списка районов, а не ответ геокодера
+    districts['title'] = districts['district']
+    districts.to_parquet(path, compression='zstd')
+    GeoDataFrame(
+        {'title': list(city_geometries)}, geometry=list(city_geometries.values()), crs='epsg:4326'
+    ).to_parquet(cities_path(path), compression='zstd')
+
+
+def write_blocks(city_blocks: dict[str, GeoDataFrame], path: str | Path) -> None:
+    """
+    Записывает кварталы городов в GeoParquet рядом с файлом районов (см. blocks_path).
+    :param city_blocks: Словарь {город: GeoDataFrame с кварталами из blocks.collect_blocks}.
+    :param path: Файл с районами.
+    """
+    blocks = pd.concat([city.assign(city=city_name) for city_name, city in city_blocks.items()], ignore_index=True) \
+        if city_blocks else GeoDataFrame({'city': [], 'title': []}, geometry=[], crs='epsg:4326')
+    _typed(GeoDataFrame(blocks, geometry='geometry', crs='epsg:4326')).to_parquet(blocks_path(path), compression='zstd')
+
+
+def write_grid(city_grids: dict[str, GeoDataFrame], rollups: DataFrame, path: str | Path) -> None:
+    """
+    Записывает ячейки сетки в GeoParquet, а сводки по районам и городам - в соседний файл *_rollup.parquet.
+    :param city_grids: Словарь {город: GeoDataFrame с ячейками из grid.collect_grid}.
+    :param rollups: DataFrame со сводками по ячейкам: колонки level (district или city), city, district и метрики.
+    :param path: Файл с ячейками.
+    """
+    grid = pd.concat(city_grids.values(), ignore_index=True) if city_grids \
+        else GeoDataFrame({'city': [], 'cell': []}, geometry=[], crs='epsg:4326')
+    _typed(GeoDataFrame(grid, geometry='geometry', crs='epsg:4326')).to_parquet(path, compression='zstd')
+    path = Path(path)
+    _typed(rollups).to_parquet(path.with_name(f'{path.stem}_rollup{path.suffix}'), compression='zstd')
@@ -0,0 +1,153 @@
+import logging
+from pathlib import Path
+
+import osmium
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from osmnx._errors import EmptyOverpassResponse
+from shapely import MultiPolygon, Polygon
+
+from collect_metric import METRICS, MetricCollector, measurable_metrics, requested_metrics
+from overpass_client import LINEAR_KEYS
+
+# Теги, которые сохраняются у объектов помимо тегов запроса: название и атрибуты метрик вида mean
+EXTRA_KEYS = ('name', *(spec.attribute for spec in METRICS.values() if spec.attribute is not None))
+
+
+class _FeatureHandler(osmium.SimpleHandler):
+    """
+    Обработчик файла OSM: оставляет точки, линейные (улицы) и площадные объекты, подходящие под теги,
+    и административные границы с названием.
+    """
+
+    def __init__(self, tags: dict):
+        super().__init__()
+        self.tags = {
+            key: True if values is True else {values} if isinstance(values, str) else set(values)
+            for key, values in tags.items()
+        }
+        self.keys = set(tags) | set(EXTRA_KEYS)
+        self.features = []
+        self.boundaries = []
+        self._wkb = osmium.geom.WKBFactory()
+
+    def _matches(self, tags) -> bool:
+        for key, values in self.tags.items():
+            value = tags.get(key)
+            if value is not None and (values is True or value in values):
+                return True
+        return False
+
+    def _record(self, element_type: str, osmid: int, tags, wkb: str) -> dict:
+        return {
+            'element_type': element_type,
+            'osmid': osmid,
+            **{key: tags.get(key) for key in self.keys if key in tags},
+            'geometry': wkb,
+        }
+
+    def node(self, node):
+        if self._matches(node.tags):
+            self.features.append(self._record('node', node.id, node.tags, self._wkb.create_point(node)))
+
+    def way(self, way):
+        if not LINEAR_KEYS.intersection(tag.k for tag in way.tags) or not self._matches(way.tags):
+            return
+        try:
+            wkb = self._wkb.create_linestring(way)
+        except (RuntimeError, osmium.InvalidLocationError):
+            return
+        self.features.append(self._record('way', way.id, way.tags, wkb))
+
+    def area(self, area):
+        is_feature = self._matches(area.tags)
+        is_boundary = area.tags.get('boundary') == 'administrative' and 'name' in area.tags
+        if not is_feature and not is_boundary:
+            return
+        try:
+            wkb = self._wkb.create_multipolygon(area)
+        except RuntimeError:
+            # Некорректно собранный мультиполигон
+            return
+        element_type = 'way' if area.from_way() else 'relation'
+        if is_feature:
+            self.features.append(self._record(element_type, area.orig_id(), area.tags, wkb))
+        if is_boundary:
+            self.boundaries.append({
+                'element_type': element_type,
+                'osmid': area.orig_id(),
+                'name': area.tags.get('name'),
+                'admin_level': area.tags.get('admin_level'),
+                'geometry': wkb,
+            })
+
+
+def _to_gdf(records: list[dict]) -> GeoDataFrame:
+    if not records:
+        return GeoDataFrame(geometry=[], crs='epsg:4326')
+    gdf = pd.DataFrame(records)
+    gdf['geometry'] = shapely.from_wkb(gdf['geometry'].values)
+    return GeoDataFrame(gdf, geometry='geometry', crs='epsg:4326').set_index(['element_type', 'osmid'])
+
+
+class PbfFeatureSource:
+    """
+    Класс PbfFeatureSource - офлайн-источник данных OSM на основе локальной выгрузки (.osm.pbf или .osm).
+    Файл читается один раз: в памяти остаются только объекты, нужные метрикам, и административные границы,
+    по которым строятся пространственные индексы. Повторяет интерфейс osmnx (geocode_to_gdf,
+    features_from_polygon), поэтому заменяет сетевые запросы везде, где ожидается источник данных OSM.
+    """
+
+    def __init__(self, path: str | Path, tags: dict = None):
+        """
+        :param path: Путь к выгрузке OSM.
+        :param tags: Словарь тегов объектов, которые нужно сохранить; по умолчанию теги всех метрик.
+        """
+        if tags is None:
+            tags = MetricCollector.merge_tags(requested_metrics(measurable_metrics))
+        self.path = Path(path)
+        handler = _FeatureHandler(tags)
+        logging.info(f'Start reading OSM extract: {self.path}')
+        handler.apply_file(str(self.path), locations=True, idx='flex_mem')
+        self.features = _to_gdf(handler.features)
+        self.boundaries = _to_gdf(handler.boundaries)
+        logging.info(f'Read {len(self.features)} features and {len(self.boundaries)} boundaries from {self.path}')
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        """
+        Офлайн-аналог ox.features_from_polygon.
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов в формате osmnx.
+        :return: GeoDataFrame с объектами, пересекающими полигон.
+        """
+        positions = self.features.sindex.query(polygon, predicate='intersects')
+        features = MetricCollector.select_layer(self.features.iloc[positions], tags)
+        if features.empty:
+            raise EmptyOverpassResponse('No matching features in OSM extract')
+        return features
+
+    def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        """
+        Офлайн-аналог ox.geocode_to_gdf по административным границам выгрузки.
+        Запрос вида "Город, Район" ищет границу с названием "Район" внутри границы с названием "Город".
+        :param query: Строка запроса.
+        :param which_result: Номер подходящей границы (с единицы); по умолчанию первая.
+        :return: GeoDataFrame с границей найденного объекта.
+        """
+        *parent_names, name = [part.strip() for part in query.split(',')]
+        candidates = self.boundaries[self.boundaries['name'] == name]
+        for parent_name in parent_names:
+            parents = self.boundaries[self.boundaries['name'] == parent_name]
+            if parents.empty:
+                candidates = candidates.iloc[0:0]
+                break
+            parent_area = shapely.union_all(parents.geometry.values)
+            candidates = candidates[candidates.geometry.representative_point().within(parent_area)]
+        candidates = candidates.sort_values('admin_level', key=lambda levels: pd.to_numeric(levels, errors='coerce'))
+        position = 0 if which_result is None else which_result - 1
+        if len(candidates) <= position:
+            raise ValueError(f'OSM extract has no boundary for query "{query}"')
+        result = candidates.iloc[[position]].reset_index()
+        result['display_name'] = query
+        return result[['geometry', 'display_name', 'element_type', 'osmid', 'name', 'admin_level']]
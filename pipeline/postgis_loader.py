@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Literal
+
+import asyncpg
+import click
+import geopandas as gpd
+import orjson
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from parquet_store import INTEGER_METRICS, METRIC_NAMES, blocks_path, cities_path
+
+LoadMode = Literal['replace', 'upsert']
+LOAD_MODES: tuple[LoadMode, ...] = ('replace', 'upsert')
+
+DISTRICT_PROPERTIES = ['common_area', *METRIC_NAMES]
+_PROPERTY_TYPES = ', '.join(
+    f"{column} {'int4' if column in INTEGER_METRICS else 'float8'}" for column in DISTRICT_PROPERTIES)
+
+# number - номер строки среди строк города с тем же названием в файле результата (см. _numbered), id - будущий id
+# района или квартала: строки сопоставляются с таблицами backend по id, а не по названиям, которые в городе
+# могут повторяться
+STAGE_TABLES = f'''
+CREATE TEMP TABLE stage_cities (title text NOT NULL, geom bytea NOT NULL) ON COMMIT DROP;
+CREATE TEMP TABLE stage_districts (id int, city text NOT NULL, title text NOT NULL, number int NOT NULL,
+{_PROPERTY_TYPES}, geom bytea NOT NULL) ON COMMIT DROP;
+CREATE TEMP TABLE stage_blocks (id int, city text NOT NULL, title text NOT NULL, number int NOT NULL,
+{_PROPERTY_TYPES}, geom bytea NOT NULL) ON COMMIT DROP;
+'''
+STAGE_COLUMNS = ['city', 'title', 'number', *DISTRICT_PROPERTIES, 'geom']
+
+_GEOM = 'ST_Multi(ST_GeomFromWKB({}.geom, 4326))'
+_PROPERTY_COLUMNS = ', '.join(DISTRICT_PROPERTIES)
+_PROPERTY_VALUES = ', '.join(f'd.{column}' for column in DISTRICT_PROPERTIES)
+
+
+def _new_ids(stage: str, table: str) -> str:
+    return f"UPDATE {stage} SET id = nextval(pg_get_serial_sequence('{table}', 'id')) WHERE id IS NULL;"
+
+
+def _insert_rows(stage: str, table: str, properties: str, key: str) -> str:
+    # Строки без найденного города не вставляются, поэтому свойства берутся только у вставленных строк
+    return f'''
+INSERT INTO {table} (id, title, city_id, geom)
+SELECT d.id, d.title, c.id, {_GEOM.format('d')} FROM {stage} d JOIN cities c ON c.title = d.city
+WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.id = d.id);
+INSERT INTO {properties} ({key}, {_PROPERTY_COLUMNS})
+SELECT d.id, {_PROPERTY_VALUES} FROM {stage} d JOIN {table} t ON t.id = d.id
+ON CONFLICT ({key}) DO UPDATE SET
+{', '.join(f'{column} = EXCLUDED.{column}' for column in DISTRICT_PROPERTIES)};
+'''
+
+
+# Полная замена: старые города удаляются вместе с районами, кварталами и свойствами (ON DELETE CASCADE)
+REPLACE_SQL = f'''
+DELETE FROM cities;
+INSERT INTO cities (title, geom) SELECT s.title, {_GEOM.format('s')} FROM stage_cities s;
+INSERT INTO city_properties (city_id) SELECT id FROM cities;
+{_new_ids('stage_districts', 'districts')}
+{_insert_rows('stage_districts', 'districts', 'district_properties', 'district_id')}
+'''
+
+# Обновление: города сопоставляются по названиям, а районы - по городу, названию и номеру среди районов города
+# с тем же названием (в порядке файла и в порядке id); остальные данные не трогаются, поэтому загружать можно
+# и часть районов файла
+UPSERT_SQL = f'''
+UPDATE cities c SET geom = {_GEOM.format('s')} FROM stage_cities s WHERE c.title = s.title;
+INSERT INTO cities (title, geom)
+SELECT s.title, {_GEOM.format('s')} FROM stage_cities s
+WHERE NOT EXISTS (SELECT 1 FROM cities c WHERE c.title = s.title);
+INSERT INTO city_properties (city_id)
+SELECT c.id FROM cities c WHERE NOT EXISTS (SELECT 1 FROM city_properties p WHERE p.city_id = c.id);
+UPDATE stage_districts s SET id = dd.id
+FROM cities c, (SELECT id, city_id, title, row_number() OVER (PARTITION BY city_id, title ORDER BY id) AS number
+                FROM districts) dd
+WHERE c.title = s.city AND dd.city_id = c.id AND dd.title = s.title AND dd.number = s.number;
+{_new_ids('stage_districts', 'districts')}
+UPDATE districts dd SET geom = {_GEOM.format('d')} FROM stage_districts d WHERE dd.id = d.id;
+{_insert_rows('stage_districts', 'districts', 'district_properties', 'district_id')}
+'''
+
+# Кварталы перестраиваются заново при каждом запуске, поэтому кварталы загружаемых городов заменяются целиком
+BLOCKS_SQL = f'''
+DELETE FROM blocks b USING cities c
+WHERE b.city_id = c.id AND c.title IN (SELECT DISTINCT city FROM stage_blocks);
+{_new_ids('stage_blocks', 'blocks')}
+{_insert_rows('stage_blocks', 'blocks', 'block_properties', 'block_id')}
+'''
+
+
+def default_dsn() -> str:
+    """
+    :return: Строка подключения к базе backend из тех же переменных окружения, что использует backend.
+    """
+    return (f"postgresql://{os.environ.get('DB_USERNAME', 'postgres')}:{os.environ.get('DB_PASSWORD', 'postgres')}"
+            f"@{os.environ.get('DB_HOST', 'localhost')}:{os.environ.get('DB_PORT', 5432)}"
+            f"/{os.environ.get('DB_DATABASE', 'pred-city-env-service')}")
+
+
+def _value(column: str, value):
+    if value is None or pd.isna(value):
+        return None
+    return int(value) if column in INTEGER_METRICS else float(value)
+
+
+def _feature_record(city_title: str, feature: dict) -> tuple:
+    properties = feature['properties']
+    return (
+        city_title,
+        properties['title'],
+        *(_value(column, properties.get(column)) for column in DISTRICT_PROPERTIES),
+        shapely.to_wkb(shape(feature['geometry'])),
+    )
+
+
+def _frame_records(gdf) -> list[tuple]:
+    return [
+        (
+            row['city'],
+            row['title'],
+            *(_value(column, row[column]) for column in DISTRICT_PROPERTIES),
+            wkb,
+        )
+        for row, wkb in zip(gdf.drop(columns='geometry').to_dict('records'), shapely.to_wkb(gdf.geometry.to_numpy()))
+    ]
+
+
+def read_geojson_records(path: str | Path) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    """
+    Читает результат form_geo_json (FeatureCollection или GeoJSONSeq) в записи для staging-таблиц.
+    :param path: Файл GeoJSON.
+    :return: Записи городов (title, wkb), районов и кварталов (city, title, свойства..., wkb).
+    """
+    with open(path, 'rb') as file:
+        content = file.read()
+    try:
+        document = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        # GeoJSONSeq: несколько документов, по одному на строку (возможно, с разделителем записей RS)
+        city_features = [orjson.loads(line.strip(b'\x1e')) for line in content.splitlines() if line.strip()]
+    else:
+        # Один документ - FeatureCollection в любом форматировании или GeoJSONSeq из одного города
+        city_features = document['features'] if document.get('type') == 'FeatureCollection' else [document]
+    cities, districts, blocks = [], [], []
+    for city in city_features:
+        city_title = city['properties']['title']
+        cities.append((city_title, shapely.to_wkb(shape(city['geometry']))))
+        districts.extend(_feature_record(city_title, district) for district in city['districts']['features'])
+        blocks.extend(_feature_record(city_title, block) for block in city.get('blocks', {'features': []})['features'])
+    return cities, districts, blocks
+
+
+def read_geoparquet_records(path: str | Path) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    """
+    Читает результат form_geo_parquet в записи для staging-таблиц; читаются только нужные колонки.
+    :param path: Файл GeoParquet с районами; границы городов и кварталы берутся из соседних
+        *_cities.parquet и *_blocks.parquet.
+    :return: Записи городов (title, wkb), районов и кварталов (city, title, свойства..., wkb).
+    """
+    columns = ['city', 'title', *DISTRICT_PROPERTIES, 'geometry']
+    cities = gpd.read_parquet(cities_path(path), columns=['title', 'geometry'])
+    city_records = list(zip(cities['title'], shapely.to_wkb(cities.geometry.to_numpy())))
+    district_records = _frame_records(gpd.read_parquet(path, columns=columns))
+    block_records = _frame_records(gpd.read_parquet(blocks_path(path), columns=columns)) \
+        if blocks_path(path).exists() else []
+    return city_records, district_records, block_records
+
+
+def _numbered(records: list[tuple]) -> list[tuple]:
+    numbers = Counter()
+    numbered = []
+    for city_title, title, *values in records:
+        numbers[city_title, title] += 1
+        numbered.append((city_title, title, numbers[city_title, title], *values))
+    return numbered
+
+
+async def load_to_postgis(path: str | Path, dsn: str = None, mode: LoadMode = 'replace',
+                          districts_filter: set[tuple[str, str]] = None) -> None:
+    """
+    Загружает города, районы, кварталы и их свойства прямо в таблицы backend.
+    Данные копируются бинарным COPY во временные staging-таблицы, а затем одной транзакцией
+    заменяют (replace) или обновляют (upsert) данные backend, так что читатели видят либо старые,
+    либо новые данные целиком.
+    :param path: Результат пайплайна: GeoParquet (*.parquet) или GeoJSON.
+    :param dsn: Строка подключения к PostgreSQL; по умолчанию из переменных окружения backend.
+    :param mode: replace - заменить все города; upsert - обновить совпадающие по названию и добавить новые.
+    :param districts_filter: Ключи (город, название) районов, которые нужно загрузить (только для upsert);
+        по умолчанию все районы файла. Номера районов с одинаковыми названиями считаются по всему файлу,
+        поэтому часть районов сопоставляется с теми же строками backend, что и при полной загрузке.
+    """
+    if mode not in LOAD_MODES:
+        raise ValueError(f'Unknown load mode: {mode}')
+    if districts_filter is not None and mode != 'upsert':
+        raise ValueError('Only the upsert mode can load a part of the districts')
+    started_at = time.perf_counter()
+    if str(path).endswith('.parquet'):
+        cities, districts, blocks = read_geoparquet_records(path)
+    else:
+        cities, districts, blocks = read_geojson_records(path)
+    districts, blocks = _numbered(districts), _numbered(blocks)
+    if districts_filter is not None:
+        districts = [record for record in districts if (record[0], record[1]) in districts_filter]
+
+    connection = await asyncpg.connect(dsn or default_dsn())
+    try:
+        async with connection.transaction():
+            await connection.execute(STAGE_TABLES)
+            await connection.copy_records_to_table('stage_cities', records=cities, columns=['title', 'geom'])
+            await connection.copy_records_to_table('stage_districts', records=districts, columns=STAGE_COLUMNS)
+            await connection.copy_records_to_table('stage_blocks', records=blocks, columns=STAGE_COLUMNS)
+            await connection.execute(REPLACE_SQL if mode == 'replace' else UPSERT_SQL)
+            await connection.execute(BLOCKS_SQL)
+    finally:
+        await connection.close()
+    logging.info(f'Loaded {len(cities)} cities, {len(districts)} districts and {len(blocks)} blocks ({mode}) '
+                 f'in {time.perf_counter() - started_at:.2f} s')
+
+
+@click.command()
+@click.option("--file", "path", default='data/districts_indexed.json', type=click.Path(exists=True, dir_okay=False),
+              help="Enter the pipeline result to load: GeoJSON, GeoJSONSeq or GeoParquet")
+@click.option("--dsn", default=None, help="PostgreSQL DSN, defaults to the backend DB_* environment variables")
+@click.option("--mode", type=click.Choice(LOAD_MODES), default='replace',
+              help="Replace all cities or upsert cities and districts by title")
+def load_db(path: str, dsn: str, mode: str):
+    asyncio.run(load_to_postgis(path, dsn=dsn, mode=mode))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    load_db()
@@ -0,0 +1,141 @@
+import cProfile
+import logging
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+import pandas as pd
+from pandas import DataFrame
+
+TRACE_COLUMNS = ['stage', 'city', 'district', 'metric', 'seconds', 'features', 'bytes']
+
+
+class StageProfiler:
+    """
+    Класс StageProfiler записывает время, число объектов и объем данных по этапам пайплайна.
+    Каждая запись - один этап (geocode, fetch, reproject, overlay, metric, collect, normalize, write_geojson, ...)
+    с метками города, района и метрики. Пока профилировщик выключен, этапы ничего не записывают.
+
+    Используется через контекстные менеджеры:
+        with profiler.context(city='Томск', district='Кировский район'):
+            with profiler.stage('fetch') as record:
+                features = ...
+                record['features'] = len(features)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.records: list[dict] = []
+        self._labels: dict = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    @contextmanager
+    def context(self, **labels):
+        """
+        Задает метки (city, district, metric) для всех вложенных этапов.
+        """
+        previous = self._labels
+        self._labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._labels = previous
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        """
+        Замеряет время этапа; в запись можно дописать features и bytes.
+        :param name: Название этапа.
+        :param labels: Метки записи в дополнение к меткам context.
+        :return: Словарь записи.
+        """
+        record = {'stage': name, **self._labels, **labels}
+        if not self.enabled:
+            yield record
+            return
+        started_at = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - started_at
+            self.records.append(record)
+
+    def drain(self) -> list[dict]:
+        """
+        :return: Накопленные записи; профилировщик очищается (используется в дочерних процессах).
+        """
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records: list[dict]) -> None:
+        self.records.extend(records)
+
+    def frame(self) -> DataFrame:
+        return pd.DataFrame(self.records, columns=TRACE_COLUMNS)
+
+    def summary(self) -> DataFrame:
+        """
+        :return: Таблица по этапам: число замеров, суммарное, среднее и максимальное время, объекты и байты.
+        """
+        return self.frame().groupby('stage', sort=False).agg(
+            count=('seconds', 'size'),
+            total_s=('seconds', 'sum'),
+            mean_s=('seconds', 'mean'),
+            max_s=('seconds', 'max'),
+            features=('features', 'sum'),
+            bytes=('bytes', 'sum'),
+        ).sort_values('total_s', ascending=False)
+
+    def slowest_districts(self, top: int = 10) -> DataFrame:
+        """
+        :return: Районы с наибольшим временем сбора метрик.
+        """
+        collected = self.frame()
+        collected = collected[collected['stage'] == 'collect']
+        return collected.nlargest(top, 'seconds')[['city', 'district', 'seconds', 'features']]
+
+    def write_trace(self, path: str | Path) -> None:
+        """
+        Записывает все записи: CSV, если у файла расширение .csv, иначе JSON.
+        :param path: Файл трассы.
+        """
+        if str(path).endswith('.csv'):
+            self.frame().to_csv(path, index=False)
+            return
+        with open(path, 'wb') as file:
+            file.write(orjson.dumps(self.records))
+
+    def report(self, trace_path: str | Path) -> None:
+        """
+        Пишет в лог сводную таблицу и самые медленные районы и сохраняет трассу.
+        :param trace_path: Файл трассы (см. write_trace).
+        """
+        self.write_trace(trace_path)
+        logging.info(f'Profile by stage:\n{self.summary().to_markdown()}')
+        logging.info(f'Slowest districts:\n{self.slowest_districts().to_markdown()}')
+        logging.info(f'Profile trace written to {trace_path}')
+
+
+# Профилировщик процесса; в дочерних процессах пула включается через _init_worker
+profiler = StageProfiler()
+
+
+@contextmanager
+def cprofiled(path: str | Path | None):
+    """
+    Запускает cProfile на время блока и сохраняет статистику в файл (читается через pstats или snakeviz).
+    :param path: Файл статистики; если None, cProfile не запускается.
+    """
+    if path is None:
+        yield
+        return
+    cprofile = cProfile.Profile()
+    cprofile.enable()
+    try:
+        yield
+    finally:
+        cprofile.disable()
+        cprofile.dump_stats(path)
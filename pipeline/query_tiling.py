@@ -0,0 +1,177 @@
+import math
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame
+from osmnx._errors import EmptyOverpassResponse
+from shapely import MultiPolygon, Polygon
+
+import osmnx as ox
+from area_engine import POLYGON_TYPE_IDS, to_equal_area
+from collect_metric import MetricCollector, record_features
+from profiler import profiler
+
+# Допуск упрощения границы запроса в метрах
+SIMPLIFY_TOLERANCE = 20.0
+# Предельная площадь ячейки запроса в кв. км: такие запросы Overpass выполняет за предсказуемое время
+MAX_QUERY_AREA = 100.0
+METERS_PER_DEGREE = 111_320
+
+
+def query_polygon(area: Polygon | MultiPolygon, tolerance: float = SIMPLIFY_TOLERANCE) -> Polygon | MultiPolygon:
+    """
+    Упрощает границу для запроса: граница сначала расширяется на допуск, а затем упрощается с тем же допуском,
+    поэтому упрощенный полигон целиком покрывает исходный, а вершин в нем на порядки меньше.
+    :param area: Граница района или города.
+    :param tolerance: Допуск в метрах; 0 - не упрощать.
+    :return: Полигон запроса.
+    """
+    if tolerance <= 0:
+        return area
+    degrees = tolerance / METERS_PER_DEGREE
+    return shapely.simplify(shapely.buffer(area, degrees), degrees)
+
+
+def query_cells(area: Polygon | MultiPolygon, max_area: float = MAX_QUERY_AREA,
+                tolerance: float = SIMPLIFY_TOLERANCE) -> list[Polygon | MultiPolygon]:
+    """
+    Готовит геометрии запросов: упрощает границу и, если она больше max_area, режет ее на квадратные ячейки
+    площадью не больше max_area.
+    :param area: Граница района или города.
+    :param max_area: Предельная площадь ячейки в кв. км; 0 - не резать.
+    :param tolerance: Допуск упрощения в метрах.
+    :return: Список полигонов запросов, вместе покрывающих area.
+    """
+    polygon = query_polygon(area, tolerance)
+    if max_area <= 0 or to_equal_area(polygon).area / 1e6 <= max_area:
+        return [polygon]
+    minx, miny, maxx, maxy = polygon.bounds
+    side = math.sqrt(max_area * 1e6) / METERS_PER_DEGREE
+    # Ширина ячейки в градусах долготы считается на ближайшей к экватору широте, где градус долготы длиннее всего
+    latitude = 0.0 if miny <= 0 <= maxy else min(abs(miny), abs(maxy))
+    side_x = side / math.cos(math.radians(latitude))
+    xs = np.arange(minx, maxx, side_x)
+    ys = np.arange(miny, maxy, side)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    boxes = shapely.box(grid_x.ravel(), grid_y.ravel(), grid_x.ravel() + side_x, grid_y.ravel() + side)
+    shapely.prepare(polygon)
+    boxes = boxes[shapely.intersects(polygon, boxes)]
+    cells = shapely.intersection(boxes, polygon)
+    return [cell for cell in cells if not cell.is_empty and shapely.get_type_id(cell) in POLYGON_TYPE_IDS]
+
+
+def merge_cell_features(area: Polygon | MultiPolygon, cell_features: list[GeoDataFrame]) -> GeoDataFrame:
+    """
+    Объединяет объекты ячеек: объекты на границе ячеек встречаются несколько раз и оставляются один раз,
+    а объекты, попавшие в запрос только из-за упрощения границы, отбрасываются точной проверкой по area.
+    :param area: Исходная граница района или города.
+    :param cell_features: Объекты каждой ячейки.
+    :return: GeoDataFrame с объектами, пересекающими area.
+    """
+    cell_features = [features for features in cell_features if not features.empty]
+    if not cell_features:
+        return GeoDataFrame(geometry=[], crs='epsg:4326')
+    features = pd.concat(cell_features)
+    features = features[~features.index.duplicated()]
+    shapely.prepare(area)
+    return features[shapely.intersects(area, features.geometry.to_numpy())]
+
+
+class TiledSource:
+    """
+    Класс TiledSource - обертка над источником данных OSM, которая ограничивает стоимость запросов объектов:
+    граница запроса упрощается, большие полигоны режутся на ячейки ограниченной площади, объекты запрашиваются
+    по ячейкам, а затем объединяются и точно обрезаются по исходной границе (см. query_cells, merge_cell_features).
+    Легкие запросы без геометрии обрезать нельзя, поэтому они идут по точной границе без упрощения.
+    Геокодирование передается источнику без изменений.
+    """
+
+    def __init__(self, source=None, max_area: float = MAX_QUERY_AREA, tolerance: float = SIMPLIFY_TOLERANCE):
+        """
+        :param source: Источник данных OSM с интерфейсом osmnx (например, OsmCache); по умолчанию osmnx.
+        :param max_area: Предельная площадь ячейки запроса в кв. км; 0 - не резать.
+        :param tolerance: Допуск упрощения границы запроса в метрах; 0 - не упрощать.
+        """
+        self.source = source
+        self.max_area = max_area
+        self.tolerance = tolerance
+
+    def __getstate__(self):
+        # Модуль osmnx нельзя сериализовать, поэтому источник по умолчанию не передается в дочерние процессы
+        state = self.__dict__.copy()
+        if state['source'] is ox:
+            state['source'] = None
+        return state
+
+    @property
+    def _source(self):
+        return ox if self.source is None else self.source
+
+    @property
+    def light_fetch(self) -> bool:
+        return getattr(self._source, 'light_fetch', False)
+
+    def geocode_to_gdf(self, query: str, which_result: int = None) -> GeoDataFrame:
+        return self._source.geocode_to_gdf(query, which_result=which_result)
+
+    def features_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict) -> GeoDataFrame:
+        """
+        Загружает объекты OSM внутри полигона по ячейкам.
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов запроса.
+        :return: GeoDataFrame с объектами, пересекающими полигон.
+        """
+        cell_features = []
+        cells = query_cells(polygon, self.max_area, self.tolerance)
+        for cell in cells:
+            with profiler.stage('fetch_cell') as record:
+                try:
+                    cell_features.append(self._source.features_from_polygon(cell, tags=tags))
+                except EmptyOverpassResponse:
+                    continue
+                record_features(record, cell_features[-1])
+        features = merge_cell_features(polygon, cell_features)
+        if features.empty:
+            raise EmptyOverpassResponse(f'No matching features in {len(cells)} query cells')
+        return features
+
+    def tags_from_polygon(self, polygon: Polygon | MultiPolygon, tags: dict, required_key: str = None) -> pd.DataFrame:
+        """
+        Загружает теги объектов внутри полигона без геометрии по ячейкам (легкий режим, см. OverpassSource).
+        Без геометрии объекты нельзя обрезать после загрузки, поэтому ячейки - точные части полигона
+        без упрощения границы, а дыры полигона исключаются самим запросом.
+        :param polygon: Полигон запроса.
+        :param tags: Словарь тегов запроса.
+        :param required_key: Ключ, который обязательно должен быть у объекта.
+        :return: DataFrame с тегами объектов; объекты на границе ячеек встречаются один раз.
+        """
+        cell_tags = []
+        for cell in query_cells(polygon, self.max_area, tolerance=0):
+            with profiler.stage('fetch_cell') as record:
+                cell_tags.append(self._source.tags_from_polygon(cell, tags, required_key))
+                record_features(record, cell_tags[-1])
+        features = pd.concat(cell_tags)
+        return features[~features.index.duplicated()]
+
+    def count_from_polygon(self, polygon: Polygon | MultiPolygon, tag_sets: list[dict]) -> list[int]:
+        """
+        Считает объекты внутри полигона (легкий режим). Если полигон умещается в одну ячейку, объекты
+        считаются на сервере (out count); иначе числа по ячейкам нельзя сложить из-за объектов на границе ячеек,
+        поэтому загружаются теги объектов и объекты считаются после удаления повторов. Как и в tags_from_polygon,
+        запросы идут по точной границе полигона.
+        :param polygon: Полигон запроса.
+        :param tag_sets: Список словарей тегов.
+        :return: Число объектов для каждого набора тегов.
+        """
+        cells = query_cells(polygon, self.max_area, tolerance=0)
+        if len(cells) == 1:
+            with profiler.stage('fetch_cell'):
+                return self._source.count_from_polygon(cells[0], tag_sets)
+        merged = defaultdict(set)
+        for tags in tag_sets:
+            for key, values in tags.items():
+                merged[key].update([values] if isinstance(values, str) else values)
+        features = self.tags_from_polygon(polygon, {key: sorted(values) for key, values in merged.items()})
+        return [len(MetricCollector.select_layer(features, tags)) for tags in tag_sets]
@@ -0,0 +1,7 @@
+import pytest
+from shapely import box
+
+
+@pytest.fixture
+def district():
+    return box(84.9, 56.4, 85.1, 56.6)
@@ -0,0 +1,34 @@
+import orjson
+
+from checkpoint import RunCheckpoint
+from main import save_raw_metrics
+
+
+def district_metrics(title: str) -> dict:
+    return {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'properties': {'title': title},
+        'geometry': {'type': 'Point', 'coordinates': [85.0, 56.5]},
+    }]}
+
+
+def test_raw_metrics_are_read_per_city(tmp_path):
+    checkpoint = RunCheckpoint(tmp_path)
+    checkpoint.record_success('Томск', 'Советский район', district_metrics('Советский'))
+    checkpoint.record_success('Новосибирск', 'Центральный район', district_metrics('Центральный'))
+    checkpoint.record_success('Томск', 'Кировский район', district_metrics('Кировский'))
+
+    # После возобновления метрики читаются с диска по смещениям строк
+    resumed = RunCheckpoint(tmp_path, resume=True)
+    raw_metrics = resumed.raw_metrics({
+        'Томск': ['Кировский район', 'Ленинский район', 'Советский район'],
+        'Новосибирск': ['Центральный район'],
+        'Омск': ['Центральный район'],
+    })
+
+    assert list(raw_metrics) == ['Томск', 'Новосибирск']
+    assert list(raw_metrics['Томск']['districts']) == ['Кировский район', 'Советский район']
+    assert raw_metrics['Новосибирск']['districts']['Центральный район'] == district_metrics('Центральный')
+    assert resumed.completed_metrics('Томск', 'Кировский район') == district_metrics('Кировский')
+
+    save_raw_metrics(raw_metrics, str(tmp_path.joinpath('metrics_outputs.json')))
+    assert tmp_path.joinpath('metrics_outputs.json').read_bytes() == orjson.dumps(dict(raw_metrics))
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+import shapely
+
+from area_engine import to_equal_area
+from bench import SyntheticFeatureSource, synthetic_district
+from collect_metric import FEATURE_BYTES, MetricCollector, metrics_of_kind
+
+METRICS = [metrics_of_kind('count')[0], metrics_of_kind('area')[0], metrics_of_kind('mean')[0]]
+MEMORY_BUDGET = 1.0
+
+
+class FixedFeatureSource:
+    """
+    Заглушка источника с легким режимом: один и тот же набор объектов для любого полигона.
+    Запоминает полигоны, загруженные целиком, и полигоны, число объектов в которых превысило бюджет.
+    """
+    light_fetch = True
+
+    def __init__(self, features):
+        self.features = features
+        self.fetched = []
+        self.over_budget = []
+
+    def _within(self, polygon, tags: dict):
+        return MetricCollector.select_layer(self.features[self.features.intersects(polygon)], tags)
+
+    def features_from_polygon(self, polygon, tags: dict):
+        self.fetched.append(shapely.to_wkb(polygon))
+        return self._within(polygon, tags)
+
+    def count_from_polygon(self, polygon, tag_sets: list[dict]) -> list[int]:
+        counts = [len(self._within(polygon, tags)) for tags in tag_sets]
+        if sum(counts) * FEATURE_BYTES > MEMORY_BUDGET * 2 ** 20:
+            self.over_budget.append(shapely.to_wkb(polygon))
+        return counts
+
+
+def test_chunked_values_equal_whole_district():
+    district = synthetic_district(1.0)
+    # Объекты вокруг района, в том числе на границах района и чанков: частые точки, из-за которых чанки
+    # не укладываются в бюджет, и редкие полигоны, площадь которых не покрывает район целиком
+    around = shapely.buffer(district.geometry.iloc[0], 0.001)
+    points = SyntheticFeatureSource(density=6_000).features_from_polygon(
+        around, MetricCollector.merge_tags(METRICS[:1]))
+    polygons = SyntheticFeatureSource(density=150, seed=1).features_from_polygon(
+        around, MetricCollector.merge_tags(METRICS[1:]))
+    features = pd.concat([points, polygons])
+    source = FixedFeatureSource(features)
+
+    whole = MetricCollector.fetch_metrics(district, dict.fromkeys(METRICS, True), features=features)
+    district_equal_area = to_equal_area(district.geometry.to_numpy(), district.crs)[0]
+    chunked = MetricCollector.fetch_chunked_values(district.geometry.iloc[0], district_equal_area, METRICS,
+                                                   district_equal_area.area, source, MEMORY_BUDGET)
+
+    assert chunked[METRICS[0]] == whole[METRICS[0]][0]
+    assert chunked[METRICS[1]] == pytest.approx(whole[METRICS[1]][0])
+    assert chunked[METRICS[2]] == pytest.approx(whole[METRICS[2]][0], rel=1e-5)
+    # Чанки, которые по числу объектов не укладываются в бюджет, делятся без загрузки объектов
+    assert source.over_budget
+    assert not set(source.over_budget) & set(source.fetched)
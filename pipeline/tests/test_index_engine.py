@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas import DataFrame
+from pandas.testing import assert_frame_equal
+
+from index_engine import KEYS, METRIC_DIRECTIONS, IndexState, index_districts
+
+METRIC_NAMES = list(METRIC_DIRECTIONS)
+
+
+def metrics_frame(seed: int, cities: dict[str, int]) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = [(city, f'{city} district {number}') for city, count in cities.items() for number in range(count)]
+    df = DataFrame(rows, columns=KEYS)
+    values = rng.uniform(0, 100, size=(len(df), len(METRIC_NAMES)))
+    values[rng.uniform(size=values.shape) < 0.1] = np.nan
+    df[METRIC_NAMES] = values
+    return df
+
+
+def assert_matches_full(state: IndexState, df: DataFrame):
+    # df - все районы состояния: индекс всех районов совпадает с полным пересчетом по ним
+    assert len(state.districts) == len(df)
+    expected = index_districts(df).sort_values(KEYS).reset_index(drop=True)
+    actual = state.indexed(df).sort_values(KEYS).reset_index(drop=True)
+    assert_frame_equal(actual[expected.columns], expected, check_dtype=False, rtol=0, atol=1e-9)
+
+
+@pytest.fixture
+def state(tmp_path) -> IndexState:
+    return IndexState(tmp_path.joinpath('index_state'))
+
+
+def test_changing_inputs_match_full_index(state, tmp_path):
+    df = metrics_frame(0, {'Томск': 6, 'Новосибирск': 8, 'Омск': 5})
+    state.update(df)
+    assert_matches_full(state, df)
+
+    # Запуск по части городов обновляет только их, а остальные города остаются в состоянии
+    subset = df[df['city'] != 'Омск'].copy()
+    subset.loc[subset['city'] == 'Томск', METRIC_NAMES[2]] *= 2
+    state.update(subset)
+    current = pd.concat([subset, df[df['city'] == 'Омск']], ignore_index=True)
+    assert_matches_full(state, current)
+
+    # Удаленный район, измененные значения и новый город
+    changed = subset[subset['district'] != 'Томск district 0'].copy()
+    changed.loc[changed['city'] == 'Новосибирск', METRIC_NAMES[0]] += 50
+    changed.loc[changed.index[1], METRIC_NAMES[1]] = np.nan
+    changed = pd.concat([changed, metrics_frame(1, {'Барнаул': 4})], ignore_index=True)
+    assert set(state.changed_districts(changed).get_level_values('city')) == {'Томск', 'Новосибирск', 'Барнаул'}
+    state.update(changed)
+    current = pd.concat([changed, df[df['city'] == 'Омск']], ignore_index=True)
+    assert_matches_full(state, current)
+    assert ('Томск', 'Томск district 0') not in state.districts.index
+
+    # Сохраненное состояние загружается и продолжает совпадать с полным пересчетом
+    state.save()
+    reloaded = IndexState(tmp_path.joinpath('index_state'))
+    restored = df[df['city'] != 'Барнаул']
+    reloaded.update(restored)
+    assert_matches_full(reloaded, pd.concat([restored, changed[changed['city'] == 'Барнаул']], ignore_index=True))
+
+
+def test_unchanged_input_returns_nothing(state):
+    df = metrics_frame(2, {'Томск': 5, 'Омск': 5})
+    state.update(df)
+    assert state.update(df.sample(frac=1, random_state=0)).empty
+    assert_matches_full(state, df)
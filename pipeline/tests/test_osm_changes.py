@@ -0,0 +1,113 @@
+import orjson
+import shapely
+from click.testing import CliRunner
+from geopandas import GeoDataFrame
+from shapely.geometry import mapping
+
+from osm_changes import affected_districts, changed_features, locate_changes, refresh
+
+TAGS = {'amenity': ['school']}
+
+
+def element(element_type: str, osmid: int, action: str, tags: dict = None, lon: float = None, lat: float = None,
+            refs: list[int] = None, timestamp: str = None) -> dict:
+    return {'element_type': element_type, 'osmid': osmid, 'action': action, 'timestamp': timestamp,
+            'tags': tags or {}, 'lon': lon, 'lat': lat, 'refs': refs or [], 'ways': []}
+
+
+class BoundsSource:
+    """
+    Заглушка Overpass: возвращает прямоугольники известных объектов и запоминает запросы.
+    """
+
+    def __init__(self, bounds: dict):
+        self.bounds = bounds
+        self.requests = []
+
+    def bounds_from_ids(self, ids: dict, date: str = None) -> dict:
+        self.requests.append((dict(ids), date))
+        return {(element_type, osmid): self.bounds[element_type, osmid] for element_type, osmids in ids.items()
+                for osmid in osmids if (element_type, osmid) in self.bounds}
+
+
+def relevant(elements: list[dict]) -> set[tuple[str, int]]:
+    changes = changed_features(elements, TAGS)
+    return set(zip(changes['element_type'], changes['osmid']))
+
+
+def test_modified_way_without_metric_tags_is_relevant():
+    elements = [
+        element('node', 1, 'modify', lon=85.0, lat=56.5),
+        element('node', 2, 'modify', lon=85.01, lat=56.51),
+        # Школа, с которой сняли теги: в файле изменений только новые теги
+        element('way', 10, 'modify', {'building': 'yes'}, refs=[1, 2]),
+        element('way', 11, 'create', {'building': 'yes'}, refs=[1, 2]),
+    ]
+    assert relevant(elements) == {('way', 10)}
+
+
+def test_node_changes():
+    elements = [
+        element('node', 1, 'create', {'amenity': 'school'}, 85.0, 56.5),
+        element('node', 2, 'create', {'amenity': 'cafe'}, 85.0, 56.5),
+        element('node', 3, 'modify', {'name': 'Школа'}, 85.0, 56.5),
+        element('node', 4, 'modify', lon=85.0, lat=56.5),
+        element('node', 5, 'delete', {'amenity': 'school'}, 85.0, 56.5),
+        element('node', 6, 'delete', lon=85.0, lat=56.5),
+    ]
+    assert relevant(elements) == {('node', 1), ('node', 3), ('node', 5)}
+
+
+def test_deleted_vertices_locate_deleted_way():
+    elements = [
+        element('node', 1, 'delete', lon=85.0, lat=56.5),
+        element('node', 2, 'delete', lon=85.01, lat=56.51),
+        element('way', 10, 'delete', refs=[1, 2]),
+    ]
+    changes = changed_features(elements, TAGS)
+    assert list(changes['osmid']) == [10]
+    assert changes.geometry.iloc[0].bounds == (85.0, 56.5, 85.01, 56.51)
+
+
+def test_tag_only_way_edit_is_located_by_overpass(district):
+    # Изменены только теги линии: ее точек в файле изменений нет
+    changes = changed_features([element('way', 10, 'modify', {'amenity': 'school'}, refs=[1, 2, 3])], TAGS)
+    assert list(changes['osmid']) == [10]
+    assert changes.geometry.isna().all()
+
+    source = BoundsSource({('way', 10): shapely.box(84.95, 56.45, 84.96, 56.46)})
+    located = locate_changes(changes, source)
+    assert source.requests == [({'way': [10]}, None)]
+    districts = GeoDataFrame({'city': ['Томск'], 'district': ['Советский район']}, geometry=[district],
+                             crs='epsg:4326')
+    assert affected_districts(located, districts) == [('Томск', 'Советский район')]
+
+
+def test_deleted_way_is_located_before_deletion():
+    changes = changed_features([element('way', 10, 'delete', refs=[1, 2], timestamp='2024-05-01T12:00:00Z')], TAGS)
+    source = BoundsSource({})
+    located = locate_changes(changes, source)
+    assert source.requests == [({'way': [10]}, '2024-05-01T11:59:59Z')]
+    assert located.geometry.isna().all()
+
+
+def test_state_is_kept_while_changes_are_not_located(tmp_path, district):
+    changes = tmp_path.joinpath('changes')
+    changes.mkdir()
+    changes.joinpath('001.osc').write_text(
+        '<osmChange version="0.6"><modify><way id="10" timestamp="2024-05-01T12:00:00Z">'
+        '<nd ref="1"/><nd ref="2"/><tag k="amenity" v="school"/></way></modify></osmChange>')
+    raw_metrics = tmp_path.joinpath('metrics_outputs.json')
+    raw_metrics.write_bytes(orjson.dumps({'Томск': {'districts': {'Советский район': {
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'properties': {'title': 'Советский район'},
+                      'geometry': mapping(district)}],
+    }}}}))
+    state = tmp_path.joinpath('state.json')
+
+    # С --pbf сеть не используется, поэтому изменение только тегов линии остается нерасположенным
+    result = CliRunner().invoke(refresh, ['--changes', str(changes), '--state', str(state),
+                                          '--file_raw_metrics', str(raw_metrics), '--pbf', 'extract.osm.pbf'])
+
+    assert result.exit_code == 0, result.output
+    assert not state.exists()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+import shapely
+from shapely import box
+
+from osm_cache import AsyncOsmCache, CacheMissError, OsmCache
+from overpass_client import AsyncOverpassClient, TokenBucket, _hole_free_parts, _poly_filters
+
+TAGS = {'highway': ['bus_stop']}
+
+
+def overpass_elements(*points: tuple[float, float]) -> dict:
+    """
+    :return: Ответ Overpass (out geom) с остановками в указанных точках.
+    """
+    return {'elements': [
+        {'type': 'node', 'id': osmid, 'lon': lon, 'lat': lat, 'tags': {'highway': 'bus_stop'}}
+        for osmid, (lon, lat) in enumerate(points, start=1)
+    ]}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def fetch_features(handler, district, requests: int = 1, **options):
+    async with AsyncOverpassClient(transport=httpx.MockTransport(handler), backoff=0, **options) as client:
+        results = await asyncio.gather(*(client.features_from_polygon(district, TAGS) for _ in range(requests)))
+    return client, results
+
+
+def test_retries_overloaded_server(district):
+    statuses = [429, 503]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if statuses:
+            return httpx.Response(statuses.pop(0))
+        return httpx.Response(200, json=overpass_elements((85.0, 56.5)))
+
+    client, (features,) = run(fetch_features(handler, district))
+    assert len(features) == 1
+    assert client.stats.requests == 3
+    assert client.stats.retries == 2
+    assert client.stats.failures == 0
+
+
+def test_gives_up_after_max_retries(district):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(fetch_features(handler, district, max_retries=2))
+    assert len(calls) == 3
+
+
+def test_does_not_retry_client_errors(district):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(400)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        run(fetch_features(handler, district))
+    assert len(calls) == 1
+
+
+def test_limits_concurrent_requests(district):
+    in_flight = []
+    peak = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        in_flight.append(request)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.02)
+        in_flight.remove(request)
+        return httpx.Response(200, json=overpass_elements((85.0, 56.5)))
+
+    client, results = run(fetch_features(handler, district, requests=10, concurrency=3, overpass_rate=1000))
+    assert len(results) == 10
+    assert max(peak) == 3
+
+
+def test_limits_request_rate(district):
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json=overpass_elements())
+
+    started_at = time.monotonic()
+    # Первые 20 запросов укладываются во всплеск, оставшиеся 10 ждут токенов по 1/20 секунды
+    run(fetch_features(handler, district, requests=30, concurrency=30, overpass_rate=20))
+    assert time.monotonic() - started_at >= 0.45
+
+
+def test_token_bucket_allows_burst():
+    async def acquire_all():
+        bucket = TokenBucket(rate=1, capacity=5)
+        started_at = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - started_at
+
+    assert run(acquire_all()) < 0.1
+
+
+def test_cached_client_reuses_responses(tmp_path, district):
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(200, json=overpass_elements((85.0, 56.5), (85.05, 56.55)))
+
+    async def fetch_twice(cache: OsmCache):
+        async with AsyncOverpassClient(transport=httpx.MockTransport(handler)) as client:
+            cached = AsyncOsmCache(client, cache)
+            first = await cached.features_from_polygon(district, TAGS)
+            second = await cached.features_from_polygon(district, TAGS)
+        return first, second
+
+    first, second = run(fetch_twice(OsmCache(tmp_path)))
+    assert len(calls) == 1
+    assert sorted(first.index) == sorted(second.index)
+    # Запись, сделанная асинхронным клиентом, видна обычному кэшу
+    assert len(OsmCache(tmp_path, mode='offline').features_from_polygon(district, tags=TAGS)) == 2
+
+
+def test_cached_client_offline_miss(tmp_path, district):
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise AssertionError('Offline cache must not send requests')
+
+    async def fetch():
+        async with AsyncOverpassClient(transport=httpx.MockTransport(handler)) as client:
+            return await AsyncOsmCache(client, OsmCache(tmp_path, mode='offline')).features_from_polygon(district, TAGS)
+
+    with pytest.raises(CacheMissError):
+        run(fetch())
+
+
+def test_poly_filters_exclude_holes(district):
+    holed = district.difference(shapely.union_all([box(84.95, 56.45, 84.98, 56.48), box(85.0, 56.5, 85.05, 56.55)]))
+    parts = _hole_free_parts(holed)
+    assert all(not part.interiors for part in parts)
+    assert shapely.union_all(parts).symmetric_difference(holed).area == pytest.approx(0, abs=1e-12)
+    assert len(_poly_filters(holed)) == len(parts)
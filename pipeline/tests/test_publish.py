@@ -0,0 +1,40 @@
+import main
+from bench import SyntheticGeocoder, synthetic_metrics_outputs
+from index_engine import METRIC_DIRECTIONS
+
+CHANGED_METRIC = next(iter(METRIC_DIRECTIONS))
+
+
+def changed_city() -> tuple[dict, tuple[str, str]]:
+    city_name, city = next(iter(synthetic_metrics_outputs(6, 2).items()))
+    district_name, district = next(iter(city['districts'].items()))
+    district['features'][0]['properties'][CHANGED_METRIC] += 1
+    return {city_name: city}, (city_name, district_name)
+
+
+def test_upsert_loads_only_changed_districts(tmp_path, monkeypatch):
+    loads = []
+
+    async def load_to_postgis(path, dsn=None, mode='replace', districts_filter=None):
+        loads.append(districts_filter)
+
+    def publish(raw_metrics: dict) -> None:
+        main.publish_index(raw_metrics, SyntheticGeocoder(), str(tmp_path.joinpath('districts.json')),
+                           str(tmp_path.joinpath('districts.md')), load_db='upsert',
+                           index_state=str(tmp_path.joinpath('index_state')))
+
+    monkeypatch.setattr(main, 'load_to_postgis', load_to_postgis)
+    raw_metrics = synthetic_metrics_outputs(6, 2)
+    publish(raw_metrics)
+    assert loads == [{(city_name, district_name) for city_name, city in raw_metrics.items()
+                      for district_name in city['districts']}]
+
+    # Запуск по одному городу с одним измененным районом загружает только этот район
+    city, key = changed_city()
+    publish(city)
+    assert loads[1:] == [{key}]
+
+    # Без изменений база не загружается
+    city, _ = changed_city()
+    publish(city)
+    assert len(loads) == 2
@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+import pytest
+from click.testing import CliRunner
+
+import distributed
+from work_queue import open_queue
+
+CITY = 'Томск'
+DISTRICTS = ['Кировский район', 'Ленинский район', 'Октябрьский район', 'Советский район']
+CRASHING = 'Ленинский район'
+
+
+# Очередь в Postgres проверяется, если задан DSN тестовой базы; таблица очереди в ней пересоздается
+POSTGRES_DSN = os.environ.get('PIPELINE_TEST_POSTGRES_DSN')
+
+
+async def _postgres(query: str):
+    connection = await asyncpg.connect(POSTGRES_DSN)
+    try:
+        return await connection.fetch(query)
+    finally:
+        await connection.close()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def queue_target(request, tmp_path) -> str:
+    if request.param == 'sqlite':
+        return str(tmp_path.joinpath('queue.sqlite'))
+    if not POSTGRES_DSN:
+        pytest.skip('PIPELINE_TEST_POSTGRES_DSN is not set')
+    asyncio.run(_postgres('DROP TABLE IF EXISTS work_queue_tasks'))
+    return POSTGRES_DSN
+
+
+def attempts(queue_target: str) -> dict[str, int]:
+    if queue_target == POSTGRES_DSN:
+        return dict(asyncio.run(_postgres('SELECT district, attempts FROM work_queue_tasks')))
+    with sqlite3.connect(queue_target) as connection:
+        return dict(connection.execute('SELECT district, attempts FROM tasks'))
+
+
+def test_expired_lease_is_reclaimed(queue_target):
+    queue = open_queue(queue_target, lease_seconds=0.2, max_attempts=2)
+    queue.enqueue({CITY: DISTRICTS[:1]})
+    assert queue.claim('first') == (CITY, DISTRICTS[0])
+    assert queue.claim('second') is None
+
+    time.sleep(0.3)
+    assert queue.claim('second') == (CITY, DISTRICTS[0])
+    assert not queue.heartbeat('first', CITY, DISTRICTS[0])
+    queue.complete('second', CITY, DISTRICTS[0], {'features': []})
+    assert queue.counts()['done'] == 1
+    assert attempts(queue_target) == {DISTRICTS[0]: 2}
+
+
+def test_lease_expires_after_last_attempt(queue_target):
+    queue = open_queue(queue_target, lease_seconds=0.2, max_attempts=1)
+    queue.enqueue({CITY: DISTRICTS[:1]})
+    queue.claim('first')
+    time.sleep(0.3)
+    assert queue.claim('second') is None
+    assert queue.is_finished()
+    assert queue.failures()[0]['error'] == 'Lease expired'
+
+
+def test_concurrent_claims_are_distinct(queue_target):
+    queue = open_queue(queue_target)
+    queue.enqueue({CITY: DISTRICTS})
+
+    def claim_all(worker_id):
+        claimed = []
+        while (task := queue.claim(worker_id)) is not None:
+            claimed.append(task)
+        return claimed
+
+    with ThreadPoolExecutor(4) as executor:
+        claimed = [task for tasks in executor.map(claim_all, ['a', 'b', 'c', 'd']) for task in tasks]
+    assert sorted(claimed) == sorted((CITY, district) for district in DISTRICTS)
+
+
+def test_local_reclaims_district_of_crashed_worker(tmp_path, queue_target, monkeypatch):
+    crashed = tmp_path.joinpath('crashed')
+    published = []
+
+    def collect_district(city_name, district_name, *args):
+        # Первая попытка собрать район обрывает процесс исполнителя, не освобождая аренду
+        if district_name == CRASHING and not crashed.exists():
+            crashed.touch()
+            os._exit(1)
+        return {'type': 'FeatureCollection', 'features': [], 'district': district_name}
+
+    # Подмены действуют в процессах исполнителей, только если они создаются через fork
+    monkeypatch.setattr(distributed, 'Process', multiprocessing.get_context('fork').Process)
+    monkeypatch.setattr(distributed, 'make_source', lambda **source_settings: None)
+    monkeypatch.setattr(distributed, 'read_districts_list', lambda cities: {CITY: DISTRICTS})
+    monkeypatch.setattr(distributed, '_geocode_districts',
+                        lambda city_name, district_list, source: {district: None for district in district_list})
+    monkeypatch.setattr(distributed, '_collect_district', collect_district)
+    monkeypatch.setattr(distributed, '_publish', lambda queue, *args: published.append(queue.results()))
+
+    result = CliRunner().invoke(distributed.cli, [
+        'local', '--cities', CITY, '--queue', queue_target, '--workers', '2', '--lease', '1',
+        '--poll_interval', '0.1',
+    ])
+
+    assert result.exit_code == 0, result.output
+    assert crashed.exists()
+    assert open_queue(queue_target).counts()['done'] == len(DISTRICTS)
+    assert attempts(queue_target)[CRASHING] == 2
+    assert list(published[0][CITY]['districts']) == DISTRICTS
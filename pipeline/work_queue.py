@@ -0,0 +1,443 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Literal
+
+import asyncpg
+import orjson
+
+from checkpoint import CityMetrics
+
+# pending - ждет исполнителя, leased - выдана исполнителю до lease_until, done - собрана, failed - исчерпаны попытки
+TaskStatus = Literal['pending', 'leased', 'done', 'failed']
+TASK_STATUSES: tuple[TaskStatus, ...] = ('pending', 'leased', 'done', 'failed')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    city TEXT NOT NULL,
+    district TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    metrics BLOB,
+    error TEXT,
+    PRIMARY KEY (city, district)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, position);
+'''
+
+# Время аренды в Postgres берется из часов сервера, поэтому расхождение часов исполнителей на аренду не влияет
+POSTGRES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS work_queue_tasks (
+    city text NOT NULL,
+    district text NOT NULL,
+    position integer NOT NULL,
+    status text NOT NULL DEFAULT 'pending',
+    worker text,
+    lease_until timestamptz,
+    attempts integer NOT NULL DEFAULT 0,
+    metrics bytea,
+    error text,
+    PRIMARY KEY (city, district)
+);
+CREATE INDEX IF NOT EXISTS work_queue_tasks_status ON work_queue_tasks (status, position);
+'''
+POSTGRES_SCHEMES = ('postgresql://', 'postgres://')
+
+
+class LeaseQueue:
+    """
+    Класс LeaseQueue - общая часть очередей задач сбора метрик (город, район) с арендой.
+    Исполнитель забирает задачу на время аренды и продлевает ее, пока собирает район (см. leased);
+    если исполнитель упал и аренда истекла, задача возвращается в очередь и достается другому исполнителю.
+    Задача, которая не удалась max_attempts раз, помечается как failed. Метрики собранных районов хранятся
+    в той же базе, поэтому координатор считает индекс, когда все задачи завершены.
+    Хранилище задач реализуют наследники: WorkQueue (SQLite) и PostgresWorkQueue.
+    """
+
+    def __init__(self, lease_seconds: float = 300, max_attempts: int = 3):
+        """
+        :param lease_seconds: Срок аренды задачи; исполнитель продлевает аренду каждую треть срока.
+        :param max_attempts: Число попыток собрать район.
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def heartbeat(self, worker_id: str, city_name: str, district_name: str) -> bool:
+        raise NotImplementedError
+
+    def counts(self) -> dict[TaskStatus, int]:
+        raise NotImplementedError
+
+    @contextmanager
+    def leased(self, worker_id: str, city_name: str, district_name: str):
+        """
+        Продлевает аренду задачи в фоновом потоке, пока выполняется блок with.
+        """
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.lease_seconds / 3):
+                if not self.heartbeat(worker_id, city_name, district_name):
+                    logging.warning(f'Lease of {city_name} {district_name} is lost by {worker_id}')
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def is_finished(self) -> bool:
+        """
+        :return: Все задачи собраны или исчерпали попытки.
+        """
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0
+
+    @staticmethod
+    def _failures(rows) -> list[dict]:
+        return [{'city': city_name, 'district': district_name, 'attempts': attempts, 'error': error}
+                for city_name, district_name, attempts, error in rows]
+
+    @staticmethod
+    def _city_results(rows) -> dict:
+        return {'districts': {district_name: orjson.loads(metrics) for district_name, metrics in rows}}
+
+
+class WorkQueue(LeaseQueue):
+    """
+    Класс WorkQueue - очередь задач с арендой в SQLite (см. LeaseQueue).
+    Каждая операция открывает свое соединение и выполняется одной транзакцией, поэтому очередь можно
+    использовать из нескольких потоков и процессов одной машины. Файл базы должен лежать на локальном диске:
+    режим WAL использует общую память рядом с файлом, а блокировки файлов на сетевых дисках (NFS, SMB)
+    ненадежны, поэтому для исполнителей на разных машинах нужна очередь в Postgres (см. PostgresWorkQueue).
+    """
+
+    def __init__(self, path: str | Path = 'data/work_queue.sqlite', lease_seconds: float = 300,
+                 max_attempts: int = 3):
+        """
+        :param path: Файл базы очереди.
+        :param lease_seconds: Срок аренды задачи; исполнитель продлевает аренду каждую треть срока.
+        :param max_attempts: Число попыток собрать район.
+        """
+        super().__init__(lease_seconds, max_attempts)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому два исполнителя не заберут одну задачу
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def enqueue(self, cities: dict[str, list[str]], reset: bool = False) -> int:
+        """
+        Добавляет задачи районов; уже добавленные районы не меняются.
+        :param cities: Словарь {город: [районы]}.
+        :param reset: Очистить очередь перед добавлением.
+        :return: Число новых задач.
+        """
+        pairs = [(city_name, district_name) for city_name, district_list in cities.items()
+                 for district_name in district_list]
+        tasks = [(city_name, district_name, position) for position, (city_name, district_name) in enumerate(pairs)]
+        with self._transaction() as connection:
+            if reset:
+                connection.execute('DELETE FROM tasks')
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO tasks (city, district, position) VALUES (?, ?, ?)', tasks)
+            return connection.total_changes - before
+
+    def _reclaim(self, connection: sqlite3.Connection) -> None:
+        connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+            "error = 'Lease expired' WHERE status = 'leased' AND lease_until < ?",
+            (self.max_attempts, time.time()))
+
+    def claim(self, worker_id: str) -> tuple[str, str] | None:
+        """
+        Забирает следующую задачу в аренду; задачи с истекшей арендой сначала возвращаются в очередь.
+        :param worker_id: Идентификатор исполнителя.
+        :return: (город, район) или None, если свободных задач нет.
+        """
+        with self._transaction() as connection:
+            self._reclaim(connection)
+            row = connection.execute(
+                "SELECT city, district FROM tasks WHERE status = 'pending' ORDER BY attempts, position LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE city = ? AND district = ?",
+                (worker_id, time.time() + self.lease_seconds, *row))
+            return row
+
+    def heartbeat(self, worker_id: str, city_name: str, district_name: str) -> bool:
+        """
+        Продлевает аренду задачи.
+        :return: False, если аренда уже потеряна (истекла и задача выдана другому исполнителю).
+        """
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_until = ? WHERE city = ? AND district = ? AND status = 'leased' AND worker = ?",
+                (time.time() + self.lease_seconds, city_name, district_name, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, worker_id: str, city_name: str, district_name: str, metrics: dict) -> None:
+        """
+        Сохраняет метрики собранного района. Сбор района детерминирован, поэтому результат принимается,
+        даже если аренда истекла, пока район не собран другим исполнителем.
+        :param metrics: FeatureCollection с метриками района.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = 'done', worker = ?, lease_until = NULL, metrics = ?, error = NULL "
+                "WHERE city = ? AND district = ? AND status != 'done'",
+                (worker_id, orjson.dumps(metrics, option=orjson.OPT_SERIALIZE_NUMPY), city_name, district_name))
+
+    def fail(self, worker_id: str, city_name: str, district_name: str, error: str) -> None:
+        """
+        Возвращает задачу в очередь после ошибки или помечает ее failed, если попытки исчерпаны.
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, "
+                "lease_until = NULL, error = ? WHERE city = ? AND district = ? AND status = 'leased' AND worker = ?",
+                (self.max_attempts, error, city_name, district_name, worker_id))
+
+    def counts(self) -> dict[TaskStatus, int]:
+        """
+        :return: Число задач в каждом статусе.
+        """
+        with self._transaction() as connection:
+            self._reclaim(connection)
+            rows = connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return {status: 0 for status in TASK_STATUSES} | dict(rows)
+
+    def failures(self) -> list[dict]:
+        """
+        :return: Задачи, исчерпавшие попытки, с последней ошибкой.
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT city, district, attempts, error FROM tasks WHERE status = 'failed' ORDER BY position"
+            ).fetchall()
+        return self._failures(rows)
+
+    def results(self) -> CityMetrics:
+        """
+        :return: Сырые метрики собранных районов в формате fetch_raw_metrics, в порядке добавления задач;
+            метрики города читаются из базы при обращении к городу.
+        """
+        with self._connect() as connection:
+            cities = [city_name for city_name, in connection.execute(
+                "SELECT city FROM tasks WHERE status = 'done' GROUP BY city ORDER BY MIN(position)")]
+
+        def load(city_name: str) -> dict:
+            with self._connect() as connection:
+                rows = connection.execute(
+                    "SELECT district, metrics FROM tasks WHERE status = 'done' AND city = ? ORDER BY position",
+                    (city_name,)).fetchall()
+            return self._city_results(rows)
+
+        return CityMetrics(cities, load)
+
+
+class PostgresWorkQueue(LeaseQueue):
+    """
+    Класс PostgresWorkQueue - очередь задач с арендой в Postgres (см. LeaseQueue) для исполнителей на нескольких
+    машинах. Задачи забираются запросом SELECT ... FOR UPDATE SKIP LOCKED: исполнители не ждут друг друга
+    и не получают одну задачу дважды. Срок аренды считается по часам сервера базы.
+    Каждая операция открывает свое соединение и выполняется одной транзакцией, как у WorkQueue.
+    """
+
+    def __init__(self, dsn: str, lease_seconds: float = 300, max_attempts: int = 3):
+        """
+        :param dsn: DSN базы очереди (postgresql://...).
+        :param lease_seconds: Срок аренды задачи; исполнитель продлевает аренду каждую треть срока.
+        :param max_attempts: Число попыток собрать район.
+        """
+        super().__init__(lease_seconds, max_attempts)
+        self.dsn = dsn
+
+        async def create(connection):
+            # Блокировка не дает нескольким исполнителям одновременно создавать таблицу
+            await connection.execute("SELECT pg_advisory_xact_lock(hashtext('work_queue_tasks'))")
+            await connection.execute(POSTGRES_SCHEMA)
+
+        self._transaction(create)
+
+    def _transaction(self, operation):
+        # Очередь вызывается из синхронного кода и из потока продления аренды, поэтому операция выполняется
+        # в собственном цикле событий
+        async def run():
+            connection = await asyncpg.connect(self.dsn)
+            try:
+                async with connection.transaction():
+                    return await operation(connection)
+            finally:
+                await connection.close()
+
+        return asyncio.run(run())
+
+    async def _reclaim(self, connection: asyncpg.Connection) -> None:
+        await connection.execute(
+            "UPDATE work_queue_tasks SET status = CASE WHEN attempts >= $1 THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, error = 'Lease expired' WHERE (city, district) IN ("
+            "SELECT city, district FROM work_queue_tasks WHERE status = 'leased' AND lease_until < now() "
+            "FOR UPDATE SKIP LOCKED)",
+            self.max_attempts)
+
+    def enqueue(self, cities: dict[str, list[str]], reset: bool = False) -> int:
+        """
+        Добавляет задачи районов; уже добавленные районы не меняются.
+        :param cities: Словарь {город: [районы]}.
+        :param reset: Очистить очередь перед добавлением.
+        :return: Число новых задач.
+        """
+        pairs = [(city_name, district_name) for city_name, district_list in cities.items()
+                 for district_name in district_list]
+
+        async def insert(connection):
+            if reset:
+                await connection.execute('DELETE FROM work_queue_tasks')
+            status = await connection.execute(
+                'INSERT INTO work_queue_tasks (city, district, position) '
+                'SELECT * FROM unnest($1::text[], $2::text[], $3::integer[]) ON CONFLICT DO NOTHING',
+                [city_name for city_name, _ in pairs], [district_name for _, district_name in pairs],
+                list(range(len(pairs))))
+            return int(status.split()[-1])
+
+        return self._transaction(insert)
+
+    def claim(self, worker_id: str) -> tuple[str, str] | None:
+        """
+        Забирает следующую задачу в аренду; задачи с истекшей арендой сначала возвращаются в очередь.
+        :param worker_id: Идентификатор исполнителя.
+        :return: (город, район) или None, если свободных задач нет.
+        """
+        async def lease(connection):
+            await self._reclaim(connection)
+            row = await connection.fetchrow(
+                "UPDATE work_queue_tasks SET status = 'leased', worker = $1, "
+                "lease_until = now() + make_interval(secs => $2), attempts = attempts + 1 "
+                "WHERE (city, district) IN ("
+                "SELECT city, district FROM work_queue_tasks WHERE status = 'pending' ORDER BY attempts, position "
+                "LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING city, district",
+                worker_id, self.lease_seconds)
+            return None if row is None else tuple(row)
+
+        return self._transaction(lease)
+
+    def heartbeat(self, worker_id: str, city_name: str, district_name: str) -> bool:
+        """
+        Продлевает аренду задачи.
+        :return: False, если аренда уже потеряна (истекла и задача выдана другому исполнителю).
+        """
+        async def renew(connection):
+            status = await connection.execute(
+                "UPDATE work_queue_tasks SET lease_until = now() + make_interval(secs => $1) "
+                "WHERE city = $2 AND district = $3 AND status = 'leased' AND worker = $4",
+                self.lease_seconds, city_name, district_name, worker_id)
+            return status == 'UPDATE 1'
+
+        return self._transaction(renew)
+
+    def complete(self, worker_id: str, city_name: str, district_name: str, metrics: dict) -> None:
+        """
+        Сохраняет метрики собранного района, как WorkQueue.complete.
+        :param metrics: FeatureCollection с метриками района.
+        """
+        async def save(connection):
+            await connection.execute(
+                "UPDATE work_queue_tasks SET status = 'done', worker = $1, lease_until = NULL, metrics = $2, "
+                "error = NULL WHERE city = $3 AND district = $4 AND status != 'done'",
+                worker_id, orjson.dumps(metrics, option=orjson.OPT_SERIALIZE_NUMPY), city_name, district_name)
+
+        self._transaction(save)
+
+    def fail(self, worker_id: str, city_name: str, district_name: str, error: str) -> None:
+        """
+        Возвращает задачу в очередь после ошибки или помечает ее failed, если попытки исчерпаны.
+        """
+        async def release(connection):
+            await connection.execute(
+                "UPDATE work_queue_tasks SET status = CASE WHEN attempts >= $1 THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_until = NULL, error = $2 "
+                "WHERE city = $3 AND district = $4 AND status = 'leased' AND worker = $5",
+                self.max_attempts, error, city_name, district_name, worker_id)
+
+        self._transaction(release)
+
+    def counts(self) -> dict[TaskStatus, int]:
+        """
+        :return: Число задач в каждом статусе.
+        """
+        async def count(connection):
+            await self._reclaim(connection)
+            return await connection.fetch('SELECT status, COUNT(*) FROM work_queue_tasks GROUP BY status')
+
+        return {status: 0 for status in TASK_STATUSES} | {status: number for status, number in self._transaction(count)}
+
+    def failures(self) -> list[dict]:
+        """
+        :return: Задачи, исчерпавшие попытки, с последней ошибкой.
+        """
+        rows = self._transaction(lambda connection: connection.fetch(
+            "SELECT city, district, attempts, error FROM work_queue_tasks WHERE status = 'failed' ORDER BY position"))
+        return self._failures(rows)
+
+    def results(self) -> CityMetrics:
+        """
+        :return: Сырые метрики собранных районов в формате fetch_raw_metrics, в порядке добавления задач;
+            метрики города читаются из базы при обращении к городу.
+        """
+        rows = self._transaction(lambda connection: connection.fetch(
+            "SELECT city FROM work_queue_tasks WHERE status = 'done' GROUP BY city ORDER BY MIN(position)"))
+
+        def load(city_name: str) -> dict:
+            return self._city_results(self._transaction(lambda connection: connection.fetch(
+                "SELECT district, metrics FROM work_queue_tasks WHERE status = 'done' AND city = $1 "
+                "ORDER BY position", city_name)))
+
+        return CityMetrics([city_name for city_name, in rows], load)
+
+
+def open_queue(queue: str | Path, lease_seconds: float = 300, max_attempts: int = 3):
+    """
+    Открывает очередь задач: DSN postgresql:// - общая очередь в Postgres для исполнителей на нескольких машинах,
+    иначе - файл SQLite для одной машины.
+    :param queue: DSN Postgres или путь к файлу SQLite.
+    :param lease_seconds: Срок аренды задачи.
+    :param max_attempts: Число попыток собрать район.
+    :return: WorkQueue или PostgresWorkQueue.
+    """
+    if str(queue).startswith(POSTGRES_SCHEMES):
+        return PostgresWorkQueue(str(queue), lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return WorkQueue(queue, lease_seconds=lease_seconds, max_attempts=max_attempts)